@@ -0,0 +1,235 @@
+#!/usr/bin/env python3.6
+# coding: utf-8
+
+# Apply a rules file of literal and regex substitutions to many Rmd notebooks
+# at once. All rules that apply to a notebook are compiled into a single
+# alternation so each file is scanned exactly once, files are processed in a
+# process pool, and every rewrite is atomic (write to a temporary file in the
+# same folder, then rename over the original).
+#
+# Usage:
+#   ./batch_rewrite_rmd.py batch_rewrite_rules.yaml
+#   ./batch_rewrite_rmd.py --dry-run batch_rewrite_rules.yaml Lung_facs.Rmd
+#
+# The rules file is a YAML list. Each rule has either a "literal" or a "regex"
+# key, a "replace" key and optionally a "files" glob restricting which
+# notebooks it applies to:
+#
+#   - literal: |
+#       tiss <- ScaleData(object = tiss)
+#     replace: |
+#       tiss <- ScaleData(object = tiss, vars.to.regress = c("nReads"))
+#     files: "*_facs.Rmd"
+#   - regex: 'n.pcs = (\d+)'
+#     replace: 'n.pcs = \1'
+#
+# When several rules match at the same position, the one listed first wins.
+# Regex replacements may use \1 or \g<name> to refer to their own groups, but
+# since all rules share one pattern, patterns must not use backreferences,
+# global inline flags such as (?i) (use a scoped (?i:...) instead) or a group
+# name that another rule also uses.
+
+from concurrent.futures import ProcessPoolExecutor
+import difflib
+import fnmatch
+import glob
+import os
+import re
+import shutil
+import sys
+
+import click
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'utilities'))
+from atomic import write_atomic
+
+
+METHODS = 'facs', 'droplet'
+LITERAL = 'literal'
+REGEX = 'regex'
+REPLACE = 'replace'
+FILES = 'files'
+# Inline flags that are not scoped to a group, e.g. (?i) but not (?i:...)
+GLOBAL_FLAGS = re.compile(r'(?<!\\)\(\?[aiLmsux]+\)')
+
+
+class Rule:
+    def __init__(self, pattern, replace, is_regex=False, files=None):
+        self.pattern = pattern
+        self.replace = replace
+        self.is_regex = is_regex
+        self.files = files
+        # Compile on its own so a broken rule is reported by itself, and so
+        # the replacement can be expanded against the rule's own groups
+        self.regex = re.compile(pattern if is_regex else re.escape(pattern))
+
+    def applies_to(self, filename):
+        if self.files is None:
+            return True
+        return fnmatch.fnmatch(os.path.basename(filename), self.files)
+
+    def expand(self, content, start):
+        """Replacement text for this rule's match starting at ``start``"""
+        if not self.is_regex:
+            return self.replace
+        # Re-running the rule's own pattern at the same position gives the
+        # same span, with group numbers that are local to this rule
+        return self.regex.match(content, start).expand(self.replace)
+
+
+def read_rules(rules_yaml):
+    with open(rules_yaml) as f:
+        entries = yaml.safe_load(f) or []
+
+    rules = []
+    for i, entry in enumerate(entries):
+        if (LITERAL in entry) == (REGEX in entry):
+            raise click.BadParameter(
+                f'Rule {i} needs exactly one of "{LITERAL}" or "{REGEX}"')
+        if REPLACE not in entry:
+            raise click.BadParameter(f'Rule {i} has no "{REPLACE}"')
+        is_regex = REGEX in entry
+        pattern = entry[REGEX] if is_regex else entry[LITERAL]
+        try:
+            rules.append(Rule(pattern, entry[REPLACE], is_regex=is_regex,
+                              files=entry.get(FILES)))
+        except re.error as e:
+            raise click.BadParameter(f'Rule {i} is not a valid regex: {e}')
+        if is_regex and GLOBAL_FLAGS.search(pattern):
+            raise click.BadParameter(
+                f'Rule {i} uses global inline flags, which would apply to '
+                f'every rule; scope them to a group as in (?i:...)')
+    # Report rules that cannot share a pattern now, rather than per notebook
+    compile_matcher(rules)
+    return rules
+
+
+def compile_matcher(rules):
+    """Combine rules into one alternation with a named group per rule"""
+    alternatives = [f'(?P<r{i}>{rule.regex.pattern})'
+                    for i, rule in enumerate(rules)]
+    try:
+        return re.compile('|'.join(alternatives))
+    except re.error as e:
+        error = e
+    # Find the first rule that cannot be combined with the ones before it
+    for i in range(len(rules)):
+        try:
+            re.compile('|'.join(alternatives[:i + 1]))
+        except re.error as e:
+            raise click.BadParameter(
+                f'Rule {i} cannot be combined with the rules before it: {e}')
+    raise click.BadParameter(f'Rules cannot be combined: {error}')
+
+
+def rewrite(content, rules, matcher):
+    """Apply all rules in a single left-to-right pass
+
+    Returns the new content and the number of replacements per rule
+    """
+    counts = [0] * len(rules)
+
+    def substitute(match):
+        i = int(match.lastgroup[1:])
+        counts[i] += 1
+        return rules[i].expand(match.string, match.start())
+
+    return matcher.sub(substitute, content), counts
+
+
+# Set in each worker process by init_worker so the rules are only sent once
+_rules = None
+_matchers = {}
+
+
+def init_worker(rules):
+    global _rules
+    _rules = rules
+    _matchers.clear()
+
+
+def process_rmd(rmd, dry_run=False, backup=False):
+    # Notebooks of the same method usually share a rule subset, so cache the
+    # compiled matcher per subset
+    applicable = tuple(i for i, rule in enumerate(_rules)
+                       if rule.applies_to(rmd))
+    if not applicable:
+        return rmd, None, [0] * len(_rules)
+    if applicable not in _matchers:
+        _matchers[applicable] = compile_matcher([_rules[i]
+                                                 for i in applicable])
+    subset = [_rules[i] for i in applicable]
+
+    with open(rmd) as f:
+        content = f.read()
+    replaced, subset_counts = rewrite(content, subset, _matchers[applicable])
+
+    counts = [0] * len(_rules)
+    for i, n in zip(applicable, subset_counts):
+        counts[i] = n
+
+    if replaced == content:
+        return rmd, None, counts
+
+    if dry_run:
+        diff = ''.join(difflib.unified_diff(
+            content.splitlines(keepends=True),
+            replaced.splitlines(keepends=True),
+            fromfile=rmd, tofile=rmd + '.replaced'))
+        return rmd, diff, counts
+
+    if backup:
+        shutil.copy2(rmd, rmd + '.backup')
+    write_atomic(rmd, replaced)
+    return rmd, '', counts
+
+
+@click.command()
+@click.argument('rules_yaml')
+@click.argument('rmds', nargs=-1)
+@click.option('--dry-run', is_flag=True,
+              help='Print a unified diff instead of rewriting files')
+@click.option('--backup/--no-backup', default=False,
+              help='Copy each changed file to <file>.backup first')
+@click.option('--jobs', '-j', default=os.cpu_count(),
+              help='Number of worker processes')
+def cli(rules_yaml, rmds, dry_run, backup, jobs):
+    """Rewrite Rmd notebooks with every rule in RULES_YAML in one pass
+
+    Defaults to all *_facs.Rmd and *_droplet.Rmd notebooks in this folder.
+    """
+    rules = read_rules(rules_yaml)
+    if not rmds:
+        rmds = sorted(rmd for method in METHODS
+                      for rmd in glob.glob(f'*{method}.Rmd'))
+
+    totals = [0] * len(rules)
+    n_changed = 0
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                             initargs=(rules,)) as executor:
+        results = executor.map(process_rmd, rmds, [dry_run] * len(rmds),
+                               [backup] * len(rmds))
+        for rmd, diff, counts in results:
+            totals = [a + b for a, b in zip(totals, counts)]
+            if diff is None:
+                continue
+            n_changed += 1
+            if dry_run:
+                sys.stdout.write(diff)
+            else:
+                click.echo(f'Rewrote {rmd}', err=True)
+
+    for i, (rule, n) in enumerate(zip(rules, totals)):
+        kind = REGEX if rule.is_regex else LITERAL
+        first_line = rule.pattern.strip().splitlines()[0] \
+            if rule.pattern.strip() else repr(rule.pattern)
+        click.echo(f'Rule {i} ({kind}, {n} replacements): {first_line}',
+                   err=True)
+    verb = 'Would change' if dry_run else 'Changed'
+    click.echo(f'{verb} {n_changed} of {len(rmds)} files', err=True)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3.6
+
+# Compare the cell ontology classes found by FACS and droplet in every tissue
+# sequenced with both methods. This generalizes the kidney.csv and spleen.csv
+# tables made by 017_facs_vs_droplets_celltypes.Rmd to all tissues at once:
+# both methods' annotations are dictionary-encoded together and counted with
+# one bincount, so there is no loop over tissues.
+#
+# Droplet heart and aorta were sequenced together as "Heart_and_Aorta", so the
+# FACS "Heart" and "Aorta" cells are compared with them under that name.
+#
+# Usage:
+#   ./facs_vs_droplet_concordance.py \
+#       --facs-metadata ../00_facs_raw_data/metadata_FACS.csv
+
+import os
+
+import click
+import numpy as np
+import pandas as pd
+
+METHODS = ("facs", "droplet")
+ANNOTATIONS_DIR = os.path.join('..', '18_global_annotation_csv')
+KEEP_COLUMNS = ('cell', 'tissue', 'cell_ontology_class', 'plate.barcode')
+# FACS tissues renamed to the droplet tissue they were sequenced in
+FACS_TISSUES = {'Heart': 'Heart_and_Aorta', 'Aorta': 'Heart_and_Aorta'}
+
+
+def read_annotations(annotations_dir, facs_metadata=None):
+    """Concatenated annotations of both methods with a "method" column
+
+    If ``facs_metadata`` is given, only FACS cells from plates sorted for
+    "Viable" cells are kept, as in the Rmd.
+    """
+    dfs = []
+    for method in METHODS:
+        filename = os.path.join(annotations_dir, f'annotations_{method}.csv')
+        df = pd.read_csv(filename, usecols=lambda x: x in KEEP_COLUMNS,
+                         dtype=str)
+        if method == 'facs' and facs_metadata is not None:
+            metadata = pd.read_csv(facs_metadata, dtype=str)
+            viable = metadata.loc[metadata['FACS.selection'] == 'Viable',
+                                  'plate.barcode']
+            df = df.loc[df['plate.barcode'].isin(viable)]
+        if method == 'facs':
+            df = df.assign(tissue=df['tissue'].replace(FACS_TISSUES))
+        df = df.assign(method=method)
+        dfs.append(df[['tissue', 'cell_ontology_class', 'method']])
+    return pd.concat(dfs, ignore_index=True)
+
+
+def concordance(annotations):
+    """Per tissue and cell ontology class statistics of FACS vs droplet
+
+    Only tissues with cells from both methods are reported, and within them
+    every class seen by at least one method.
+    """
+    annotations = annotations.dropna(subset=['cell_ontology_class'])
+    tissue_codes, tissues = pd.factorize(annotations['tissue'], sort=True)
+    class_codes, classes = pd.factorize(annotations['cell_ontology_class'],
+                                        sort=True)
+    method_codes = annotations['method'].map(
+        {method: i for i, method in enumerate(METHODS)}).values
+
+    shape = len(tissues), len(classes), len(METHODS)
+    flat = np.ravel_multi_index((tissue_codes, class_codes, method_codes),
+                                shape)
+    counts = np.bincount(flat, minlength=int(np.prod(shape))).reshape(shape)
+
+    # Tissue x method totals, kept broadcastable against counts
+    totals = counts.sum(axis=1, keepdims=True)
+    in_both = (totals > 0).all(axis=2).ravel()
+    proportions = np.divide(counts, totals, out=np.zeros(shape),
+                            where=totals > 0)
+
+    facs, droplet = METHODS.index('facs'), METHODS.index('droplet')
+    n_facs, n_droplet = counts[..., facs], counts[..., droplet]
+    p_facs, p_droplet = proportions[..., facs], proportions[..., droplet]
+    total_facs, total_droplet = totals[..., facs], totals[..., droplet]
+
+    # Two-proportion z-test with the pooled proportion of each class
+    pooled = (n_facs + n_droplet) / np.maximum(total_facs + total_droplet, 1)
+    se = np.sqrt(pooled * (1 - pooled) *
+                 (1 / np.maximum(total_facs, 1) +
+                  1 / np.maximum(total_droplet, 1)))
+    difference = p_facs - p_droplet
+    z = np.divide(difference, se, out=np.zeros_like(difference),
+                  where=se > 0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Undefined, rather than infinite, for classes without droplet cells
+        count_ratio = np.where(n_droplet > 0, n_facs / n_droplet, np.nan)
+        # Add half a cell to both so classes seen by one method stay finite
+        log2_proportion_ratio = np.log2(((n_facs + 0.5) / (total_facs + 1)) /
+                                        ((n_droplet + 0.5) /
+                                         (total_droplet + 1)))
+
+    keep = in_both[:, None] & ((n_facs > 0) | (n_droplet > 0))
+    tissue_index, class_index = np.nonzero(keep)
+    table = pd.DataFrame({
+        'tissue': np.asarray(tissues)[tissue_index],
+        'cell_ontology_class': np.asarray(classes)[class_index],
+        'n.droplet': n_droplet[keep],
+        'percentage.droplet': 100 * p_droplet[keep],
+        'n.facs': n_facs[keep],
+        'percentage.facs': 100 * p_facs[keep],
+        'present.droplet': n_droplet[keep] > 0,
+        'present.facs': n_facs[keep] > 0,
+        'count_ratio': count_ratio[keep],
+        'percentage_difference': 100 * difference[keep],
+        'log2_proportion_ratio': log2_proportion_ratio[keep],
+        'z': z[keep],
+    })
+    table['present_in'] = np.select(
+        [table['present.droplet'] & table['present.facs'],
+         table['present.facs']], ['both', 'facs'], 'droplet')
+    return table
+
+
+@click.command()
+@click.option('--annotations-dir', default=ANNOTATIONS_DIR,
+              help='Folder with annotations_facs.csv and '
+                   'annotations_droplet.csv')
+@click.option('--facs-metadata', default=None,
+              help='metadata_FACS.csv, to keep only "Viable" FACS plates')
+@click.option('--output', default='facs_vs_droplet_concordance.csv')
+def cli(annotations_dir, facs_metadata, output):
+    """Write the FACS vs droplet concordance of all shared tissues"""
+    annotations = read_annotations(annotations_dir, facs_metadata)
+    table = concordance(annotations)
+    table.to_csv(output, index=False)
+    n_tissues = table['tissue'].nunique()
+    click.echo(f'Wrote {len(table)} tissue/cell ontology class pairs from '
+               f'{n_tissues} tissues to {output}')
+
+
+if __name__ == "__main__":
+    cli()
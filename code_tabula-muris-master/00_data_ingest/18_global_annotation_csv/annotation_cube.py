@@ -0,0 +1,190 @@
+#!/usr/bin/env python3.6
+
+# Build a dense count cube of cells over
+#   tissue x subtissue x method x cell_ontology_class x mouse.sex x mouse.id
+# from the concatenated annotations made by concat_all_annotations_by_method.py
+# so that count tables (e.g. for Demographics.Rmd, SexBreakdown.Rmd and the
+# tissue supplement) are slices of an array instead of group-bys over all
+# cells.
+#
+# Usage:
+#   ./annotation_cube.py build
+#   ./annotation_cube.py query --by tissue --by mouse.sex --where method=droplet
+
+import os
+
+import click
+import numpy as np
+import pandas as pd
+
+METHODS = ("facs", "droplet")
+DIMENSIONS = ('tissue', 'subtissue', 'method', 'cell_ontology_class',
+              'mouse.sex', 'mouse.id')
+CUBE_FILENAME = 'annotation_cube.npz'
+
+# Missing values (e.g. no subtissue) get their own label, as in
+# generate_tissue_tex.py
+NA = 'NA'
+
+
+class AnnotationCube:
+    """Cell counts over dictionary-encoded annotation dimensions
+
+    ``counts`` has one axis per entry of ``dimensions`` and ``labels[dim]``
+    holds the (sorted) label of each position along that axis.
+    """
+
+    def __init__(self, counts, labels, dimensions=DIMENSIONS):
+        self.counts = counts
+        self.labels = labels
+        self.dimensions = tuple(dimensions)
+        self._codes = {dim: {label: i for i, label in enumerate(labels[dim])}
+                       for dim in self.dimensions}
+
+    @classmethod
+    def from_annotations(cls, annotations, dimensions=DIMENSIONS):
+        """Count cells of an annotation dataframe in one bincount"""
+        codes = []
+        labels = {}
+        for dim in dimensions:
+            column = annotations[dim].fillna(NA).astype(str)
+            codes_dim, labels_dim = pd.factorize(column, sort=True)
+            codes.append(codes_dim)
+            labels[dim] = np.asarray(labels_dim, dtype=str)
+
+        shape = tuple(len(labels[dim]) for dim in dimensions)
+        flat = np.ravel_multi_index(codes, shape)
+        counts = np.bincount(flat, minlength=int(np.prod(shape)))
+        counts = counts.astype(np.uint32).reshape(shape)
+        return cls(counts, labels, dimensions)
+
+    @classmethod
+    def from_csvs(cls, folder='.', methods=METHODS):
+        """Read annotations_<method>.csv for each method"""
+        dfs = []
+        for method in methods:
+            filename = os.path.join(folder, f'annotations_{method}.csv')
+            df = pd.read_csv(filename, usecols=lambda x: x in DIMENSIONS,
+                             dtype=str)
+            df['method'] = method
+            dfs.append(df)
+        return cls.from_annotations(pd.concat(dfs, ignore_index=True))
+
+    def save(self, filename=CUBE_FILENAME):
+        arrays = {f'labels_{i}': self.labels[dim]
+                  for i, dim in enumerate(self.dimensions)}
+        np.savez_compressed(filename, counts=self.counts,
+                            dimensions=np.asarray(self.dimensions),
+                            **arrays)
+
+    @classmethod
+    def load(cls, filename=CUBE_FILENAME):
+        with np.load(filename, allow_pickle=False) as npz:
+            dimensions = [str(x) for x in npz['dimensions']]
+            labels = {dim: npz[f'labels_{i}']
+                      for i, dim in enumerate(dimensions)}
+            return cls(npz['counts'], labels, dimensions)
+
+    def _positions(self, dim, values):
+        if isinstance(values, str) or not np.iterable(values):
+            values = [values]
+        try:
+            return [self._codes[dim][str(value)] for value in values]
+        except KeyError as e:
+            raise KeyError(f'{e.args[0]} is not a value of "{dim}"')
+
+    def slice(self, **where):
+        """Restrict dimensions to one or more values, keeping all axes
+
+        Keyword names use underscores for dots, e.g. ``mouse_sex='F'``.
+        """
+        counts = self.counts
+        labels = dict(self.labels)
+        for key, values in where.items():
+            dim = key.replace('_', '.') if key not in self._codes else key
+            if dim not in self._codes:
+                raise KeyError(f'"{key}" is not a cube dimension')
+            positions = self._positions(dim, values)
+            axis = self.dimensions.index(dim)
+            if len(positions) == 1:
+                # A single value can be a view instead of a copy
+                index = [slice(None)] * counts.ndim
+                index[axis] = slice(positions[0], positions[0] + 1)
+                counts = counts[tuple(index)]
+            else:
+                counts = np.take(counts, positions, axis=axis)
+            labels[dim] = self.labels[dim][positions]
+        return AnnotationCube(counts, labels, self.dimensions)
+
+    def rollup(self, by=()):
+        """Sum over all dimensions not in ``by``, as an array"""
+        by = [by] if isinstance(by, str) else list(by)
+        axes = tuple(i for i, dim in enumerate(self.dimensions)
+                     if dim not in by)
+        summed = self.counts.sum(axis=axes, dtype=np.int64)
+        # Axes keep cube order after summing, reorder to the order of ``by``
+        kept = [dim for dim in self.dimensions if dim in by]
+        return np.transpose(summed, [kept.index(dim) for dim in by])
+
+    def table(self, by=(), drop_zeros=True, **where):
+        """Counts per combination of ``by``, as a named Series"""
+        by = [by] if isinstance(by, str) else list(by)
+        cube = self.slice(**where) if where else self
+        summed = cube.rollup(by)
+        if not by:
+            return int(summed)
+        index = pd.MultiIndex.from_product([cube.labels[dim] for dim in by],
+                                           names=by)
+        counts = pd.Series(summed.ravel(), index=index, name='n_cells')
+        if len(by) == 1:
+            counts.index = counts.index.get_level_values(0)
+        if drop_zeros:
+            counts = counts[counts > 0]
+        return counts
+
+
+def parse_where(where):
+    parsed = {}
+    for condition in where:
+        key, value = condition.split('=', 1)
+        parsed.setdefault(key, []).append(value)
+    return parsed
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--folder', default='.',
+              help='Folder containing annotations_<method>.csv')
+@click.option('--output', default=CUBE_FILENAME)
+def build(folder, output):
+    """Build the count cube from both methods' concatenated annotations"""
+    cube = AnnotationCube.from_csvs(folder)
+    cube.save(output)
+    shape = ' x '.join(f'{dim} ({n})' for dim, n
+                       in zip(cube.dimensions, cube.counts.shape))
+    click.echo(f'Wrote {output}: {shape}, {cube.counts.sum()} cells')
+
+
+@cli.command()
+@click.option('--cube', 'cube_filename', default=CUBE_FILENAME)
+@click.option('--by', multiple=True, type=click.Choice(DIMENSIONS),
+              help='Dimension to keep, may be given more than once')
+@click.option('--where', multiple=True,
+              help='Restrict a dimension, e.g. "mouse.sex=F"')
+@click.option('--output', default=None, help='Write the table to this csv')
+def query(cube_filename, by, where, output):
+    """Print cell counts per combination of the --by dimensions"""
+    cube = AnnotationCube.load(cube_filename)
+    counts = cube.slice(**parse_where(where)).table(by)
+    if output is not None:
+        counts.to_frame().to_csv(output)
+    else:
+        click.echo(counts.to_string() if by else counts)
+
+
+if __name__ == "__main__":
+    cli()
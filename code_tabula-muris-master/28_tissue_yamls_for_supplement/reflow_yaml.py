@@ -1,8 +1,23 @@
 #!/usr/bin/env python
 
+from concurrent.futures import ProcessPoolExecutor
+import os
+import sys
+
 import click
 import yaml
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'utilities'))
+from atomic import write_atomic
+
+# The C loader/dumper are an order of magnitude faster, but only exist when
+# PyYAML was built against libyaml
+try:
+    from yaml import CSafeLoader as Loader, CSafeDumper as Dumper
+except ImportError:
+    from yaml import SafeLoader as Loader, SafeDumper as Dumper
+
 
 def listify(genes):
     if isinstance(genes, list):
@@ -10,27 +25,63 @@ def listify(genes):
     else:
         return genes.replace("'", '').replace(' ', '').split(',')
 
+
+def reflow(data):
+    """Sort and deduplicate the gene lists of the tissue and its subsets"""
+    data['GENES'] = sorted(list(set(listify(data["GENES"]))))
+    if 'SUBSET' in data:
+        for name, subset in data['SUBSET'].items():
+            subset['GENES'] = sorted(list(set(listify(subset['GENES']))))
+    return data
+
+
+def dump(data):
+    return yaml.dump(data, Dumper=Dumper,
+                     # Add the --- at the beginning of the file
+                     explicit_start=True,
+                     # Turn flow style to false to get
+                     # "bullet point" arrays
+                     default_flow_style=False)
+
+
+def reflow_file(filename, in_place=False):
+    """Reflow one yaml, only writing if the normalized content differs
+
+    Returns True if the file changed
+    """
+    with open(filename) as f:
+        content = f.read()
+    data = yaml.load(content, Loader=Loader)
+
+    reflowed_data = dump(reflow(data))
+    if reflowed_data == content:
+        return False
+
+    outfile = filename if in_place else filename + '.reflowed'
+    write_atomic(outfile, reflowed_data)
+    return True
+
+
 @click.command()
 @click.argument('yamls', nargs=-1)
-def cli(yamls):
-    for filename in yamls:
-
-        with open(filename) as f:
-            data = yaml.load(f)
-
-        data['GENES'] = sorted(list(set(listify(data["GENES"]))))
-        if 'SUBSET' in data:
-            for name, subset in data['SUBSET'].items():
-                subset['GENES'] = sorted(list(set(listify(subset['GENES']))))
-
-        reflowed_data = yaml.dump(data,
-                                  # Add the --- at the beginning of the file
-                                  explicit_start=True,
-                                  # Turn flow style to false to get
-                                  # "bullet point" arrays
-                                  default_flow_style=False)
-        with open(filename + '.reflowed', 'w') as g:
-            g.write(reflowed_data)
+@click.option('--in-place', is_flag=True,
+              help='Overwrite the yamls instead of writing *.reflowed files')
+@click.option('--jobs', '-j', default=os.cpu_count(),
+              help='Number of worker processes')
+def cli(yamls, in_place, jobs):
+    """Sort and deduplicate the GENES lists of tissue yamls
+
+    Files that are already normalized are left untouched.
+    """
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        changed = list(executor.map(reflow_file, yamls,
+                                    [in_place] * len(yamls)))
+
+    for filename, is_changed in zip(yamls, changed):
+        if is_changed:
+            click.echo(f'Reflowed {filename}')
+    n_changed = sum(changed)
+    click.echo(f'{n_changed} changed, {len(yamls) - n_changed} unchanged')
 
 
 if __name__ == "__main__":
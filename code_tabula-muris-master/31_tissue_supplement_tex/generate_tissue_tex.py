@@ -441,7 +441,7 @@ def cli(figure_folder, tissue, method):
                                      basename_yaml)
         try:
             with open(filename_yaml) as f:
-                yaml_data = yaml.load(f)
+                yaml_data = yaml.load(f, Loader=yaml.SafeLoader)
         except FileNotFoundError:
             # Microbiome doesn't have a yaml
             yaml_data = None
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3.6
+# coding: utf-8
+
+# Cluster compactness and mixing of the global FACS clusters, as in
+# ClusterHeterogeneity.Rmd, computed for every cluster at once.
+#
+# The average distance between pairs of cells is exact for small clusters:
+# all pairwise distances come from one Gram matrix, and the averages within
+# and between the cell ontology classes of a cluster are then two matrix
+# products with the class indicator matrix. Larger clusters fall back to
+# sampling, like avg_pairwise_distance in the Rmd, but every sample of every
+# pair of classes is drawn and measured as one array. Clusters are processed
+# in a process pool with a fixed seed per cluster, so results do not depend on
+# the number of workers.
+#
+# Usage:
+#   Rscript extract_pca_embeddings.R
+#   ./cluster_heterogeneity.py
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+import click
+import numpy as np
+import pandas as pd
+
+GLOBAL_ANNOTATION_DIR = os.path.join('..', '00_data_ingest',
+                                     '18_global_annotation_csv')
+N_PCS = 100
+N_SAMPLES = 1000
+MIN_ID_SIZE = 5
+SEED = 2018
+# Clusters with at most this many cells get exact average distances
+EXACT_MAX_CELLS = 3000
+# Number of sampled pairs to measure at a time
+BLOCK_SIZE = 100000
+
+
+def pairwise_distances(a, b):
+    """Euclidean distances between all rows of a and b, via the Gram matrix"""
+    squared = ((a ** 2).sum(axis=1)[:, None] + (b ** 2).sum(axis=1)[None, :]
+               - 2 * a @ b.T)
+    np.maximum(squared, 0, out=squared)
+    return np.sqrt(squared)
+
+
+def exact_class_distances(mat, codes, n_classes):
+    """Average distance within and between classes from all pairs of cells
+
+    Within a class, a cell's distance to itself is not counted.
+    """
+    distances = pairwise_distances(mat, mat)
+    np.fill_diagonal(distances, 0)
+    indicator = np.zeros((len(codes), n_classes))
+    indicator[np.arange(len(codes)), codes] = 1
+    sums = indicator.T @ distances @ indicator
+    sizes = indicator.sum(axis=0)
+    pairs = np.outer(sizes, sizes) - np.diag(sizes)
+    return np.divide(sums, pairs, out=np.full(sums.shape, np.nan),
+                     where=pairs > 0)
+
+
+def sampled_class_distances(mat, codes, n_classes, rng,
+                            n_samples=N_SAMPLES):
+    """Average distance within and between classes from sampled pairs
+
+    Within a class, the two cells of a pair are always different.
+    """
+    order = np.argsort(codes, kind='stable')
+    mat = mat[order]
+    sizes = np.bincount(codes, minlength=n_classes)
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+
+    first, second = np.triu_indices(n_classes)
+    size_1 = sizes[first][:, None]
+    size_2 = sizes[second][:, None]
+    local_1 = (rng.random((len(first), n_samples)) * size_1).astype(int)
+    same = (first == second)[:, None]
+    # For pairs within a class, draw the second cell from the other n - 1
+    offset = (rng.random((len(first), n_samples)) *
+              np.maximum(size_2 - 1, 1)).astype(int)
+    local_2 = np.where(same, (local_1 + 1 + offset) % size_2,
+                       (rng.random((len(first), n_samples)) *
+                        size_2).astype(int))
+    index_1 = (starts[first][:, None] + local_1).ravel()
+    index_2 = (starts[second][:, None] + local_2).ravel()
+
+    distances = np.empty(len(index_1))
+    for start in range(0, len(index_1), BLOCK_SIZE):
+        block = slice(start, start + BLOCK_SIZE)
+        diff = mat[index_1[block]] - mat[index_2[block]]
+        distances[block] = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+    means = distances.reshape(len(first), n_samples).mean(axis=1)
+
+    result = np.full((n_classes, n_classes), np.nan)
+    result[first, second] = means
+    result[second, first] = means
+    # A single cell has no within-class pairs
+    singletons = np.flatnonzero(sizes < 2)
+    result[singletons, singletons] = np.nan
+    return result
+
+
+def class_distances(mat, codes, n_classes, rng, n_samples=N_SAMPLES,
+                    exact_max_cells=EXACT_MAX_CELLS):
+    if len(codes) <= exact_max_cells:
+        return exact_class_distances(mat, codes, n_classes)
+    return sampled_class_distances(mat, codes, n_classes, rng, n_samples)
+
+
+def average_pairwise_distance(mat, rng, n_samples=N_SAMPLES,
+                              exact_max_cells=EXACT_MAX_CELLS):
+    """Average distance between pairs of different rows"""
+    codes = np.zeros(len(mat), dtype=int)
+    return class_distances(mat, codes, 1, rng, n_samples,
+                           exact_max_cells)[0, 0]
+
+
+def cluster_heterogeneity(cluster, mat, classes, seed, n_samples=N_SAMPLES,
+                          min_id_size=MIN_ID_SIZE,
+                          exact_max_cells=EXACT_MAX_CELLS):
+    """Compactness of one cluster and distances between its classes
+
+    Returns a one-row summary and the long-form class x class distances
+    """
+    rng = np.random.default_rng([seed, cluster])
+    compactness = average_pairwise_distance(mat, rng, n_samples,
+                                            exact_max_cells)
+
+    # Keep only those classes occuring at least min_id_size times
+    codes, labels = pd.factorize(classes, sort=True)
+    sizes = np.bincount(codes, minlength=len(labels))
+    keep_class = sizes >= min_id_size
+    keep_cell = keep_class[codes]
+    new_codes = np.cumsum(keep_class) - 1
+    labels = labels[keep_class]
+    sizes = sizes[keep_class]
+
+    distances = class_distances(mat[keep_cell], new_codes[codes[keep_cell]],
+                                len(labels), rng, n_samples, exact_max_cells)
+    # Geometric normalization by the within-class distances, as geo_normalize
+    within = np.sqrt(np.diag(distances))
+    normalized = distances / np.outer(within, within)
+
+    first, second = np.triu_indices(len(labels))
+    pairs = pd.DataFrame({
+        'cluster': cluster,
+        'class_1': labels[first], 'n_1': sizes[first],
+        'class_2': labels[second], 'n_2': sizes[second],
+        'distance': distances[first, second],
+        'normalized_distance': normalized[first, second]})
+
+    summary = {
+        'cluster': cluster, 'n_cells': len(mat), 'n_types': len(labels),
+        'compactness': compactness,
+        'max_dist': np.nanmax(distances) if len(labels) else np.nan,
+        'avg_dist': np.nanmean(distances) if len(labels) else np.nan,
+        'worst_dist': np.nanmax(normalized) if len(labels) else np.nan,
+        'exact': len(mat) <= exact_max_cells}
+    return summary, pairs
+
+
+def read_global_facs(pca_csv, annotation_dir, n_pcs):
+    """Global PCA embedding with the cluster, tissue and class of each cell"""
+    pca = pd.read_csv(pca_csv, index_col='cell')
+    pca = pca.iloc[:, :n_pcs]
+    tsne = pd.read_csv(os.path.join(annotation_dir, 'tsne_facs.csv'),
+                       index_col='cell', usecols=['cell', 'cluster'])
+    annotations = pd.read_csv(
+        os.path.join(annotation_dir, 'annotations_facs.csv'),
+        index_col='cell', usecols=['cell', 'tissue', 'cell_ontology_class'])
+    metadata = tsne.join(annotations, how='inner')
+    metadata = metadata.loc[metadata.index.isin(pca.index)]
+    return pca.loc[metadata.index].values.astype(np.float64), metadata
+
+
+@click.command()
+@click.option('--pca', 'pca_csv', default='pca_facs.csv',
+              help='Cells x PCs csv from extract_pca_embeddings.R')
+@click.option('--annotation-dir', default=GLOBAL_ANNOTATION_DIR,
+              help='Folder with tsne_facs.csv and annotations_facs.csv')
+@click.option('--n-pcs', default=N_PCS)
+@click.option('--n-samples', default=N_SAMPLES,
+              help='Sampled pairs per class pair in large clusters')
+@click.option('--min-id-size', default=MIN_ID_SIZE,
+              help='Smallest class within a cluster to compare')
+@click.option('--exact-max-cells', default=EXACT_MAX_CELLS,
+              help='Largest cluster to compute exact distances for')
+@click.option('--keep-na', is_flag=True,
+              help='Keep cells without a cell ontology class')
+@click.option('--seed', default=SEED)
+@click.option('--jobs', '-j', default=os.cpu_count())
+def cli(pca_csv, annotation_dir, n_pcs, n_samples, min_id_size,
+        exact_max_cells, keep_na, seed, jobs):
+    """Write heterogeneity tables for every global FACS cluster"""
+    mat, metadata = read_global_facs(pca_csv, annotation_dir, n_pcs)
+    if not keep_na:
+        has_class = metadata['cell_ontology_class'].notnull().values
+        mat, metadata = mat[has_class], metadata.loc[has_class]
+    # e.g. "B cell (Spleen)"
+    classes = (metadata['cell_ontology_class'].fillna('NA') + ' (' +
+               metadata['tissue'] + ')').values
+
+    rng = np.random.default_rng(seed)
+    global_avg = average_pairwise_distance(mat, rng, n_samples=10000,
+                                           exact_max_cells=0)
+    click.echo(f'Global average distance: {global_avg:.3f}')
+
+    clusters = np.sort(metadata['cluster'].unique())
+    cluster_values = metadata['cluster'].values
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = []
+        for cluster in clusters:
+            in_cluster = cluster_values == cluster
+            futures.append(executor.submit(
+                cluster_heterogeneity, int(cluster), mat[in_cluster],
+                classes[in_cluster], seed, n_samples, min_id_size,
+                exact_max_cells))
+        results = [future.result() for future in futures]
+
+    summary = pd.DataFrame([x[0] for x in results])
+    summary['max_dist'] /= global_avg
+    summary['rank'] = summary['max_dist'].rank()
+    tissue_counts = metadata.groupby(['cluster', 'tissue']).size()
+    n_tissues = (tissue_counts >= min_id_size).groupby(level=0).sum()
+    summary['tissues'] = summary['cluster'].map(n_tissues)
+    summary['global_avg'] = global_avg
+    summary.to_csv('cluster_heterogeneity.csv', index=False)
+
+    pairs = pd.concat([x[1] for x in results], ignore_index=True)
+    pairs.to_csv('cluster_class_distances.csv', index=False)
+    click.echo(f'Wrote cluster_heterogeneity.csv ({len(summary)} clusters) '
+               f'and cluster_class_distances.csv ({len(pairs)} class pairs)')
+
+
+if __name__ == "__main__":
+    cli()
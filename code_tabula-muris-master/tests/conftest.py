@@ -0,0 +1,116 @@
+# Make the scripts importable as modules: the shared ones in utilities and
+# the stand-alone ones in their analysis folders. The tissue_tree fixture
+# writes a small synthetic data tree with the layout raw_counts reads.
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import io, sparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT_FOLDERS = ('utilities',
+                  os.path.join('00_data_ingest', '02_tissue_analysis_rmd'),
+                  os.path.join('00_data_ingest',
+                               '17_facs_vs_droplets_celltypes'),
+                  os.path.join('00_data_ingest', '18_global_annotation_csv'),
+                  '28_tissue_yamls_for_supplement',
+                  '32_cluster_heterogeneity')
+
+for folder in SCRIPT_FOLDERS:
+    sys.path.insert(0, os.path.join(ROOT, folder))
+
+TISSUES = ('Liver', 'Spleen')
+CLASSES = ('B cell', 'T cell', 'hepatocyte', 'endothelial cell')
+N_GENES = 200
+# Each class expresses its own block of genes
+MARKERS_PER_CLASS = 20
+CHANNELS = ('10X_P4_2', '10X_P7_0')
+
+
+def synthetic_counts(rng, n_cells, codes):
+    """Genes x cells counts with a block of markers per class"""
+    counts = rng.poisson(0.3, (N_GENES, n_cells))
+    markers = codes[None, :] * MARKERS_PER_CLASS + \
+        np.arange(MARKERS_PER_CLASS)[:, None]
+    counts[markers, np.arange(n_cells)] += 10
+    return counts
+
+
+def synthetic_annotation(rng, cells, tissue, codes):
+    n = len(cells)
+    return pd.DataFrame({
+        'cell': cells, 'tissue': tissue, 'subtissue': np.nan,
+        'cell_ontology_class': np.asarray(CLASSES)[codes],
+        'cell_ontology_id': 'CL:0000000', 'free_annotation': np.nan,
+        'cluster.ids': codes, 'mouse.sex': rng.choice(['F', 'M'], n),
+        'mouse.id': rng.choice(['3_8_M', '3_9_F'], n),
+        'tSNE_1': rng.normal(size=n) + 5 * codes,
+        'tSNE_2': rng.normal(size=n)})
+
+
+def write_facs(root, rng, tissue, genes):
+    # Each tissue has its own plates, so cell names are unique across tissues
+    first = 1 + 2 * TISSUES.index(tissue)
+    cells = [f'{row}{column}.MAA00{plate}.3_{plate + 7}_M.1.1'
+             for plate in (first, first + 1) for row in 'AB'
+             for column in range(1, 21)]
+    codes = rng.integers(0, len(CLASSES), len(cells))
+    counts = synthetic_counts(rng, len(cells), codes)
+    folder = os.path.join(root, 'facs', 'FACS')
+    os.makedirs(folder, exist_ok=True)
+    pd.DataFrame(counts, index=genes, columns=cells).to_csv(
+        os.path.join(folder, f'{tissue}-counts.csv'))
+    # Leave some cells out, as quality control does
+    return synthetic_annotation(rng, cells, tissue, codes).iloc[3:]
+
+
+def write_droplet(root, rng, tissue, genes):
+    annotations = []
+    for channel in CHANNELS:
+        barcodes = [''.join(x) for x in rng.choice(list('ACGT'), (80, 14))]
+        codes = rng.integers(0, len(CLASSES), len(barcodes))
+        counts = synthetic_counts(rng, len(barcodes), codes)
+        folder = os.path.join(root, 'droplet', 'droplet',
+                              f'{tissue}-{channel}')
+        os.makedirs(folder)
+        io.mmwrite(os.path.join(folder, 'matrix.mtx'),
+                   sparse.coo_matrix(counts))
+        pd.DataFrame({'id': genes, 'symbol': genes}).to_csv(
+            os.path.join(folder, 'genes.tsv'), sep='\t', header=False,
+            index=False)
+        pd.Series([x + '-1' for x in barcodes]).to_csv(
+            os.path.join(folder, 'barcodes.tsv'), header=False, index=False)
+        cells = [f'{channel}_{x}' for x in barcodes]
+        annotation = synthetic_annotation(rng, cells, tissue, codes)
+        annotation['channel'] = channel
+        annotations.append(annotation.iloc[2:])
+    return pd.concat(annotations, ignore_index=True)
+
+
+@pytest.fixture
+def tissue_tree(tmp_path, monkeypatch):
+    """Liver and Spleen counts and annotations of both methods
+
+    Points raw_counts at them and returns the root folder.
+    """
+    import raw_counts
+
+    rng = np.random.default_rng(0)
+    genes = [f'Gene{i}' for i in range(N_GENES - 2)] + \
+        ['ERCC-00002', 'ERCC-00003']
+    annotation_dir = tmp_path / 'annotation'
+    annotation_dir.mkdir()
+    for tissue in TISSUES:
+        for method, write in (('facs', write_facs),
+                              ('droplet', write_droplet)):
+            annotation = write(str(tmp_path), rng, tissue, genes)
+            annotation.to_csv(
+                annotation_dir / f'{tissue}_{method}_annotation.csv',
+                index=False)
+    monkeypatch.setattr(raw_counts, 'FACS_DIR', str(tmp_path / 'facs'))
+    monkeypatch.setattr(raw_counts, 'DROPLET_DIR', str(tmp_path / 'droplet'))
+    monkeypatch.setattr(raw_counts, 'ANNOTATION_DIR', str(annotation_dir))
+    return tmp_path
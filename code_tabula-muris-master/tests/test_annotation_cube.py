@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from annotation_cube import AnnotationCube
+
+
+@pytest.fixture
+def annotations():
+    rng = np.random.default_rng(0)
+    n = 500
+    return pd.DataFrame({
+        'tissue': rng.choice(['Liver', 'Lung', 'Marrow'], n),
+        'subtissue': rng.choice(['A', np.nan], n),
+        'method': rng.choice(['facs', 'droplet'], n),
+        'cell_ontology_class': rng.choice(['B cell', 'T cell', np.nan], n),
+        'mouse.sex': rng.choice(['F', 'M'], n),
+        'mouse.id': rng.choice(['3_8_M', '3_9_F', '3_10_M'], n),
+    })
+
+
+def test_table_matches_groupby(annotations):
+    cube = AnnotationCube.from_annotations(annotations)
+    assert cube.table() == len(annotations)
+
+    expected = annotations.loc[annotations['method'] == 'droplet'].groupby(
+        ['tissue', 'mouse.sex']).size()
+    table = cube.table(['tissue', 'mouse.sex'], method='droplet')
+    assert table.to_dict() == expected.to_dict()
+
+    # Missing values are counted under "NA", and dots can be underscores
+    expected = annotations.loc[annotations['mouse.sex'] == 'F'].fillna(
+        'NA').groupby('subtissue').size()
+    assert cube.table('subtissue', mouse_sex='F').to_dict() == \
+        expected.to_dict()
+
+
+def test_by_order_and_several_values(annotations):
+    cube = AnnotationCube.from_annotations(annotations)
+    rolled = cube.slice(tissue=['Lung', 'Liver']).rollup(
+        ['mouse.sex', 'tissue'])
+    assert rolled.shape == (2, 2)
+    # Tissues are in the order they were given
+    in_liver = annotations['tissue'] == 'Liver'
+    assert rolled[1, 1] == (in_liver &
+                            (annotations['mouse.sex'] == 'M')).sum()
+
+    with pytest.raises(KeyError):
+        cube.slice(tissue='Brain')
+
+
+def test_save_load(annotations, tmp_path):
+    cube = AnnotationCube.from_annotations(annotations)
+    filename = str(tmp_path / 'cube.npz')
+    cube.save(filename)
+    loaded = AnnotationCube.load(filename)
+    assert loaded.dimensions == cube.dimensions
+    assert np.array_equal(loaded.counts, cube.counts)
+    assert loaded.table('cell_ontology_class').equals(
+        cube.table('cell_ontology_class'))
@@ -0,0 +1,96 @@
+import click
+import pytest
+
+import batch_rewrite_rmd
+from batch_rewrite_rmd import Rule, compile_matcher, read_rules, rewrite
+
+
+def apply(content, rules):
+    return rewrite(content, rules, compile_matcher(rules))
+
+
+def test_literal_and_regex_rules_in_one_pass():
+    rules = [Rule('library(Seurat)', 'library(Seurat)\nlibrary(dplyr)'),
+             Rule(r'n\.pcs = (\d+)', r'n.pcs = 2*\1', is_regex=True)]
+    content = 'library(Seurat)\nn.pcs = 10\nn.pcs = 15\n'
+    replaced, counts = apply(content, rules)
+    assert replaced == ('library(Seurat)\nlibrary(dplyr)\n'
+                        'n.pcs = 2*10\nn.pcs = 2*15\n')
+    assert counts == [1, 2]
+
+
+def test_groups_are_local_to_each_rule():
+    rules = [Rule(r'(a)(b)', r'\2\1', is_regex=True),
+             Rule(r'x(y)', r'[\1]', is_regex=True)]
+    assert apply('ab xy', rules) == ('ba [y]', [1, 1])
+
+
+def test_replacements_are_not_rewritten_again():
+    rules = [Rule('a', 'b'), Rule('b', 'a')]
+    assert apply('ab', rules) == ('ba', [1, 1])
+
+
+def test_files_glob():
+    rule = Rule('x', 'y', files='*_facs.Rmd')
+    assert rule.applies_to('Liver_facs.Rmd')
+    assert not rule.applies_to('Liver_droplet.Rmd')
+
+
+def test_read_rules(tmp_path):
+    rules_yaml = tmp_path / 'rules.yaml'
+    rules_yaml.write_text("- literal: 'a.b'\n  replace: c\n"
+                          "- regex: 'a.b'\n  replace: d\n  files: '*.Rmd'\n")
+    literal, regex = read_rules(str(rules_yaml))
+    assert apply('a.b axb', [literal]) == ('c axb', [1])
+    assert apply('a.b axb', [regex]) == ('d d', [2])
+
+    rules_yaml.write_text("- literal: a\n  regex: b\n  replace: c\n")
+    with pytest.raises(click.BadParameter):
+        read_rules(str(rules_yaml))
+
+
+@pytest.mark.parametrize('second', [
+    # Group names are shared by all the rules
+    "- regex: '(?P<n>b)'\n  replace: c\n",
+    # Global flags would apply to all the rules
+    "- regex: '(?i)b'\n  replace: c\n",
+])
+def test_read_rules_rejects_rules_that_cannot_be_combined(tmp_path, second):
+    rules_yaml = tmp_path / 'rules.yaml'
+    rules_yaml.write_text("- regex: '(?P<n>a)'\n  replace: c\n" + second)
+    with pytest.raises(click.BadParameter, match='Rule 1'):
+        read_rules(str(rules_yaml))
+
+
+def test_scoped_flags(tmp_path):
+    rules_yaml = tmp_path / 'rules.yaml'
+    rules_yaml.write_text("- regex: '(?i:tiss)'\n  replace: x\n"
+                          "- literal: '(?i)'\n  replace: y\n")
+    assert apply('TISS tiss (?i)', read_rules(str(rules_yaml))) == \
+        ('x x y', [2, 1])
+
+
+def test_compile_matcher_names_the_rule():
+    rules = [Rule('(?P<n>a)', 'c', is_regex=True), Rule('b', 'c'),
+             Rule('(?P<n>d)', 'c', is_regex=True)]
+    with pytest.raises(click.BadParameter, match='Rule 2'):
+        compile_matcher(rules)
+
+
+def test_process_rmd(tmp_path):
+    rmd = tmp_path / 'Liver_facs.Rmd'
+    rmd.write_text('tiss <- FindClusters(tiss, resolution = 0.5)\n')
+    batch_rewrite_rmd.init_worker(
+        [Rule('resolution = 0.5', 'resolution = 1'),
+         Rule('tiss', 'x', files='*_droplet.Rmd')])
+
+    _, diff, counts = batch_rewrite_rmd.process_rmd(str(rmd), dry_run=True)
+    assert '+tiss <- FindClusters(tiss, resolution = 1)' in diff
+    assert counts == [1, 0]
+    assert 'resolution = 0.5' in rmd.read_text()
+
+    batch_rewrite_rmd.process_rmd(str(rmd), backup=True)
+    assert rmd.read_text() == 'tiss <- FindClusters(tiss, resolution = 1)\n'
+    assert (tmp_path / 'Liver_facs.Rmd.backup').exists()
+    assert sorted(x.name for x in tmp_path.iterdir()) == \
+        ['Liver_facs.Rmd', 'Liver_facs.Rmd.backup']
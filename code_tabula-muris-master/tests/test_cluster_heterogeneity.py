@@ -0,0 +1,72 @@
+import itertools
+
+import numpy as np
+import pytest
+
+import cluster_heterogeneity as ch
+
+
+@pytest.fixture
+def cells():
+    rng = np.random.default_rng(0)
+    codes = rng.integers(0, 3, 60)
+    mat = rng.normal(size=(60, 5)) + codes[:, None] * 2.0
+    return mat, codes
+
+
+def brute_force(mat, codes, n_classes):
+    result = np.full((n_classes, n_classes), np.nan)
+    for a, b in itertools.product(range(n_classes), repeat=2):
+        distances = [np.linalg.norm(mat[i] - mat[j])
+                     for i in np.flatnonzero(codes == a)
+                     for j in np.flatnonzero(codes == b) if i != j]
+        if distances:
+            result[a, b] = np.mean(distances)
+    return result
+
+
+def test_exact_matches_all_pairs(cells):
+    mat, codes = cells
+    assert np.allclose(ch.exact_class_distances(mat, codes, 3),
+                       brute_force(mat, codes, 3))
+
+
+def test_sampled_is_close_to_exact(cells):
+    mat, codes = cells
+    rng = np.random.default_rng(1)
+    sampled = ch.sampled_class_distances(mat, codes, 3, rng,
+                                         n_samples=20000)
+    assert np.allclose(sampled, ch.exact_class_distances(mat, codes, 3),
+                       rtol=0.03)
+
+
+def test_single_cell_has_no_within_distance(cells):
+    mat, codes = cells
+    codes = codes.copy()
+    codes[0] = 3
+    rng = np.random.default_rng(1)
+    for distances in (ch.exact_class_distances(mat, codes, 4),
+                      ch.sampled_class_distances(mat, codes, 4, rng)):
+        assert np.isnan(distances[3, 3])
+        assert np.isfinite(distances[3, :3]).all()
+
+
+def test_cluster_heterogeneity(cells):
+    mat, codes = cells
+    classes = np.array(['B cell', 'T cell', 'NK cell'])[codes]
+    # A class below min_id_size is left out of the class pairs
+    classes[:2] = 'rare'
+    summary, pairs = ch.cluster_heterogeneity(7, mat, classes, seed=0)
+    assert summary['n_cells'] == 60
+    assert summary['n_types'] == 3
+    assert 'rare' not in set(pairs['class_1']) | set(pairs['class_2'])
+    assert len(pairs) == 6
+    within = pairs.loc[pairs['class_1'] == pairs['class_2']]
+    assert np.allclose(within['normalized_distance'], 1)
+    assert np.isclose(summary['compactness'],
+                      brute_force(mat, np.zeros(60, dtype=int), 1)[0, 0])
+    # The same seed gives the same samples whatever the worker
+    assert ch.cluster_heterogeneity(7, mat, classes, seed=0,
+                                    exact_max_cells=0)[1].equals(
+        ch.cluster_heterogeneity(7, mat, classes, seed=0,
+                                 exact_max_cells=0)[1])
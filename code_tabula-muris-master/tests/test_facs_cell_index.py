@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import facs_cell_index
+import raw_counts
+from facs_cell_index import FacsCellIndex, parse_cell_names
+
+NAMES = ['A12.D041914.3_8_M.1.1', 'P1.MAA000123.3_10_F.1.1',
+         'B3.D041914.3_8_M.1', 'A12.B002775.3_39_F.1.1']
+
+
+def test_parse_cell_names():
+    codes, levels = parse_cell_names(NAMES)
+    fields = {field: list(levels[field][codes[field]]) for field in codes}
+    assert fields == {
+        'well': ['A12', 'P1', 'B3', 'A12'],
+        'plate': ['D041914', 'MAA000123', 'D041914', 'B002775'],
+        'mouse': ['3_8_M', '3_10_F', '3_8_M', '3_39_F'],
+        'sex': ['M', 'F', 'M', 'F'],
+        'replicate': ['1.1', '1.1', '1', '1.1']}
+    assert codes['plate'].dtype == np.int8
+
+    with pytest.raises(ValueError):
+        parse_cell_names(NAMES + ['10X_P4_3_AAACCTGAGATGCCAG'])
+
+
+def test_select_and_fields():
+    index = FacsCellIndex(NAMES)
+    assert list(index.select(plate='D041914')) == [0, 2]
+    assert list(index.select(sex='F', well=['A12', 'B3'])) == [3]
+    assert list(index.ids(['B3.D041914.3_8_M.1', 'nope'])) == [2, -1]
+    with pytest.raises(KeyError):
+        index.select(plate='nope')
+    assert index.fields([1])['mouse'].tolist() == ['3_10_F']
+
+    with pytest.raises(ValueError):
+        FacsCellIndex(NAMES + NAMES[:1])
+
+
+def test_by_id_and_by_name():
+    index = FacsCellIndex(NAMES)
+    table = pd.DataFrame({'x': [3, 1, 9]},
+                         index=[NAMES[3], NAMES[1], 'not.a.cell'])
+    by_id = index.by_id(table)
+    assert list(by_id.index) == [1, 3]
+    assert list(by_id['x']) == [1, 3]
+    assert index.by_name(by_id).equals(table.iloc[[1, 0]])
+
+
+def test_read_facs_tables(tissue_tree, monkeypatch):
+    liver = raw_counts.read_annotation('Liver', 'facs').index
+    spleen = raw_counts.read_annotation('Spleen', 'facs').index
+    cells = sorted(liver.append(spleen))
+    index = FacsCellIndex(cells[::-1])
+    nreads_dir = tissue_tree / 'nreads'
+    nreads_dir.mkdir()
+    pd.DataFrame({'nReads': 1000, 'nGene': 100, 'orig.ident': 'x'},
+                 index=pd.Index(liver[:5], name='cell')).to_csv(
+        nreads_dir / 'Liver_nreads_ngenes.csv')
+    monkeypatch.setattr(facs_cell_index, 'NREADS_DIR', str(nreads_dir))
+    monkeypatch.setattr(facs_cell_index, 'GLOBAL_TSNE',
+                        str(tissue_tree / 'missing.csv'))
+
+    table = facs_cell_index.read_facs_tables(index)
+    assert list(table.index) == list(range(len(cells)))
+    assert list(index.names[table.index]) == cells[::-1]
+    assert table['nReads'].notnull().sum() == 5
+    assert 'orig.ident' not in table.columns
+
+    ids = index.select(plate='MAA001')
+    table = facs_cell_index.read_facs_tables(index, tissues=['Liver'],
+                                             ids=ids)
+    assert set(index.fields(table.index)['plate']) == {'MAA001'}
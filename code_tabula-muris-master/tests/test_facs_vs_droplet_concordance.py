@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from facs_vs_droplet_concordance import concordance, read_annotations
+
+
+@pytest.mark.filterwarnings('error')
+def test_read_annotations(tmp_path):
+    pd.DataFrame({
+        'cell': ['a', 'b', 'c', 'd'],
+        'tissue': ['Heart', 'Aorta', 'Lung', 'Heart'],
+        'cell_ontology_class': ['fibroblast'] * 4,
+        'plate.barcode': ['P1', 'P1', 'P1', 'P2'],
+        'free_annotation': ['x'] * 4,
+    }).to_csv(tmp_path / 'annotations_facs.csv', index=False)
+    pd.DataFrame({
+        'cell': ['e'], 'tissue': ['Heart_and_Aorta'],
+        'cell_ontology_class': ['fibroblast'], 'channel': ['10X_P7_4'],
+    }).to_csv(tmp_path / 'annotations_droplet.csv', index=False)
+    metadata = tmp_path / 'metadata_FACS.csv'
+    pd.DataFrame({'plate.barcode': ['P1', 'P2'],
+                  'FACS.selection': ['Viable', 'Endothelial']}).to_csv(
+        metadata, index=False)
+
+    annotations = read_annotations(str(tmp_path), str(metadata))
+    assert annotations.columns.tolist() == ['tissue', 'cell_ontology_class',
+                                            'method']
+    # FACS heart and aorta are paired with the droplet Heart_and_Aorta
+    assert annotations['tissue'].tolist() == [
+        'Heart_and_Aorta', 'Heart_and_Aorta', 'Lung', 'Heart_and_Aorta']
+    assert annotations['method'].tolist() == ['facs'] * 3 + ['droplet']
+    assert len(read_annotations(str(tmp_path))) == 5
+
+
+def annotation(tissue, method, classes):
+    return pd.DataFrame({'tissue': tissue, 'cell_ontology_class': classes,
+                         'method': method})
+
+
+def test_concordance():
+    annotations = pd.concat([
+        annotation('Heart_and_Aorta', 'facs', ['A', 'A', 'A', 'B', np.nan]),
+        annotation('Heart_and_Aorta', 'droplet', ['A', 'A', 'C', 'C']),
+        # Only sequenced by FACS, so not compared
+        annotation('Lung', 'facs', ['A', 'D']),
+    ], ignore_index=True)
+    table = concordance(annotations).set_index('cell_ontology_class')
+
+    assert table.index.tolist() == ['A', 'B', 'C']
+    assert (table['tissue'] == 'Heart_and_Aorta').all()
+    assert table['n.facs'].tolist() == [3, 1, 0]
+    assert table['n.droplet'].tolist() == [2, 0, 2]
+    assert table['percentage.facs'].tolist() == [75, 25, 0]
+    assert table['percentage.droplet'].tolist() == [50, 0, 50]
+    assert table['present_in'].tolist() == ['both', 'facs', 'droplet']
+    assert table.loc['A', 'count_ratio'] == 1.5
+    assert np.isnan(table.loc['B', 'count_ratio'])
+    assert table.loc['C', 'count_ratio'] == 0
+    assert table.loc['A', 'percentage_difference'] == 25
+    assert table.loc['A', 'log2_proportion_ratio'] == \
+        pytest.approx(np.log2(1.4))
+    assert np.isfinite(table['log2_proportion_ratio']).all()
+    # Two-proportion z-test with a pooled proportion of 5/8
+    assert table.loc['A', 'z'] == \
+        pytest.approx(0.25 / np.sqrt(5 / 8 * 3 / 8 * (1 / 4 + 1 / 4)))
@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+
+import gene_set_scores
+import raw_counts
+
+
+def test_read_gene_sets(tmp_path, monkeypatch):
+    monkeypatch.setattr(raw_counts, 'ROOT', str(tmp_path))
+    pd.DataFrame({'Symbol': ['Fos', 'Jun', None, 'Fos']}).to_csv(
+        tmp_path / 'tfs.csv', index=False)
+    gene_sets_yaml = tmp_path / 'gene_sets.yaml'
+    gene_sets_yaml.write_text("ercc:\n  PATTERN: '^ERCC-'\n"
+                              "tf:\n  GENES: [Myc]\n  FILE: tfs.csv\n"
+                              "  COLUMN: Symbol\n")
+    assert gene_set_scores.read_gene_sets(str(gene_sets_yaml)) == {
+        'ercc': ([], '^ERCC-'), 'tf': (['Myc', 'Fos', 'Jun'], None)}
+
+    gene_sets_yaml.write_text('empty:\n  COLUMN: Symbol\n')
+    with pytest.raises(ValueError):
+        gene_set_scores.read_gene_sets(str(gene_sets_yaml))
+
+
+def test_score_denominators():
+    genes = pd.Index(['A', 'B', 'Rpl1', 'ERCC-00002', 'ERCC-00003'])
+    matrix = np.array([[1, 2, 3, 2, 2],
+                       [0, 0, 5, 0, 5],
+                       [0, 0, 0, 4, 0]], dtype=np.float32)
+    counts = raw_counts.Counts(sparse.csr_matrix(matrix),
+                               pd.Index(['c1', 'c2', 'c3']), genes)
+    gene_sets = {'ab': (['A', 'B'], None), 'ribo': ([], r'^Rp[sl]\d'),
+                 'ercc': ([], '^ERCC-'), 'a_and_ercc': (['A'], '^ERCC-00003')}
+    scores = gene_set_scores.score(counts, gene_sets)
+
+    # Sets without ERCCs are fractions of the non-ERCC counts
+    assert scores['percent.ab'].tolist() == pytest.approx([0.5, 0, 0])
+    assert scores['percent.ribo'].tolist() == pytest.approx([0.5, 1, 0])
+    # Sets with ERCCs are fractions of all counts, as percent.ercc
+    assert scores['percent.ercc'].tolist() == pytest.approx([0.4, 0.5, 1])
+    assert scores['percent.a_and_ercc'].tolist() == \
+        pytest.approx([0.3, 0.5, 0])
+    assert scores['n_genes.ab'].tolist() == [2, 0, 0]
+    assert scores['n_genes.ercc'].tolist() == [2, 1, 1]
+    assert list(scores.index) == ['c1', 'c2', 'c3']
+
+
+def test_score_tissue(tissue_tree):
+    gene_sets = {'markers': ([f'Gene{i}' for i in range(20)], None),
+                 'ercc': ([], '^ERCC-')}
+    scored = gene_set_scores.score_tissue('Liver', 'droplet', gene_sets)
+    annotation = raw_counts.read_annotation('Liver', 'droplet')
+    assert scored.index.tolist() == annotation.index.tolist()
+    assert (scored['method'] == 'droplet').all()
+    # The first class expresses the first block of genes
+    is_first = scored['cell_ontology_class'] == 'B cell'
+    assert scored.loc[is_first, 'percent.markers'].min() > \
+        scored.loc[~is_first, 'percent.markers'].max()
+    assert scored['percent.ercc'].between(0, 1).all()
@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+from sklearn.neighbors import NearestNeighbors
+
+import han_label_transfer
+import raw_counts
+
+
+def write_dge(filename, counts, name_gene_column=False):
+    """Write counts as a Han et al. genes x cells DGE table"""
+    table = pd.DataFrame(counts.matrix.toarray().T.astype(int),
+                         index=counts.genes, columns=counts.cells)
+    with open(filename, 'w') as f:
+        header = list(counts.cells)
+        if name_gene_column:
+            header.insert(0, 'GENE')
+        f.write(' '.join(f'"{x}"' for x in header) + '\n')
+        for gene, row in table.iterrows():
+            f.write(f'"{gene}" ' + ' '.join(map(str, row)) + '\n')
+
+
+@pytest.mark.parametrize('name_gene_column', [False, True])
+def test_read_dge(tmp_path, name_gene_column):
+    matrix = np.array([[0, 3], [1, 0], [0, 0]], dtype=np.float32)
+    counts = raw_counts.Counts(sparse.csr_matrix(matrix.T),
+                               pd.Index(['c1', 'c2']),
+                               pd.Index(['Actb', 'Cd19', 'Alb']))
+    filename = str(tmp_path / 'GSM1_dge.txt')
+    write_dge(filename, counts, name_gene_column)
+    read = han_label_transfer.read_dge(filename, chunksize=2)
+    assert list(read.cells) == ['c1', 'c2']
+    assert list(read.genes) == ['Actb', 'Cd19', 'Alb']
+    assert np.array_equal(read.matrix.toarray(), matrix.T)
+
+
+def test_transfer_recovers_classes(tissue_tree):
+    reference = han_label_transfer.build_reference('Liver', n_pcs=10)
+    assert len(reference['classes']) == len(reference['embedding'])
+    index = NearestNeighbors().fit(reference['embedding'])
+
+    # Another tissue with the same classes stands in for the query, with a
+    # few reference genes missing
+    query, annotation = raw_counts.read_annotated_counts('Spleen', 'droplet')
+    query = raw_counts.subset_genes(query, query.genes[5:])
+    predictions = han_label_transfer.transfer(query, reference, index, k=10,
+                                              batch_size=50)
+    assert predictions.index.equals(query.cells)
+    accuracy = (predictions['cell_ontology_class'] ==
+                annotation['cell_ontology_class'].values).mean()
+    assert accuracy > 0.95
+    assert ((predictions['confidence'] > 0) &
+            (predictions['confidence'] <= 1)).all()
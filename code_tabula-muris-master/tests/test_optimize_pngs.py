@@ -0,0 +1,114 @@
+import base64
+import os
+import stat
+import sys
+
+from click.testing import CliRunner
+
+import generate_from_template
+import optimize_pngs
+
+# Stands in for optipng: "optimizes" an image by dropping its trailing zeros,
+# and logs every call
+FAKE_OPTIPNG = f'''#!{sys.executable}
+import sys
+arguments = sys.argv[1:]
+before, after = arguments[-1], arguments[arguments.index('-out') + 1]
+with open(before, 'rb') as f:
+    image = f.read()
+with open(after, 'wb') as f:
+    f.write(image.rstrip(b'\\0'))
+with open(__file__ + '.log', 'a') as f:
+    f.write(before + '\\n')
+'''
+
+
+def image(i, padding=100):
+    return b'\x89PNG fake image ' + str(i).encode() + b'\0' * padding
+
+
+def html(*images):
+    return b''.join(b'<img src="data:image/png;base64,' +
+                    base64.b64encode(x) + b'">' for x in images)
+
+
+def test_code_to_codeblock():
+    assert "```{r optipng='-o7'}\nx <- 1\n```" in \
+        generate_from_template.code_to_codeblock('x <- 1')
+    assert "```{r}\nx <- 1\n```" in \
+        generate_from_template.code_to_codeblock('x <- 1', optipng=False)
+
+
+def test_remove_optipng():
+    rmarkdown = ("```{r use-optipng, optipng='-o7'}\nplot(1)\n```\n"
+                 "```{r optipng='-o7', fig.width=5}\nplot(2)\n```\n"
+                 "```{r}\noptipng='kept in code'\n```\n")
+    assert generate_from_template.remove_optipng(rmarkdown) == (
+        "```{r use-optipng}\nplot(1)\n```\n"
+        "```{r, fig.width=5}\nplot(2)\n```\n"
+        "```{r}\noptipng='kept in code'\n```\n")
+
+
+def test_optimize_files_once(tmp_path):
+    executable = tmp_path / 'optipng'
+    executable.write_text(FAKE_OPTIPNG)
+    executable.chmod(executable.stat().st_mode | stat.S_IEXEC)
+    log = tmp_path / 'optipng.log'
+    figures = tmp_path / 'figures'
+    figures.mkdir()
+    (figures / 'a.png').write_bytes(image(1))
+    (figures / 'b.png').write_bytes(image(1))
+    (figures / 'Liver.nb.html').write_bytes(html(image(1), image(2)))
+    # Already optimal, so kept as is
+    (figures / 'c.png').write_bytes(image(3, padding=0))
+
+    arguments = [str(figures), '--cache-dir', str(tmp_path / 'cache'),
+                 '--optipng', str(executable), '--jobs', '1']
+    result = CliRunner().invoke(optimize_pngs.cli, arguments)
+    assert result.exit_code == 0, result.output
+    assert '5 images (3 distinct) in 4 files, 3 to optimize' in result.output
+    assert len(log.read_text().splitlines()) == 3
+    assert (figures / 'a.png').read_bytes() == image(1, padding=0)
+    assert (figures / 'b.png').read_bytes() == image(1, padding=0)
+    assert (figures / 'Liver.nb.html').read_bytes() == \
+        html(image(1, padding=0), image(2, padding=0))
+    assert (figures / 'c.png').read_bytes() == image(3, padding=0)
+    assert not [x for x in os.listdir(figures) if x.endswith('.tmp')]
+
+    # A new file with a known image only needs the cache
+    (figures / 'd.png').write_bytes(image(2))
+    result = CliRunner().invoke(optimize_pngs.cli, arguments)
+    assert result.exit_code == 0, result.output
+    assert '0 to optimize' in result.output
+    assert len(log.read_text().splitlines()) == 3
+    assert (figures / 'd.png').read_bytes() == image(2, padding=0)
+
+
+def test_decode_each_file_once(tmp_path, monkeypatch):
+    executable = tmp_path / 'optipng'
+    executable.write_text(FAKE_OPTIPNG)
+    executable.chmod(executable.stat().st_mode | stat.S_IEXEC)
+    (tmp_path / 'Liver.nb.html').write_bytes(html(*map(image, range(9))))
+    # Decoding in this process, the scan being done by the workers
+    decoded = []
+    read = optimize_pngs.read_images
+
+    def read_images(filename):
+        decoded.append(filename)
+        return read(filename)
+    monkeypatch.setattr(optimize_pngs, 'read_images', read_images)
+
+    result = CliRunner().invoke(optimize_pngs.cli, [
+        str(tmp_path / 'Liver.nb.html'), '--cache-dir',
+        str(tmp_path / 'cache'), '--optipng', str(executable)])
+    assert result.exit_code == 0, result.output
+    assert 'Optimized 9 images' in result.output
+    assert decoded == [str(tmp_path / 'Liver.nb.html')]
+    assert len((tmp_path / 'optipng.log').read_text().splitlines()) == 9
+
+
+def test_missing_optipng(tmp_path):
+    result = CliRunner().invoke(optimize_pngs.cli, [
+        str(tmp_path), '--optipng', str(tmp_path / 'no_optipng')])
+    assert result.exit_code != 0
+    assert 'not found' in result.output
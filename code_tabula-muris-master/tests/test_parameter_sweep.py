@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import clustering
+import parameter_sweep
+
+
+@pytest.mark.parametrize('block_size', [clustering.BLOCK_SIZE, 500])
+def test_prefix_knn_matches_knn(block_size):
+    pcs = np.random.default_rng(0).normal(size=(120, 12))
+    neighbors = clustering.prefix_knn(pcs, [3, 8, 12, 20], k=10,
+                                      block_size=block_size)
+    # Prefixes longer than the PCs are cut to the PCs
+    assert sorted(neighbors) == [3, 8, 12]
+    for n_pcs, found in neighbors.items():
+        expected = clustering.knn(pcs[:, :n_pcs], k=10)
+        # Every cell is one of its own neighbors
+        assert (found == np.arange(120)[:, None]).any(axis=1).all()
+        assert [set(x) for x in found] == [set(x) for x in expected]
+
+
+def test_agreement_ignores_missing_labels():
+    clusters = np.array([0, 0, 1, 1])
+    assert parameter_sweep.agreement(clusters, ['a', 'a', 'b', None]) == 1
+    assert np.isnan(parameter_sweep.agreement(clusters, [None] * 4))
+
+
+def test_sweep_table():
+    results = {(10, 0.5): np.array([0, 0, 1, 1]),
+               (10, 1): np.array([0, 1, 2, 2]),
+               (20, 0.5): np.array([0, 0, 1, 1]),
+               (20, 1): np.array([0, 0, 1, 1])}
+    annotation = pd.DataFrame({'cluster.ids': ['0', '0', '1', '1']})
+    table = parameter_sweep.sweep_table(results, annotation, ['cluster.ids'])
+    table = table.set_index(['npcs', 'res'])
+    assert table.loc[(10, 1), 'n_clusters'] == 3
+    assert table.loc[(10, 0.5), 'ari_next_npcs'] == 1
+    assert table.loc[(20, 0.5), 'ari_next_res'] == 1
+    assert np.isnan(table.loc[(20, 1), 'ari_next_res'])
+    assert table.loc[(20, 1), 'ari_cluster.ids'] == 1
+
+
+def test_sweep_tissue(tissue_tree, tmp_path):
+    parameters_yaml = tissue_tree / 'liver_droplet.yaml'
+    parameters_yaml.write_text(
+        'TISSUE: Liver\nMETHOD: droplet\nNPCS: 8\nRES: 1\nSUBSET:\n'
+        '  SUBSETA:\n    FILTER_COLUMN: cluster.ids\n'
+        '    FILTER_VALUE: c(0,1)\n'
+        '  SUBSETB:\n    FILTER_COLUMN: cell_ontology_class\n'
+        '    FILTER_VALUE: nope\n')
+    filename, table = parameter_sweep.sweep_tissue(
+        str(parameters_yaml), None, [5], [0.5], str(tmp_path))
+    # The yaml's own setting is always swept
+    assert len(table) == 4
+    assert table.loc[table['in_yaml'], 'ari_cluster.ids'].iloc[0] > 0.9
+
+    _, table = parameter_sweep.sweep_tissue(
+        str(parameters_yaml), 'SUBSETA', [5], [0.5], str(tmp_path))
+    assert set(table['n_cells']) == {table['n_cells'].iloc[0]}
+    assert (table['n_clusters'] >= 2).all()
+
+    with pytest.raises(parameter_sweep.TooFewCells) as e:
+        parameter_sweep.sweep_tissue(str(parameters_yaml), 'SUBSETB', [5],
+                                     [0.5], str(tmp_path))
+    assert e.value.n_cells == 0
+
+
+def test_sweep_tissue_cuts_npcs(tissue_tree, tmp_path, capsys):
+    parameters_yaml = tissue_tree / 'liver_facs.yaml'
+    # The FACS tissue has fewer cells than the yaml's NPCS
+    parameters_yaml.write_text('TISSUE: Liver\nMETHOD: facs\nNPCS: 500\n'
+                               'RES: 1\n')
+    _, table = parameter_sweep.sweep_tissue(
+        str(parameters_yaml), None, [5], [1], str(tmp_path))
+    n_pcs = table['npcs'].max()
+    assert n_pcs < 500
+    assert table.loc[table['in_yaml'], 'npcs'].tolist() == [n_pcs]
+    assert f'NPCS 500 swept as {n_pcs}' in capsys.readouterr().err
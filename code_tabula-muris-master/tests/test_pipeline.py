@@ -0,0 +1,95 @@
+import asyncio
+import os
+
+import pytest
+
+import pipeline
+from pipeline import PYTHON, Runner, task
+
+LIMITS = {PYTHON: 2}
+
+
+def run(tmp_path, tasks, **kwargs):
+    runner = Runner(tasks, LIMITS, state_file=str(tmp_path / 'state.json'),
+                    log_dir=str(tmp_path / 'logs'), **kwargs)
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(runner.run())
+    finally:
+        loop.close()
+
+
+@pytest.fixture
+def chain(tmp_path):
+    """in.txt -> a.txt -> b.txt"""
+    source = tmp_path / 'in.txt'
+    source.write_text('1')
+    a = task('a', PYTHON, ['touch', 'a.txt'], str(tmp_path),
+             inputs=[str(source)], outputs=[str(tmp_path / 'a.txt')])
+    b = task('b', PYTHON, ['touch', 'b.txt'], str(tmp_path),
+             outputs=[str(tmp_path / 'b.txt')], deps=['a'])
+    return source, [a, b]
+
+
+def test_second_run_skips(tmp_path, chain):
+    _, tasks = chain
+    assert run(tmp_path, tasks) == {'a': 'done', 'b': 'done'}
+    assert run(tmp_path, tasks) == {'a': 'up to date', 'b': 'up to date'}
+    assert run(tmp_path, tasks, force=True) == {'a': 'done', 'b': 'done'}
+
+
+def test_changed_input_reruns_downstream(tmp_path, chain):
+    source, tasks = chain
+    run(tmp_path, tasks)
+    source.write_text('22')
+    assert run(tmp_path, tasks, dry_run=True) == \
+        {'a': 'would run', 'b': 'would run'}
+    assert run(tmp_path, tasks) == {'a': 'done', 'b': 'done'}
+    assert run(tmp_path, tasks) == {'a': 'up to date', 'b': 'up to date'}
+
+
+def test_missing_output_reruns(tmp_path, chain):
+    _, tasks = chain
+    run(tmp_path, tasks)
+    os.remove(tmp_path / 'b.txt')
+    assert run(tmp_path, tasks) == {'a': 'up to date', 'b': 'done'}
+
+
+def test_existing_outputs_are_adopted(tmp_path, chain):
+    source, tasks = chain
+    (tmp_path / 'a.txt').write_text('')
+    (tmp_path / 'b.txt').write_text('')
+    os.utime(source, (0, 0))
+    assert run(tmp_path, tasks) == {'a': 'up to date', 'b': 'up to date'}
+
+    # Outputs older than their inputs are not
+    (tmp_path / 'state.json').unlink()
+    os.utime(tmp_path / 'a.txt', (0, 0))
+    os.utime(source, None)
+    assert run(tmp_path, tasks) == {'a': 'done', 'b': 'done'}
+
+
+@pytest.mark.parametrize('command', [['false'], ['true'],
+                                     ['./not_a_script.py']])
+def test_failure_blocks_dependents(tmp_path, chain, command):
+    """Exit codes, missing outputs and commands that cannot start"""
+    _, tasks = chain
+    failing = task('f', PYTHON, command, str(tmp_path),
+                   outputs=[str(tmp_path / 'f.txt')])
+    dependent = task('g', PYTHON, ['touch', 'g.txt'], str(tmp_path),
+                     outputs=[str(tmp_path / 'g.txt')], deps=['f'])
+    downstream = task('h', PYTHON, ['touch', 'h.txt'], str(tmp_path),
+                      deps=['g', 'b'])
+    status = run(tmp_path, tasks + [failing, dependent, downstream])
+    assert status == {'a': 'done', 'b': 'done', 'f': 'failed',
+                      'g': 'blocked', 'h': 'blocked'}
+    assert not (tmp_path / 'g.txt').exists()
+
+
+def test_task_signature():
+    a = task('a', PYTHON, ['touch', 'a.txt'], '.')
+    signature = pipeline.task_signature(a, ['x'])
+    assert pipeline.task_signature(a, ['x']) == signature
+    assert pipeline.task_signature(a, ['y']) != signature
+    assert pipeline.task_signature(a._replace(command=['touch', 'b.txt']),
+                                   ['x']) != signature
@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import raw_counts
+from pseudobulk import Pseudobulk
+
+
+@pytest.mark.parametrize('method', raw_counts.METHODS)
+def test_sums_match_groupby(tissue_tree, method):
+    pseudobulk = Pseudobulk.from_tissues(['Liver', 'Spleen'], method, jobs=1)
+    assert not pseudobulk.genes.str.startswith('ERCC-').any()
+
+    counts, annotation = raw_counts.read_annotated_counts('Spleen', method)
+    normalized = raw_counts.log_normalize(counts.matrix,
+                                          raw_counts.SCALE_FACTORS[method])
+    groups = 'Spleen__' + annotation['cell_ontology_class'].values
+    for name, matrix in (('sum', counts.matrix), ('mean', normalized),
+                         ('fraction_expressing', counts.matrix > 0)):
+        frame = pd.DataFrame(matrix.toarray().astype(np.float64),
+                             columns=counts.genes)
+        grouped = frame.groupby(groups)
+        expected = grouped.sum() if name == 'sum' else grouped.mean()
+        table = pseudobulk.frame(name, tissue='Spleen')
+        assert np.allclose(table[expected.index].values,
+                           expected.T.loc[pseudobulk.genes].values,
+                           rtol=1e-5)
+
+    n_cells = pseudobulk.groups.loc[pseudobulk.groups['tissue'] == 'Spleen',
+                                    'n_cells']
+    assert n_cells.to_dict() == pd.Series(groups).value_counts().to_dict()
+
+
+def test_genes_and_save_load(tissue_tree, tmp_path):
+    pseudobulk = Pseudobulk.from_tissues(['Liver'], 'facs',
+                                         genes=['Gene3', 'Gene0'], jobs=1)
+    assert list(pseudobulk.genes) == ['Gene3', 'Gene0']
+    filename = str(tmp_path / 'pseudobulk_facs.npz')
+    pseudobulk.save(filename)
+    loaded = Pseudobulk.load(filename)
+    assert loaded.groups.equals(pseudobulk.groups)
+    assert loaded.frame('sum', genes=['Gene0'],
+                        cell_ontology_class='B cell').equals(
+        pseudobulk.frame('sum', genes=['Gene0'],
+                         cell_ontology_class='B cell'))
+    with pytest.raises(KeyError):
+        loaded.frame('sum', genes=['Gene5'])
@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+from scipy import io, sparse
+
+import raw_counts
+
+
+def facs_csv(tissue_tree, tissue='Liver'):
+    return pd.read_csv(tissue_tree / 'facs' / 'FACS' / f'{tissue}-counts.csv',
+                       index_col=0)
+
+
+def test_read_facs_counts(tissue_tree):
+    expected = facs_csv(tissue_tree)
+    counts = raw_counts.read_counts('Liver', 'facs')
+    # Cells are sorted by name, as in boilerplate.R
+    assert counts.cells.tolist() == sorted(expected.columns)
+    assert counts.genes.tolist() == expected.index.tolist()
+    assert np.array_equal(counts.matrix.toarray(),
+                          expected[counts.cells].values.T)
+
+
+def test_read_facs_counts_of_some_cells(tissue_tree):
+    expected = facs_csv(tissue_tree)
+    cells = list(expected.columns[[7, 2, 30]]) + ['not_a_cell']
+    counts = raw_counts.read_counts('Liver', 'facs', cells=cells)
+    assert counts.cells.tolist() == sorted(cells[:3])
+    assert np.array_equal(counts.matrix.toarray(),
+                          expected[counts.cells].values.T)
+
+
+def channel_counts(tissue_tree, channel):
+    folder = tissue_tree / 'droplet' / 'droplet' / f'Liver-{channel}'
+    matrix = io.mmread(str(folder / 'matrix.mtx')).toarray()
+    barcodes = pd.read_csv(folder / 'barcodes.tsv', header=None)[0]
+    cells = channel + '_' + barcodes.str.replace('-1$', '', regex=True)
+    return pd.DataFrame(matrix.T, index=cells)
+
+
+def test_read_droplet_counts(tissue_tree):
+    expected = pd.concat([channel_counts(tissue_tree, x)
+                          for x in ('10X_P4_2', '10X_P7_0')])
+    counts = raw_counts.read_counts('Liver', 'droplet')
+    assert counts.cells.tolist() == sorted(expected.index)
+    assert counts.genes[0] == 'Gene0'
+    assert np.array_equal(counts.matrix.toarray(),
+                          expected.loc[counts.cells].values)
+
+
+def test_read_droplet_counts_of_some_cells(tissue_tree):
+    expected = channel_counts(tissue_tree, '10X_P7_0')
+    cells = expected.index[[5, 1, 60]]
+    counts = raw_counts.read_counts('Liver', 'droplet', cells=cells)
+    assert counts.cells.tolist() == sorted(cells)
+    assert np.array_equal(counts.matrix.toarray(),
+                          expected.loc[counts.cells].values)
+
+
+def test_read_mtx_columns(tmp_path):
+    dense = np.arange(12).reshape(3, 4) % 5
+    filename = str(tmp_path / 'matrix.mtx')
+    io.mmwrite(filename, sparse.coo_matrix(dense))
+    matrix = raw_counts.read_mtx_columns(filename, [3, 0])
+    assert np.array_equal(matrix.toarray(), dense[:, [3, 0]])
+
+
+def test_read_annotated_counts(tissue_tree):
+    expected = facs_csv(tissue_tree)
+    counts, annotation = raw_counts.read_annotated_counts('Liver', 'facs')
+    # The annotation leaves some cells out, and its order is kept
+    assert counts.cells.tolist() == annotation.index.tolist()
+    assert len(annotation) == expected.shape[1] - 3
+    assert not counts.genes.str.startswith('ERCC-').any()
+    non_ercc = expected.loc[counts.genes, counts.cells]
+    assert np.array_equal(counts.matrix.toarray(), non_ercc.values.T)
+    assert np.array_equal(annotation['n_counts'], non_ercc.sum().values)
+
+    counts, _ = raw_counts.read_annotated_counts(
+        'Liver', 'facs', genes=['Gene3', 'ERCC-00002', 'Gene1', 'nope'])
+    assert counts.genes.tolist() == ['Gene3', 'Gene1']
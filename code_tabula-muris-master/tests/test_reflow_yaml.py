@@ -0,0 +1,57 @@
+import os
+import shutil
+
+from click.testing import CliRunner
+
+import reflow_yaml
+
+MESSY = ("TISSUE: Liver\nGENES: 'Alb, Cd19, Alb'\nSUBSET:\n"
+         "  SUBSETA:\n    GENES: [Cd79b, Cd79a, Cd79b]\n")
+
+
+def write_yamls(tmp_path):
+    messy = tmp_path / 'messy_facs.yaml'
+    messy.write_text(MESSY)
+    tidy = tmp_path / 'liver_facs.yaml'
+    shutil.copy(os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                             '28_tissue_yamls_for_supplement',
+                             'liver_facs.yaml'), tidy)
+    return messy, tidy
+
+
+def reflow(*arguments):
+    result = CliRunner().invoke(reflow_yaml.cli, [str(x) for x in arguments])
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def test_reflow():
+    data = reflow_yaml.reflow({'GENES': 'Alb, Cd19, Alb', 'SUBSET': {
+        'SUBSETA': {'GENES': ['Cd79b', 'Cd79a', 'Cd79b']}}})
+    assert data['GENES'] == ['Alb', 'Cd19']
+    assert data['SUBSET']['SUBSETA']['GENES'] == ['Cd79a', 'Cd79b']
+
+
+def test_reflow_in_place_is_idempotent(tmp_path):
+    messy, tidy = write_yamls(tmp_path)
+    tidy_stat = os.stat(tidy)
+
+    assert '1 changed, 1 unchanged' in reflow('--in-place', messy, tidy)
+    assert messy.read_text().startswith('---\nGENES:\n- Alb\n- Cd19\n')
+    reflowed = messy.read_text()
+
+    assert '0 changed, 2 unchanged' in reflow('--in-place', messy, tidy)
+    assert messy.read_text() == reflowed
+    # Unchanged files are not rewritten at all
+    assert os.stat(tidy).st_ino == tidy_stat.st_ino
+    assert os.stat(tidy).st_mtime_ns == tidy_stat.st_mtime_ns
+    assert sorted(os.listdir(tmp_path)) == ['liver_facs.yaml',
+                                            'messy_facs.yaml']
+
+
+def test_reflow_to_new_files(tmp_path):
+    messy, tidy = write_yamls(tmp_path)
+    assert '1 changed, 1 unchanged' in reflow(messy, tidy)
+    assert messy.read_text() == MESSY
+    assert (tmp_path / 'messy_facs.yaml.reflowed').exists()
+    assert not (tmp_path / 'liver_facs.yaml.reflowed').exists()
@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+
+import raw_counts
+import slice_export
+import subset_preview
+
+
+def full_read(tissue, method, cells):
+    """Rows of cells from reading the whole tissue"""
+    counts, annotation = raw_counts.read_annotated_counts(tissue, method)
+    positions = counts.cells.get_indexer(cells)
+    return counts.matrix[positions].toarray(), annotation.loc[cells]
+
+
+@pytest.mark.parametrize('method', raw_counts.METHODS)
+def test_slice_matches_full_read(tissue_tree, method):
+    where = slice_export.parse_where(['cell_ontology_class=T cell',
+                                      'cell_ontology_class=B cell',
+                                      'mouse.sex=F'])
+    counts, annotation = slice_export.export_slice(method, where, jobs=1)
+    assert set(annotation['tissue']) == {'Liver', 'Spleen'}
+    assert annotation['cell_ontology_class'].isin(['T cell', 'B cell']).all()
+    assert (annotation['mouse.sex'] == 'F').all()
+    assert counts.cells.equals(annotation.index)
+
+    for tissue in ('Liver', 'Spleen'):
+        cells = annotation.index[annotation['tissue'] == tissue]
+        matrix, expected = full_read(tissue, method, cells)
+        positions = counts.cells.get_indexer(cells)
+        assert np.array_equal(counts.matrix[positions].toarray(), matrix)
+        assert np.array_equal(annotation.loc[cells, 'n_counts'],
+                              expected['n_counts'])
+
+
+def test_single_channel_and_genes(tissue_tree):
+    where = {'channel': ['10X_P7_0']}
+    counts, annotation = slice_export.export_slice(
+        'droplet', where, genes=['Gene7', 'Gene1'], tissues=['Liver'], jobs=1)
+    assert list(counts.genes) == ['Gene7', 'Gene1']
+    matrix, expected = full_read('Liver', 'droplet', annotation.index)
+    all_genes = raw_counts.read_annotated_counts('Liver', 'droplet')[0].genes
+    assert np.array_equal(counts.matrix.toarray(),
+                          matrix[:, all_genes.get_indexer(['Gene7', 'Gene1'])])
+    # n_counts is over all genes, not only the exported ones
+    assert np.array_equal(annotation['n_counts'], expected['n_counts'])
+
+
+def test_select_cells_matches_subset_filters(tissue_tree):
+    # Numbers match whatever their formatting, as FILTER_VALUE does
+    selected = slice_export.select_cells('facs', {'cluster.ids': ['0.0', 1]},
+                                         tissues=['Liver'])
+    annotation = raw_counts.read_annotation('Liver', 'facs')
+    expected = subset_preview.in_subset(annotation, 'cluster.ids', 'c(0,1)')
+    assert selected['Liver'].index.equals(annotation.index[expected])
+    assert set(selected['Liver']['cluster.ids']) == {'0', '1'}
+
+
+def test_no_match_and_unknown_column(tissue_tree):
+    with pytest.raises(ValueError):
+        slice_export.export_slice('facs', {'tissue': ['Brain']}, jobs=1)
+    with pytest.raises(KeyError):
+        slice_export.select_cells('facs', {'color': ['red']})
+
+
+def test_save_load(tissue_tree, tmp_path):
+    counts, annotation = slice_export.export_slice(
+        'facs', {'tissue': ['Liver']}, jobs=1)
+    filename = str(tmp_path / 'liver.npz')
+    slice_export.save_slice(filename, counts, annotation)
+    loaded, loaded_annotation = slice_export.load_slice(filename)
+    assert loaded.cells.equals(counts.cells)
+    assert loaded.genes.equals(counts.genes)
+    assert (loaded.matrix != counts.matrix).nnz == 0
+    assert loaded_annotation['subtissue'].isnull().all()
+    assert np.array_equal(loaded_annotation['n_counts'],
+                          annotation['n_counts'])
+    assert list(loaded_annotation['cell_ontology_class']) == \
+        list(annotation['cell_ontology_class'])
+
+
+def test_align_genes():
+    matrix = sparse.csr_matrix(np.array([[1, 0], [0, 2]]))
+    all_genes = pd.Index(['a', 'b', 'c'])
+    expected = np.array([[0, 0, 1], [2, 0, 0]])
+    assert np.array_equal(
+        raw_counts.align_genes(matrix, ['c', 'a'], all_genes).toarray(),
+        expected)
+    assert np.array_equal(
+        raw_counts.align_genes(matrix.toarray(), ['c', 'a'], all_genes),
+        expected)
@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+from sklearn.metrics import adjusted_rand_score
+
+import clustering
+import raw_counts
+import subset_preview
+from subset_preview import filter_values, in_subset
+
+
+def test_filter_values():
+    assert filter_values('c(11, 12)') == ['11', '12']
+    assert filter_values('c("B cell", \'T cell\')') == ['B cell', 'T cell']
+    assert filter_values('hepatocyte') == ['hepatocyte']
+    assert filter_values(3) == ['3']
+
+
+def test_in_subset_compares_numbers_as_numbers():
+    annotation = pd.DataFrame({
+        'cluster.ids': ['0', '1', '2', np.nan],
+        'subsetA_cluster.ids': [0.0, 1.0, np.nan, 0.0],
+        'cell_ontology_class': ['B cell', 'T cell', 'B cell', np.nan]})
+    assert in_subset(annotation, 'cluster.ids', 'c(0,1)').tolist() == \
+        [True, True, False, False]
+    assert in_subset(annotation, 'subsetA_cluster.ids', 0).tolist() == \
+        [True, False, False, True]
+    assert in_subset(annotation, 'cell_ontology_class',
+                     'B cell').tolist() == [True, False, True, False]
+    assert not in_subset(annotation, 'cell_ontology_class', 'nope').any()
+
+
+def test_read_annotation_keeps_cluster_ids_as_strings(tissue_tree):
+    annotation = raw_counts.read_annotation('Liver', 'facs')
+    assert set(annotation['cluster.ids']) <= {'0', '1', '2', '3'}
+
+
+def test_find_clusters_separates_classes(tissue_tree):
+    counts, annotation = raw_counts.read_annotated_counts('Liver', 'droplet')
+    normalized = raw_counts.log_normalize(counts.matrix, 1e4)
+    pcs = clustering.variable_gene_pcs(normalized, 10)
+    clusters = clustering.find_clusters(pcs, 10, 0.5)
+    assert adjusted_rand_score(annotation['cluster.ids'], clusters) > 0.9
+
+
+def modularity(graph, communities, resolution=1.0):
+    degrees = np.asarray(graph.sum(axis=1)).ravel()
+    two_m = degrees.sum()
+    same = communities[:, None] == communities[None, :]
+    return (graph.toarray()[same].sum() - resolution *
+            (np.outer(degrees, degrees)[same]).sum() / two_m) / two_m
+
+
+def test_louvain_finds_planted_communities():
+    rng = np.random.default_rng(0)
+    planted = np.repeat(np.arange(6), 50)[rng.permutation(300)]
+    same = planted[:, None] == planted[None, :]
+    edges = np.triu(rng.random((300, 300)) < np.where(same, 0.3, 0.01), 1)
+    graph = sparse.csr_matrix(edges + edges.T, dtype=float)
+
+    clusters = clustering.louvain(graph)
+    assert adjusted_rand_score(planted, clusters) == 1
+    # Numbered from the largest cluster
+    sizes = np.bincount(clusters)
+    assert (np.diff(sizes) <= 0).all()
+    communities, improved = clustering._local_moving(
+        graph, 1.0, np.random.default_rng(0))
+    assert improved
+    assert modularity(graph, communities) > modularity(graph, np.arange(300))
+
+
+@pytest.fixture
+def parameters_yaml(tissue_tree):
+    filename = tissue_tree / 'liver_droplet.yaml'
+    filename.write_text(
+        'TISSUE: Liver\nMETHOD: droplet\nSUBSET:\n'
+        '  SUBSETA:\n    FILTER_COLUMN: cluster.ids\n'
+        '    FILTER_VALUE: c(0,1)\n    NPCS: 5\n    RES: 0.5\n'
+        '  SUBSETB:\n    FILTER_COLUMN: cell_ontology_class\n'
+        '    FILTER_VALUE: nope\n')
+    return str(filename)
+
+
+def test_preview_tissue(parameters_yaml, tmp_path):
+    tissue, method, summary = subset_preview.preview_tissue(
+        parameters_yaml, str(tmp_path))
+    subset_a, subset_b = summary
+    annotation = raw_counts.read_annotation('Liver', 'droplet')
+    assert subset_a['n_cells'] == \
+        annotation['cluster.ids'].isin(['0', '1']).sum()
+    assert subset_a['n_clusters'] >= 2
+    # Empty subsets are reported, not reclustered
+    assert subset_b['n_cells'] == 0
+    assert subset_b['n_clusters'] == 0
+
+    preview = pd.read_csv(tmp_path / 'Liver_droplet_SubsetA_preview.csv',
+                          index_col='cell')
+    assert len(preview) == subset_a['n_cells']
+    assert preview['cell_ontology_class'].isin(['B cell', 'T cell']).all()
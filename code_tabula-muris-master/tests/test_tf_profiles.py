@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from tf_profiles import classes_above_threshold, correlation_clustering, \
+    make_names
+
+
+@pytest.mark.parametrize('label, expected', [
+    # Outputs of R's make.names
+    ('Liver__B cell', 'Liver__B.cell'),
+    ('Kupffer cell (liver)', 'Kupffer.cell..liver.'),
+    ('10X cell', 'X10X.cell'),
+    ('.2a', 'X.2a'),
+    ('.a', '.a'),
+    ('_a', 'X_a'),
+    (' a', 'X.a'),
+    ('', 'X'),
+    ('NA', 'NA.'),
+    ('if', 'if.'),
+])
+def test_make_names(label, expected):
+    assert make_names(label) == expected
+
+
+def test_correlation_clustering():
+    mean = pd.DataFrame({'a': [1, 2, 3, 4], 'b': [1, 2, 3, 5],
+                         'c': [4, 3, 2, 1], 'none': [0, 0, 0, 0]},
+                        index=['Tf1', 'Tf2', 'Tf3', 'Tf4'], dtype=float)
+    correlation, linkage, constant = correlation_clustering(mean)
+    assert list(constant) == ['none']
+    assert sorted(correlation.index) == ['a', 'b', 'c']
+    assert list(correlation.index) == list(correlation.columns)
+    assert len(linkage) == 2
+    # a and b are merged first
+    assert sorted(linkage.loc[0, ['left', 'right']]) == [0, 1]
+    assert linkage['n_classes'].tolist() == [2, 3]
+
+
+@pytest.mark.parametrize('columns', [['a', 'none'], ['none'], []])
+def test_correlation_clustering_fewer_than_two_classes(columns):
+    mean = pd.DataFrame({'a': [1.0, 2.0], 'none': [0.0, 0.0]})[columns]
+    correlation, linkage, constant = correlation_clustering(mean)
+    assert list(constant) == [x for x in columns if x == 'none']
+    assert list(correlation.index) == [x for x in columns if x == 'a']
+    assert np.all(correlation.values == 1)
+    assert list(linkage.columns) == ['left', 'right', 'height', 'n_classes']
+    assert linkage.empty
+
+
+def test_classes_above_threshold():
+    fraction = pd.DataFrame({'Liver__B cell': [0.5, 0.2],
+                             'Liver__1 cell': [0.5, 0.6]},
+                            index=['Tf1', 'Tf2'])
+    protocols = pd.DataFrame({'Genes': ['Tf1;Tf2', 'Tf1', 'Tf3'],
+                              'Fraction_Expressing_Threshold': [0.4] * 3})
+    above = classes_above_threshold(fraction, protocols)
+    assert above['Celltypes_above_threshold'].tolist() == \
+        ['Liver__1.cell', 'Liver__B.cell;Liver__1.cell', '']
@@ -0,0 +1,142 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import website_images
+from website_images import build_tissue, fingerprint
+
+# Stands in for render_website_images.R: writes the kind and name of each
+# image to its filename and logs every image it draws
+FAKE_RENDERER = '''\
+import sys
+import pandas as pd
+
+tissue, method, robj, images_csv = sys.argv[1:]
+images = pd.read_csv(images_csv)
+with open(sys.argv[0] + '.log', 'a') as log:
+    for kind, name, filename in images.values:
+        with open(filename, 'w') as f:
+            f.write(f'{kind} {name}')
+        log.write(f'{tissue} {method} {kind} {name}\\n')
+'''
+
+
+@pytest.fixture
+def renderer(tmp_path):
+    script = tmp_path / 'render.py'
+    script.write_text(FAKE_RENDERER)
+    return (sys.executable, str(script))
+
+
+def rendered(renderer):
+    log = renderer[1] + '.log'
+    if not os.path.exists(log):
+        return []
+    with open(log) as f:
+        return f.read().splitlines()
+
+
+def build(tissue_tree, renderer, previous=None, **kwargs):
+    images_dir = str(tissue_tree / 'images')
+    return build_tissue('Liver', 'facs', [f'Gene{i}' for i in range(5)],
+                        images_dir, previous or {}, renderer=renderer,
+                        **kwargs)
+
+
+def edit_facs_counts(tissue_tree, edit):
+    filename = tissue_tree / 'facs' / 'FACS' / 'Liver-counts.csv'
+    counts = pd.read_csv(filename, index_col=0)
+    edit(counts)
+    counts.to_csv(filename)
+
+
+def test_fingerprint():
+    assert fingerprint('a', np.arange(3)) == fingerprint('a', np.arange(3))
+    assert fingerprint('a', np.arange(3)) != fingerprint(np.arange(3), 'a')
+    assert fingerprint(np.arange(3)) != fingerprint(np.arange(3.0))
+    assert fingerprint('ab', 'c') != fingerprint('a', 'bc')
+
+
+def test_first_build_renders_every_image(tissue_tree, renderer):
+    entries, stats = build(tissue_tree, renderer)
+    # tsne and vln of 5 genes, and the 3 metadata tSNEs
+    assert len(entries) == 13
+    assert stats == {'unchanged': 0, 'linked': 0, 'rendered': 13}
+    assert len(rendered(renderer)) == 13
+    images_dir = tissue_tree / 'images'
+    for name, entry in entries.items():
+        assert os.path.samefile(images_dir / name,
+                                images_dir / entry['object'])
+    assert (images_dir / 'Liver-facs-Gene3-vln.png').read_text() == \
+        'vln Gene3'
+
+
+def test_unchanged_images_are_skipped(tissue_tree, renderer):
+    entries, _ = build(tissue_tree, renderer)
+    again, stats = build(tissue_tree, renderer, entries)
+    assert again == entries
+    assert stats == {'unchanged': 13, 'linked': 0, 'rendered': 0}
+    assert len(rendered(renderer)) == 13
+
+
+def test_changed_gene_is_rendered_again(tissue_tree, renderer):
+    entries, _ = build(tissue_tree, renderer)
+
+    # Swap with a gene that has no images, so the cell totals are unchanged
+    def edit(counts):
+        counts.loc[['Gene2', 'Gene100']] = \
+            counts.loc[['Gene100', 'Gene2']].values
+    edit_facs_counts(tissue_tree, edit)
+
+    again, stats = build(tissue_tree, renderer, entries)
+    assert stats == {'unchanged': 11, 'linked': 0, 'rendered': 2}
+    assert rendered(renderer)[13:] == ['Liver facs tsne Gene2',
+                                       'Liver facs vln Gene2']
+    changed = {k for k in entries if entries[k] != again[k]}
+    assert changed == {'Liver-facs-Gene2-tsne.png', 'Liver-facs-Gene2-vln.png'}
+
+
+def test_identical_images_are_rendered_once(tissue_tree, renderer):
+    def edit(counts):
+        counts.loc['Gene1'] = counts.loc['Gene0']
+    edit_facs_counts(tissue_tree, edit)
+
+    entries, stats = build(tissue_tree, renderer)
+    assert stats == {'unchanged': 0, 'linked': 2, 'rendered': 11}
+    assert not any('Gene1' in x for x in rendered(renderer))
+    images_dir = tissue_tree / 'images'
+    for kind in ('tsne', 'vln'):
+        assert os.path.samefile(images_dir / f'Liver-facs-Gene0-{kind}.png',
+                                images_dir / f'Liver-facs-Gene1-{kind}.png')
+
+
+def test_force_renders_each_object_once(tissue_tree, renderer):
+    entries, _ = build(tissue_tree, renderer)
+    _, stats = build(tissue_tree, renderer, entries, force=True)
+    assert stats == {'unchanged': 0, 'linked': 0, 'rendered': 13}
+    assert len(rendered(renderer)) == 26
+
+
+def test_renderer_failure_raises(tissue_tree):
+    with pytest.raises(RuntimeError):
+        build(tissue_tree, (sys.executable, '-c', 'raise SystemExit(1)'))
+
+
+def test_link_replaces_stale_temporary_files(tmp_path):
+    source = tmp_path / 'object.png'
+    source.write_text('image')
+    name = tmp_path / 'name.png'
+    (tmp_path / 'name.png.tmp').write_text('stale')
+    website_images.link(str(source), str(name))
+    website_images.link(str(source), str(name))
+    other = tmp_path / 'other.png'
+    other.write_text('other image')
+    website_images.link(str(other), str(name))
+    assert os.path.samefile(other, name)
+    website_images.link(str(source), str(name))
+    assert os.path.samefile(source, name)
+    assert sorted(os.listdir(tmp_path)) == ['name.png', 'name.png.tmp',
+                                            'object.png', 'other.png']
@@ -0,0 +1,49 @@
+# coding: utf-8
+
+# Atomic file writes: the content goes to a temporary file in the same folder,
+# which is renamed over the target only once it is complete. An interrupted or
+# failing write therefore never leaves a partial file, nor a temporary one.
+
+from contextlib import contextmanager
+import os
+import shutil
+import tempfile
+
+
+def default_mode():
+    """Permissions of a new file under the current umask"""
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+@contextmanager
+def atomic_path(filename, suffix='.tmp'):
+    """Temporary path to write to, renamed over ``filename`` on success
+
+    The file keeps the permissions of the one it replaces.
+    """
+    folder = os.path.dirname(os.path.abspath(filename))
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=folder, suffix=suffix,
+                               prefix='.' + os.path.basename(filename))
+    os.close(fd)
+    try:
+        yield tmp
+        if os.path.exists(filename):
+            shutil.copymode(filename, tmp)
+        else:
+            os.chmod(tmp, default_mode())
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def write_atomic(filename, content):
+    """Write text or bytes to ``filename`` atomically"""
+    mode = 'wb' if isinstance(content, bytes) else 'w'
+    with atomic_path(filename) as tmp:
+        with open(tmp, mode) as f:
+            f.write(content)
@@ -0,0 +1,255 @@
+# coding: utf-8
+
+# Python versions of the Seurat steps the tissue notebooks run on every
+# subset: FindVariableGenes -> ScaleData -> RunPCA -> FindClusters -> RunTSNE.
+# They are meant for quickly previewing parameters (NPCS, RES, PERPLEXITY),
+# not for replacing the annotations made in R.
+
+import numpy as np
+from scipy import sparse
+from sklearn.manifold import TSNE
+from sklearn.neighbors import NearestNeighbors
+from sklearn.utils.extmath import randomized_svd
+
+# Seurat v2 defaults of FindVariableGenes, FindClusters and ScaleData
+X_LOW_CUTOFF = 0.1
+Y_CUTOFF = 0.5
+N_BINS = 20
+K_PARAM = 30
+PRUNE_SNN = 1 / 15
+SCALE_MAX = 10
+TSNE_SEED = 10
+# Number of node batches per local moving pass of louvain
+LOUVAIN_BATCHES = 32
+# Number of distances to hold in memory at a time in prefix_knn
+BLOCK_SIZE = 20000000
+
+
+def find_variable_genes(normalized, x_low_cutoff=X_LOW_CUTOFF,
+                        y_cutoff=Y_CUTOFF, n_bins=N_BINS):
+    """Genes with a high dispersion for their mean, as FindVariableGenes
+
+    ``normalized`` is a cells x genes log-normalized sparse matrix. Returns a
+    boolean mask over genes.
+    """
+    expm1 = normalized.copy()
+    np.expm1(expm1.data, out=expm1.data)
+    mean = np.asarray(expm1.mean(axis=0)).ravel()
+    squared_mean = np.asarray(expm1.multiply(expm1).mean(axis=0)).ravel()
+    n = normalized.shape[0]
+    variance = (squared_mean - mean ** 2) * n / max(n - 1, 1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dispersion = np.log(variance / mean)
+        log_mean = np.log1p(mean)
+    dispersion[~np.isfinite(dispersion)] = 0
+
+    # z-score dispersions within bins of mean expression
+    edges = np.linspace(log_mean.min(), log_mean.max(), n_bins + 1)
+    bins = np.clip(np.digitize(log_mean, edges[1:-1]), 0, n_bins - 1)
+    counts = np.bincount(bins, minlength=n_bins)
+    bin_mean = np.bincount(bins, dispersion, n_bins) / np.maximum(counts, 1)
+    bin_squared = np.bincount(bins, dispersion ** 2, n_bins)
+    bin_std = np.sqrt(np.maximum(bin_squared - counts * bin_mean ** 2, 0) /
+                      np.maximum(counts - 1, 1))
+    z = np.divide(dispersion - bin_mean[bins], bin_std[bins],
+                  out=np.zeros(len(dispersion)), where=bin_std[bins] > 0)
+    return (log_mean > x_low_cutoff) & (z > y_cutoff)
+
+
+def scale(normalized, scale_max=SCALE_MAX):
+    """Center and scale genes to unit variance, as ScaleData"""
+    dense = np.asarray(normalized.todense()) if sparse.issparse(normalized) \
+        else np.asarray(normalized)
+    dense = dense - dense.mean(axis=0)
+    std = dense.std(axis=0, ddof=1)
+    dense /= np.where(std > 0, std, 1)
+    return np.clip(dense, -scale_max, scale_max)
+
+
+def fit_pca(scaled, n_pcs, seed=0):
+    """Cell embeddings and gene loadings of the first ``n_pcs`` PCs
+
+    Uses a randomized truncated SVD. New cells scaled the same way are
+    projected with ``scaled @ loadings.T``.
+    """
+    n_pcs = min(n_pcs, min(scaled.shape) - 1)
+    u, s, loadings = randomized_svd(scaled, n_components=n_pcs, n_iter=7,
+                                    random_state=seed)
+    return u * s, loadings
+
+
+def randomized_pca(scaled, n_pcs, seed=0):
+    """Cell embeddings of the first ``n_pcs`` PCs by randomized truncated SVD"""
+    return fit_pca(scaled, n_pcs, seed)[0]
+
+
+def knn(embeddings, k=K_PARAM, n_jobs=1):
+    """Indices of the k nearest neighbors of every cell, including itself"""
+    k = min(k, len(embeddings))
+    neighbors = NearestNeighbors(n_neighbors=k, n_jobs=n_jobs)
+    neighbors.fit(embeddings)
+    return neighbors.kneighbors(embeddings, return_distance=False)
+
+
+def prefix_knn(pcs, n_pcs_grid, k=K_PARAM, block_size=BLOCK_SIZE):
+    """k nearest neighbors on each of several prefixes of the PCs at once
+
+    Squared distances on the first n PCs are those on fewer PCs plus the
+    contribution of the extra PCs, so for each block of cells the distances
+    are accumulated over the PCs once and the neighbors are read off every
+    time a prefix in ``n_pcs_grid`` is reached. Returns {n_pcs: neighbors}.
+    """
+    n = len(pcs)
+    k = min(k, n)
+    grid = sorted(set(min(x, pcs.shape[1]) for x in n_pcs_grid))
+    neighbors = {x: np.empty((n, k), dtype=int) for x in grid}
+    squared_norms = np.cumsum(pcs ** 2, axis=1)
+    rows_per_block = max(1, block_size // n)
+
+    for start in range(0, n, rows_per_block):
+        block = slice(start, min(start + rows_per_block, n))
+        rows = np.arange(block.start, block.stop)
+        squared = np.zeros((len(rows), n))
+        # A cell is always its own nearest neighbor, as in Seurat
+        squared[np.arange(len(rows)), rows] = -np.inf
+        previous = 0
+        for n_pcs in grid:
+            extra = slice(previous, n_pcs)
+            norms = squared_norms[:, n_pcs - 1] - \
+                (squared_norms[:, previous - 1] if previous else 0)
+            squared += norms[rows][:, None] + norms[None, :] - \
+                2 * pcs[block, extra] @ pcs[:, extra].T
+            neighbors[n_pcs][block] = np.argpartition(squared, k - 1,
+                                                      axis=1)[:, :k]
+            previous = n_pcs
+    return neighbors
+
+
+def snn_graph(neighbors, prune=PRUNE_SNN):
+    """Shared nearest neighbor graph with Jaccard weights, as in Seurat
+
+    Edges whose weight is below ``prune`` are removed.
+    """
+    n, k = neighbors.shape
+    rows = np.repeat(np.arange(n), k)
+    indicator = sparse.csr_matrix((np.ones(n * k), (rows, neighbors.ravel())),
+                                  shape=(n, n))
+    shared = (indicator @ indicator.T).tocoo()
+    jaccard = shared.data / (2 * k - shared.data)
+    keep = jaccard >= prune
+    return sparse.csr_matrix((jaccard[keep], (shared.row[keep],
+                                              shared.col[keep])),
+                             shape=(n, n))
+
+
+def _local_moving(graph, resolution, rng, max_passes=20,
+                  n_batches=LOUVAIN_BATCHES):
+    """Move nodes between communities while modularity increases
+
+    Nodes are visited in random batches. The gains of moving every node of a
+    batch to each neighboring community come from sparse products, and the
+    nodes of a batch move together, before the community totals are updated
+    for the next batch.
+    """
+    n = graph.shape[0]
+    degrees = np.asarray(graph.sum(axis=1)).ravel()
+    two_m = degrees.sum()
+    communities = np.arange(n)
+    totals = degrees.copy()
+    improved = False
+
+    for _ in range(max_passes):
+        moved = 0
+        for batch in np.array_split(rng.permutation(n), min(n, n_batches)):
+            rows = graph[batch].tocoo()
+            not_self = rows.col != batch[rows.row]
+            # Weight from each node of the batch to each community
+            links = sparse.csr_matrix(
+                (rows.data[not_self],
+                 (rows.row[not_self], communities[rows.col[not_self]])),
+                shape=(len(batch), n))
+            links.sum_duplicates()
+            link_rows = np.repeat(np.arange(len(batch)), np.diff(links.indptr))
+            link_communities = links.indices
+
+            current = communities[batch]
+            k = degrees[batch]
+            # Totals of the communities without the nodes being moved
+            totals_without = totals[link_communities] - \
+                k[link_rows] * (link_communities == current[link_rows])
+            gains = links.data - resolution * totals_without * \
+                k[link_rows] / two_m
+            in_current = link_communities == current[link_rows]
+            current_gain = -resolution * (totals[current] - k) * k / two_m
+            current_gain[link_rows[in_current]] += links.data[in_current]
+
+            # Best community of each node, the first row entry after sorting
+            order = np.lexsort((-gains, link_rows))
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = link_rows[order][1:] != link_rows[order][:-1]
+            best_rows = link_rows[order][first]
+            best_gain = gains[order][first]
+            moving = best_gain > current_gain[best_rows] + 1e-12
+            best_rows = best_rows[moving]
+            if not len(best_rows):
+                continue
+
+            nodes = batch[best_rows]
+            targets = link_communities[order][first][moving]
+            totals -= np.bincount(communities[nodes], degrees[nodes],
+                                  minlength=n)
+            totals += np.bincount(targets, degrees[nodes], minlength=n)
+            communities[nodes] = targets
+            moved += len(nodes)
+        if moved == 0:
+            break
+        improved = True
+    return communities, improved
+
+
+def louvain(graph, resolution=1.0, seed=0, max_levels=10):
+    """Louvain modularity clustering of a weighted undirected graph
+
+    Clusters are numbered from the largest, starting at 0, like Seurat idents
+    """
+    rng = np.random.default_rng(seed)
+    graph = sparse.csr_matrix(graph)
+    membership = np.arange(graph.shape[0])
+
+    for _ in range(max_levels):
+        communities, improved = _local_moving(graph, resolution, rng)
+        if not improved:
+            break
+        _, communities = np.unique(communities, return_inverse=True)
+        membership = communities[membership]
+        # Collapse each community into a single node
+        n_communities = communities.max() + 1
+        aggregate = sparse.csr_matrix(
+            (np.ones(len(communities)), (np.arange(len(communities)),
+                                         communities)),
+            shape=(len(communities), n_communities))
+        graph = (aggregate.T @ graph @ aggregate).tocsr()
+
+    sizes = np.bincount(membership)
+    rank = np.empty(len(sizes), dtype=int)
+    rank[np.argsort(-sizes, kind='stable')] = np.arange(len(sizes))
+    return rank[membership]
+
+
+def tsne(embeddings, perplexity=30, seed=TSNE_SEED):
+    perplexity = min(perplexity, (len(embeddings) - 1) / 3)
+    return TSNE(n_components=2, perplexity=perplexity, init='pca',
+                random_state=seed).fit_transform(embeddings)
+
+
+def variable_gene_pcs(normalized, n_pcs, seed=0):
+    """PCA cell embeddings on the scaled variable genes"""
+    variable = find_variable_genes(normalized)
+    return randomized_pca(scale(normalized[:, variable]), n_pcs, seed)
+
+
+def find_clusters(pcs, n_pcs, resolution, k=K_PARAM, seed=0):
+    """Louvain clusters of the SNN graph on the first ``n_pcs`` PCs"""
+    graph = snn_graph(knn(pcs[:, :n_pcs], k))
+    return louvain(graph, resolution, seed)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3.6
+# coding: utf-8
+
+# An index of the FACS cell names, e.g. A12.D041914.3_8_M.1.1, which are the
+# well, plate barcode, mouse id (age_number_sex) and a replicate suffix. The
+# names are parsed once into small integer codes per field and every cell gets
+# an integer id, its position in cell_order_FACS.txt. Tables keyed by cell
+# name (the tissue annotation csvs, *_nreads_ngenes.csv and tsne_facs.csv) are
+# looked up in a hash table once, and from then on are joined, filtered by
+# plate, mouse, sex or well and put in cell_order_FACS.txt order with integer
+# array operations instead of splitting and comparing strings.
+#
+# Usage:
+#   ../utilities/facs_cell_index.py --tissue Liver --mouse 3_8_M \
+#       --output liver_3_8_M.csv
+
+import os
+
+import click
+import numpy as np
+import pandas as pd
+
+import raw_counts
+
+CELL_ORDER = raw_counts.here('00_data_ingest', 'cell_order_FACS.txt')
+NREADS_DIR = raw_counts.here('00_data_ingest', '13_ngenes_ncells_facs')
+GLOBAL_TSNE = raw_counts.here('00_data_ingest', '18_global_annotation_csv',
+                              'tsne_facs.csv')
+# The replicate suffix is "1.1" for most cells, and "1" for a few plates
+CELL_PATTERN = (r'^(?P<well>[A-P]\d+)\.(?P<plate>[^.]+)\.'
+                r'(?P<mouse>\d+_\d+_(?P<sex>[MF]))\.(?P<replicate>\d+(?:\.\d+)*)$')
+FIELDS = ('well', 'plate', 'mouse', 'sex', 'replicate')
+
+
+def smallest_int(n_levels):
+    """The smallest signed integer type that holds codes up to n_levels"""
+    for dtype in (np.int8, np.int16, np.int32):
+        if n_levels <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def parse_cell_names(names):
+    """Codes and levels of the fields of FACS cell names
+
+    Returns {field: codes} and {field: levels}, where levels are sorted and
+    ``levels[field][codes[field]]`` gives back the field of every cell.
+    """
+    names = pd.Index(names)
+    parts = names.to_series().str.extract(CELL_PATTERN)
+    invalid = parts['well'].isnull().values
+    if invalid.any():
+        raise ValueError(f'{invalid.sum()} cells are not named like FACS '
+                         f'cells, e.g. {names[invalid][0]}')
+    codes = {}
+    levels = {}
+    for field in FIELDS:
+        field_codes, field_levels = pd.factorize(parts[field].values,
+                                                 sort=True)
+        codes[field] = field_codes.astype(smallest_int(len(field_levels)))
+        levels[field] = pd.Index(field_levels)
+    return codes, levels
+
+
+class FacsCellIndex:
+    """Interned FACS cell names with their fields as integer codes
+
+    A cell's id is its position in ``names``, by default the order of
+    cell_order_FACS.txt. ``codes[field]`` has the code of every cell for each
+    of FIELDS, indexing into ``levels[field]``. ``names`` is a pandas Index,
+    whose hash table gives the ids of names.
+    """
+
+    def __init__(self, names):
+        self.names = pd.Index(names, name='cell')
+        if not self.names.is_unique:
+            duplicated = self.names[self.names.duplicated()]
+            raise ValueError(f'{duplicated[0]} is in the index twice')
+        self.codes, self.levels = parse_cell_names(self.names)
+
+    @classmethod
+    def from_cell_order(cls, filename=CELL_ORDER):
+        with open(filename) as f:
+            return cls([x.strip().strip('"') for x in f if x.strip()])
+
+    def __len__(self):
+        return len(self.names)
+
+    def ids(self, names):
+        """Ids of cell names, with -1 for names not in the index"""
+        return self.names.get_indexer(names)
+
+    def field_codes(self, field, values):
+        """Codes of values of a field, e.g. of plates ["D041914"]"""
+        if field not in FIELDS:
+            raise KeyError(f'field must be one of {FIELDS}, not "{field}"')
+        codes = self.levels[field].get_indexer(values)
+        if (codes < 0).any():
+            missing = np.asarray(values)[codes < 0]
+            raise KeyError(f'No cell has {field} {missing[0]}')
+        return codes
+
+    def select(self, **where):
+        """Ids of the cells with any of the given values of each field
+
+        e.g. select(plate='D041914', sex='F') or select(mouse=['3_8_M',
+        '3_9_M']).
+        """
+        keep = np.ones(len(self), dtype=bool)
+        for field, values in where.items():
+            if isinstance(values, str):
+                values = [values]
+            keep &= np.isin(self.codes[field], self.field_codes(field, values))
+        return np.flatnonzero(keep)
+
+    def fields(self, ids=None):
+        """The fields of cells as strings, in a dataframe indexed by name"""
+        ids = np.arange(len(self)) if ids is None else np.asarray(ids)
+        return pd.DataFrame(
+            {field: self.levels[field][self.codes[field][ids]]
+             for field in FIELDS},
+            index=self.names[ids])
+
+    def by_id(self, table):
+        """A table indexed by cell name, re-indexed by cell id
+
+        Rows are sorted by id, i.e. in the order of the index, and rows of
+        cells that are not in the index are dropped.
+        """
+        ids = self.ids(table.index)
+        keep = ids >= 0
+        table = table.iloc[np.flatnonzero(keep)]
+        table.index = pd.Index(ids[keep], name='cell_id')
+        return table.sort_index()
+
+    def by_name(self, table):
+        """A table indexed by cell id, re-indexed by cell name"""
+        table = table.copy()
+        table.index = self.names[table.index.values]
+        return table
+
+
+def read_nreads_ngenes(tissue, folder=NREADS_DIR):
+    filename = os.path.join(folder, f'{tissue}_nreads_ngenes.csv')
+    table = pd.read_csv(filename, index_col=0)
+    return table.drop(columns=['orig.ident'], errors='ignore')
+
+
+def read_global_tsne(filename=GLOBAL_TSNE):
+    """tSNE and cluster of the whole-atlas FACS analysis
+
+    Columns are renamed global_*, so they are not confused with the tissue
+    tSNE of the annotation csvs.
+    """
+    table = pd.read_csv(filename, index_col='cell')
+    return table.rename(columns=lambda x: 'global_' + x)
+
+
+def read_facs_tables(index, tissues=None, ids=None):
+    """Annotation, nreads_ngenes and global tSNE of the annotated FACS cells
+
+    All tables are indexed by cell id and joined on it, starting from the
+    annotations, so cells without an annotation are left out. If ``ids`` is
+    given, only those cells are kept.
+    """
+    tables = []
+    for tissue in tissues or raw_counts.annotated_tissues('facs'):
+        annotation = index.by_id(raw_counts.read_annotation(tissue, 'facs'))
+        if os.path.exists(os.path.join(NREADS_DIR,
+                                       f'{tissue}_nreads_ngenes.csv')):
+            annotation = annotation.join(
+                index.by_id(read_nreads_ngenes(tissue, NREADS_DIR)),
+                how='left')
+        tables.append(annotation)
+    table = pd.concat(tables, sort=False)
+    if ids is not None:
+        table = table.loc[table.index.isin(ids)]
+    if os.path.exists(GLOBAL_TSNE):
+        table = table.join(index.by_id(read_global_tsne(GLOBAL_TSNE)),
+                           how='left')
+    return table.sort_index()
+
+
+@click.command()
+@click.option('--cell-order', default=CELL_ORDER)
+@click.option('--tissue', multiple=True, help='Tissues (default: all)')
+@click.option('--plate', multiple=True, help='Plate barcodes, e.g. D041914')
+@click.option('--mouse', multiple=True, help='Mouse ids, e.g. 3_8_M')
+@click.option('--sex', multiple=True, type=click.Choice(('M', 'F')))
+@click.option('--well', multiple=True, help='Wells, e.g. A12')
+@click.option('--output', default='facs_cells.csv')
+def cli(cell_order, tissue, plate, mouse, sex, well, output):
+    """Join the per-cell FACS tables, in the order of cell_order_FACS.txt"""
+    index = FacsCellIndex.from_cell_order(cell_order)
+    where = {field: values for field, values in
+             (('plate', plate), ('mouse', mouse), ('sex', sex),
+              ('well', well)) if values}
+    ids = index.select(**where) if where else None
+    table = read_facs_tables(index, tissues=tissue or None, ids=ids)
+    table = index.fields(table.index).join(index.by_name(table))
+    table.to_csv(output)
+    click.echo(f'Wrote {output}: {len(table)} of {len(index)} cells, from '
+               f'{table["plate"].nunique()} plates and '
+               f'{table["mouse"].nunique()} mice')
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3.6
+# coding: utf-8
+
+# Score many gene sets per cell at once. All sets are compiled into a sparse
+# genes x sets indicator matrix, so every set's fraction of counts and number
+# of detected genes comes out of one sparse product per tissue instead of a
+# colSums per set. Tissues are scored in parallel and joined to the
+# annotations.
+#
+# Usage: gene_set_scores.py [--gene-sets gene_sets.yaml] [--method facs]
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+import click
+import numpy as np
+import pandas as pd
+from scipy import sparse
+import yaml
+
+import raw_counts
+
+GENE_SETS_YAML = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'gene_sets.yaml')
+GENES = 'GENES'
+PATTERN = 'PATTERN'
+FILE = 'FILE'
+COLUMN = 'COLUMN'
+
+
+def read_gene_sets(gene_sets_yaml=GENE_SETS_YAML):
+    """Read set definitions into {name: (genes, pattern)}
+
+    Genes listed in a file are read here, but patterns are only matched
+    once the genes of a tissue are known.
+    """
+    with open(gene_sets_yaml) as f:
+        definitions = yaml.safe_load(f)
+
+    gene_sets = {}
+    for name, definition in definitions.items():
+        genes = list(definition.get(GENES, []))
+        if FILE in definition:
+            table = pd.read_csv(raw_counts.here(definition[FILE]))
+            column = table[definition.get(COLUMN, table.columns[0])]
+            genes.extend(column.dropna().astype(str).unique())
+        pattern = definition.get(PATTERN)
+        if not genes and pattern is None:
+            raise ValueError(f'Gene set "{name}" needs {GENES}, {PATTERN} '
+                             f'or {FILE}')
+        gene_sets[name] = (genes, pattern)
+    return gene_sets
+
+
+def indicator_matrix(genes, gene_sets):
+    """Sparse genes x sets matrix with a 1 where a gene is in a set"""
+    genes = pd.Index(genes)
+    rows = []
+    cols = []
+    for j, (members, pattern) in enumerate(gene_sets.values()):
+        in_set = genes.isin(members)
+        if pattern is not None:
+            in_set |= np.asarray(genes.str.contains(pattern, regex=True))
+        positions = np.flatnonzero(in_set)
+        rows.append(positions)
+        cols.append(np.full(len(positions), j))
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    data = np.ones(len(rows), dtype=np.float32)
+    return sparse.csc_matrix((data, (rows, cols)),
+                             shape=(len(genes), len(gene_sets)))
+
+
+def score(counts, gene_sets):
+    """Fraction of counts and number of detected genes of every set
+
+    Fractions are of all non-ERCC counts of a cell, except for sets containing
+    ERCC spike-ins which use all counts, as percent.ercc does in boilerplate.R
+    """
+    indicator = indicator_matrix(counts.genes, gene_sets)
+    set_counts = np.asarray((counts.matrix @ indicator).todense())
+    detected = counts.matrix.copy()
+    detected.data = (detected.data > 0).astype(np.float32)
+    set_detected = np.asarray((detected @ indicator).todense())
+
+    is_ercc = np.asarray(counts.genes.str.contains(raw_counts.ERCC_PATTERN))
+    totals = np.asarray(counts.matrix.sum(axis=1)).ravel()
+    ercc_totals = np.asarray(counts.matrix[:, is_ercc].sum(axis=1)).ravel()
+    has_ercc = np.asarray(indicator[is_ercc].sum(axis=0)).ravel() > 0
+    denominators = np.where(has_ercc[None, :], totals[:, None],
+                            (totals - ercc_totals)[:, None])
+    fractions = np.divide(set_counts, denominators,
+                          out=np.zeros(set_counts.shape),
+                          where=denominators > 0)
+
+    names = list(gene_sets)
+    scores = pd.DataFrame(fractions, index=counts.cells,
+                          columns=['percent.' + x for x in names])
+    for j, name in enumerate(names):
+        scores['n_genes.' + name] = set_detected[:, j].astype(int)
+    return scores
+
+
+def score_tissue(tissue, method, gene_sets):
+    annotation = raw_counts.read_annotation(tissue, method)
+    counts = raw_counts.read_counts(tissue, method)
+    counts = raw_counts.subset_cells(counts, annotation.index)
+    scores = score(counts, gene_sets)
+
+    columns = [x for x in raw_counts.ANNOTATION_COLUMNS
+               if x in annotation.columns]
+    scored = annotation[columns].join(scores)
+    scored.insert(0, 'method', method)
+    return scored
+
+
+@click.command()
+@click.option('--gene-sets', 'gene_sets_yaml', default=GENE_SETS_YAML)
+@click.option('--method', default='all',
+              type=click.Choice(('all',) + raw_counts.METHODS))
+@click.option('--tissue', default=None, multiple=True,
+              help='Only score these tissues (default: all annotated)')
+@click.option('--output', default='gene_set_scores.csv')
+@click.option('--jobs', '-j', default=os.cpu_count())
+def cli(gene_sets_yaml, method, tissue, output, jobs):
+    """Score every gene set of GENE_SETS for each annotated cell"""
+    gene_sets = read_gene_sets(gene_sets_yaml)
+    methods = raw_counts.METHODS if method == 'all' else (method,)
+    jobs_args = [(t, m) for m in methods
+                 for t in (tissue or raw_counts.annotated_tissues(m))]
+    click.echo(f'Scoring {len(gene_sets)} gene sets in '
+               f'{len(jobs_args)} tissues')
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(score_tissue, t, m, gene_sets)
+                   for t, m in jobs_args]
+        tables = []
+        for (t, m), future in zip(jobs_args, futures):
+            tables.append(future.result())
+            click.echo(f'\t{t} {m}: {len(tables[-1])} cells')
+
+    scores = pd.concat(tables)
+    scores.index.name = 'cell'
+    scores.to_csv(output)
+
+
+if __name__ == "__main__":
+    cli()
@@ -28,6 +28,10 @@ NPCS = "NPCS"
 GENES = "GENES"
 GROUPBY = "GROUPBY"
 CODE_FOLDER = '29_tissue-specific_supplement_code'
+OPTIPNG = '-o7'
+# optipng option of an R chunk header, e.g. ```{r use-optipng, optipng='-o7'}
+OPTIPNG_CHUNK_OPTION = re.compile(
+    r"^(```\{r[^}\n]*?)(?:,\s*|\s+)optipng\s*=\s*'[^']*'", re.MULTILINE)
 
 DEFAULTS = {'res': 0.5, 'npcs': 20, 'genes': ['Actb'], 'groupby': None,
             'perplexity': 30}
@@ -46,16 +50,23 @@ def clean_name(name):
     return name
 
 
-def code_to_codeblock(code):
+def code_to_codeblock(code, optipng=True):
+    """R chunk of code, whose figures knitr optimizes with optipng if asked"""
+    options = f" optipng='{OPTIPNG}'" if optipng else ''
     return f'''
-```{{r optipng='-o7'}}
+```{{r{options}}}
 {code}
 ```
 '''
 
 
+def remove_optipng(rmarkdown):
+    """Remove the optipng option of all chunks, e.g. those of the template"""
+    return OPTIPNG_CHUNK_OPTION.sub(r'\1', rmarkdown)
+
+
 def add_subset(subset, method, filter_column, filter_value, res, npcs, genes,
-               groupby, perplexity, name=None):
+               groupby, perplexity, name=None, optipng=True):
     """Add R code blocks for subsetting and reclustering"""
     subset = clean_name(subset)
 
@@ -76,7 +87,7 @@ def add_subset(subset, method, filter_column, filter_value, res, npcs, genes,
 
     rmarkdown += code_to_codeblock(f'''in_{subset} = tiss@meta.data${filter_column} == {filter_value}
 in_{subset}[is.na(in_{subset})] = FALSE
-''')
+''', optipng)
 
     rmarkdown += code_to_codeblock(f"""{subset}.cells.use = tiss@cell.names[in_{subset}]
 write(paste("Number of cells in {subset} subset:", length({subset}.cells.use)), stderr())
@@ -92,11 +103,12 @@ write(paste("Number of cells in {subset} subset:", length({subset}.cells.use)),
 {subset}.tiss <- {subset}.tiss %>% FindClusters(reduction.type = "pca", dims.use = 1:{subset}.n.pcs, 
     resolution = {subset}.res.use, print.output = 0, save.SNN = TRUE) %>%
     RunTSNE(dims.use = 1:{subset}.n.pcs, seed.use = 10, perplexity={subset}.perplexity)
-""")
+""", optipng)
     if groupby is not None:
         # Append this subset's groupby to the list
         rmarkdown += "\n### Append this subset's groupby to the list"
-        rmarkdown += code_to_codeblock(f'group.bys = c(group.bys, {stringify_list([groupby])})')
+        rmarkdown += code_to_codeblock(f'group.bys = c(group.bys, {stringify_list([groupby])})',
+                                       optipng)
 
     rmarkdown += '\n### Highlight which cells are in this subset'
     rmarkdown += code_to_codeblock(f'''colors.use = c('LightGray', 'Coral')
@@ -137,7 +149,7 @@ ggdraw()
 ggdraw(g_legend(p))
 ggsave(filename, width = 8, height = 4)
 dev.off()
-''')
+''', optipng)
 
     prefix = subset
     if name is not None:
@@ -147,7 +159,7 @@ dev.off()
     rmarkdown += code_to_codeblock(f'''dot_tsne_ridge({subset}.tiss, {subset}.genes_to_check,
     save_folder, prefix = "{prefix}", group.bys = {subset}.group.bys, 
     "{method}")
-''')
+''', optipng)
 
     return rmarkdown
 
@@ -156,13 +168,16 @@ dev.off()
 @click.argument('parameters_yaml')
 @click.option('--template-file', default='Template.Rmd')
 @click.option('--suffix', default='_template.Rmd')
+@click.option('--optipng/--no-optipng', default=True,
+              help='Optimize the figures with optipng while knitting, or '
+                   'leave them to optimize_pngs.py after rendering')
 def main(parameters_yaml, template_file='Template.Rmd',
-         suffix='_template.Rmd'):
+         suffix='_template.Rmd', optipng=True):
     print(parameters_yaml)
     # print command line arguments
 
     with open(parameters_yaml) as f:
-        parameters = yaml.load(f)
+        parameters = yaml.load(f, Loader=yaml.SafeLoader)
 
     tissue = parameters[TISSUE]
     method = parameters[METHOD]
@@ -189,7 +204,7 @@ def main(parameters_yaml, template_file='Template.Rmd',
                     kv.setdefault(k, v)
 
 
-                subset_code = add_subset(name, method, **kv)
+                subset_code = add_subset(name, method, **kv, optipng=optipng)
                 template += f'\n## Subset: {name}\n\n{subset_code}'
 
 
@@ -206,6 +221,9 @@ def main(parameters_yaml, template_file='Template.Rmd',
         template = template.replace('{' + ADDITIONAL_CODE + '}',
                                     '# No additional code')
 
+    if not optipng:
+        template = remove_optipng(template)
+
     outfile = parameters[TISSUE] + "_" + parameters[METHOD] + suffix
     with open(outfile, 'w') as f:
         f.write(template)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3.6
+# coding: utf-8
+
+# Transfer Tabula Muris cell ontology classes onto the Han et al. (2018)
+# Microwell-seq cells listed in 00_data_ingest/han_data/han_metadata.csv.
+#
+# For each tissue, a reference index holds the scaling and PCA loadings of
+# the tissue's variable genes and the PCA embedding and class of every
+# annotated cell. The GSM*_dge.txt files (genes x cells) are read a block of
+# genes at a time into a sparse matrix, normalized like the reference,
+# projected onto the reference PCs and labeled by their k nearest reference
+# cells, a batch of query cells at a time. The confidence of a label is the
+# distance-weighted share of neighbors with that class.
+#
+# Usage (from 00_data_ingest/han_data):
+#   ../../utilities/han_label_transfer.py build-index
+#   ../../utilities/han_label_transfer.py transfer --tissue Bladder
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+import click
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.neighbors import NearestNeighbors
+
+import clustering
+import raw_counts
+
+HAN_DIR = raw_counts.here('00_data_ingest', 'han_data')
+HAN_METADATA = os.path.join(HAN_DIR, 'han_metadata.csv')
+INDEX_DIR = 'reference_index'
+# Microwell-seq counts UMIs, like the droplet data
+METHOD = 'droplet'
+N_PCS = 30
+K = 15
+# Number of genes (rows) of a DGE file to parse at a time
+CHUNKSIZE = 2000
+# Number of query cells to look up at a time
+BATCH_SIZE = 5000
+SEED = 0
+
+
+def index_filename(index_dir, tissue, method):
+    return os.path.join(index_dir, f'{tissue}_{method}_reference.npz')
+
+
+def build_reference(tissue, method=METHOD, n_pcs=N_PCS, seed=SEED):
+    """Variable genes, their scaling and PCA of an annotated tissue"""
+    counts, annotation = raw_counts.read_annotated_counts(tissue, method)
+    normalized = raw_counts.log_normalize(
+        counts.matrix, raw_counts.SCALE_FACTORS[method],
+        totals=annotation['n_counts'].values)
+    has_class = annotation['cell_ontology_class'].notnull().values
+    normalized = normalized[has_class]
+
+    variable = clustering.find_variable_genes(normalized)
+    dense = np.asarray(normalized[:, variable].todense())
+    mean = dense.mean(axis=0)
+    std = dense.std(axis=0, ddof=1)
+    std[std == 0] = 1
+    scaled = np.clip((dense - mean) / std, -clustering.SCALE_MAX,
+                     clustering.SCALE_MAX)
+    embedding, loadings = clustering.fit_pca(scaled, n_pcs, seed)
+    return {'genes': np.asarray(counts.genes[variable], dtype=str),
+            'mean': mean, 'std': std, 'loadings': loadings,
+            'embedding': embedding,
+            'classes': np.asarray(annotation['cell_ontology_class']
+                                  .values[has_class], dtype=str)}
+
+
+def save_reference(filename, tissue, method=METHOD, n_pcs=N_PCS, seed=SEED):
+    reference = build_reference(tissue, method, n_pcs, seed)
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    np.savez_compressed(filename, **reference)
+    return filename, len(reference['classes']), len(reference['genes'])
+
+
+def load_reference(filename):
+    with np.load(filename, allow_pickle=False) as npz:
+        return {key: npz[key] for key in npz.files}
+
+
+def read_dge(filename, chunksize=CHUNKSIZE):
+    """Read a Han et al. genes x cells DGE table into raw_counts.Counts
+
+    The header has one name per cell, and every row starts with the gene.
+    """
+    with open(filename) as f:
+        header = next(f).split()
+        first = next(f).split()
+    cells = [x.strip('"') for x in header]
+    if len(header) == len(first):
+        # The header also names the gene column
+        cells = cells[1:]
+
+    blocks = []
+    genes = []
+    for chunk in pd.read_csv(filename, sep=r'\s+', skiprows=1, header=None,
+                             index_col=0, chunksize=chunksize):
+        genes.extend(str(x).strip('"') for x in chunk.index)
+        blocks.append(sparse.csr_matrix(chunk.values.astype(np.float32)))
+    matrix = sparse.vstack(blocks).T.tocsr()
+    return raw_counts.Counts(matrix, pd.Index(cells), pd.Index(genes))
+
+
+def project(counts, reference, method=METHOD):
+    """Query cells in the PCA space of the reference"""
+    normalized = raw_counts.log_normalize(counts.matrix,
+                                          raw_counts.SCALE_FACTORS[method])
+    # Genes the query did not measure get the reference mean, which scales
+    # to 0 and so does not move the cell along any PC
+    positions = counts.genes.get_indexer(reference['genes'])
+    measured = positions >= 0
+    scaled = np.zeros((counts.matrix.shape[0], len(reference['genes'])))
+    scaled[:, measured] = np.asarray(
+        normalized[:, positions[measured]].todense())
+    scaled[:, measured] = (scaled[:, measured] - reference['mean'][measured]) \
+        / reference['std'][measured]
+    np.clip(scaled, -clustering.SCALE_MAX, clustering.SCALE_MAX, out=scaled)
+    return scaled @ reference['loadings'].T
+
+
+def transfer(counts, reference, index, k=K, batch_size=BATCH_SIZE,
+             method=METHOD):
+    """Predicted class and confidence of every query cell"""
+    codes, labels = pd.factorize(reference['classes'], sort=True)
+    k = min(k, len(codes))
+    predicted = []
+    confidence = []
+    for start in range(0, len(counts.cells), batch_size):
+        batch = raw_counts.Counts(counts.matrix[start:start + batch_size],
+                                  counts.cells[start:start + batch_size],
+                                  counts.genes)
+        embedding = project(batch, reference, method)
+        distances, neighbors = index.kneighbors(embedding, n_neighbors=k)
+        # Closer neighbors get a larger vote
+        weights = 1 / (distances + 1e-6)
+        votes = np.zeros((len(embedding), len(labels)))
+        np.add.at(votes, (np.repeat(np.arange(len(embedding)), k),
+                          codes[neighbors].ravel()), weights.ravel())
+        best = votes.argmax(axis=1)
+        predicted.append(labels[best])
+        confidence.append(votes[np.arange(len(best)), best] /
+                          votes.sum(axis=1))
+    return pd.DataFrame({'cell_ontology_class': np.concatenate(predicted),
+                         'confidence': np.concatenate(confidence)},
+                        index=counts.cells)
+
+
+def transfer_file(dge, tissue, subtissue, reference_filename, k=K,
+                  batch_size=BATCH_SIZE, method=METHOD):
+    reference = load_reference(reference_filename)
+    index = NearestNeighbors().fit(reference['embedding'])
+    counts = read_dge(os.path.join(HAN_DIR, dge))
+    predictions = transfer(counts, reference, index, k, batch_size, method)
+    predictions.index.name = 'cell'
+    predictions.insert(0, 'filename', dge)
+    predictions.insert(1, 'tissue', tissue)
+    predictions.insert(2, 'subtissue', subtissue)
+    predictions['nGene'] = np.diff(counts.matrix.indptr)
+    # Reference genes missing from the query make the mapping less reliable
+    predictions['fraction_reference_genes'] = \
+        pd.Index(reference['genes']).isin(counts.genes).mean()
+    return predictions
+
+
+def comparable_files(metadata_csv=HAN_METADATA, tissues=None):
+    """Han et al. files of tissues that are in Tabula Muris"""
+    metadata = pd.read_csv(metadata_csv)
+    metadata = metadata.loc[metadata['tissue'].notnull()].copy()
+    # e.g. "Limb Muscle" is Limb_Muscle here
+    metadata['tissue'] = metadata['tissue'].str.replace(' ', '_')
+    if tissues:
+        metadata = metadata.loc[metadata['tissue'].isin(tissues)]
+    return metadata
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command('build-index')
+@click.option('--tissue', multiple=True,
+              help='Tissues to index (default: all tissues in Han et al.)')
+@click.option('--method', default=METHOD,
+              type=click.Choice(raw_counts.METHODS))
+@click.option('--index-dir', default=INDEX_DIR)
+@click.option('--n-pcs', default=N_PCS)
+@click.option('--jobs', '-j', default=os.cpu_count())
+def build_index(tissue, method, index_dir, n_pcs, jobs):
+    """Save the reference PCA of every tissue to map onto"""
+    tissues = tissue or comparable_files()['tissue'].unique()
+    annotated = set(raw_counts.annotated_tissues(method))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = []
+        for t in tissues:
+            if t not in annotated:
+                click.echo(f'\t{t}: no {method} annotation, skipping')
+                continue
+            futures.append(executor.submit(
+                save_reference, index_filename(index_dir, t, method), t,
+                method, n_pcs))
+        for future in futures:
+            filename, n_cells, n_genes = future.result()
+            click.echo(f'\t{filename}: {n_cells} cells, {n_genes} genes')
+
+
+@cli.command('transfer')
+@click.option('--tissue', multiple=True,
+              help='Tissues to map (default: all tissues in Han et al.)')
+@click.option('--method', default=METHOD,
+              type=click.Choice(raw_counts.METHODS))
+@click.option('--index-dir', default=INDEX_DIR)
+@click.option('--k', default=K, help='Number of neighbors voting')
+@click.option('--batch-size', default=BATCH_SIZE)
+@click.option('--output', default='han_label_transfer.csv')
+@click.option('--jobs', '-j', default=os.cpu_count())
+def transfer_cli(tissue, method, index_dir, k, batch_size, output, jobs):
+    """Label every Han et al. cell with its closest Tabula Muris class"""
+    metadata = comparable_files(tissues=tissue)
+    jobs_args = []
+    for _, row in metadata.iterrows():
+        filename = index_filename(index_dir, row['tissue'], method)
+        if not os.path.exists(filename):
+            click.echo(f'\t{row["filename"]}: no reference index for '
+                       f'{row["tissue"]}, skipping (run build-index)')
+            continue
+        jobs_args.append((row['filename'], row['tissue'], row['subtissue'],
+                          filename))
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(transfer_file, *args, k, batch_size, method)
+                   for args in jobs_args]
+        tables = []
+        for args, future in zip(jobs_args, futures):
+            tables.append(future.result())
+            median = tables[-1]['confidence'].median()
+            click.echo(f'\t{args[0]}: {len(tables[-1])} cells, median '
+                       f'confidence {median:.2f}')
+
+    predictions = pd.concat(tables)
+    predictions.to_csv(output)
+    summary = predictions.groupby(['tissue', 'cell_ontology_class'])[
+        'confidence'].agg(['size', 'median'])
+    summary.columns = ['n_cells', 'median_confidence']
+    summary.to_csv(os.path.splitext(output)[0] + '_summary.csv')
+    click.echo(f'Wrote {output} ({len(predictions)} cells)')
+
+
+if __name__ == "__main__":
+    cli()
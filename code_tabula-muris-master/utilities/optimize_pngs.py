@@ -0,0 +1,200 @@
+#!/usr/bin/env python3.6
+# coding: utf-8
+
+# Optimize the PNGs of rendered notebooks with optipng after rendering, instead
+# of through knitr's optipng hook, which runs on every figure one at a time
+# inside the render. Takes PNG files and html files, whose embedded base64
+# PNGs (the figures of a self-contained html_notebook) are optimized in place.
+#
+# Every image is identified by the sha256 of its bytes. Each distinct image
+# that is not in the cache yet is optimized once, in a process pool, and the
+# result is stored in the cache under the digest of both the original and the
+# optimized image. Identical images, images optimized by an earlier run and
+# images that are already optimized are therefore never optimized again.
+# Files are then rewritten atomically and the bytes saved are reported.
+#
+# Usage (from 30_tissue_supplement_figures):
+#   make rmd OPTIPNG=--no-optipng run_rmd
+#   ../utilities/optimize_pngs.py --jobs 32 .
+
+import base64
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+import click
+
+from atomic import write_atomic
+import raw_counts
+
+CACHE_DIR = raw_counts.here('.png_cache')
+# knitr's optipng hook is used with -o7 in Template.Rmd
+LEVEL = 7
+DATA_URI = re.compile(rb'data:image/png;base64,([A-Za-z0-9+/=]+)')
+EXTENSIONS = ('.png', '.html')
+
+
+def find_files(paths, exclude):
+    """PNG and html files of the paths, searching folders recursively"""
+    exclude = os.path.abspath(exclude)
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+            continue
+        for folder, folders, filenames in os.walk(path):
+            folders[:] = sorted(x for x in folders if os.path.abspath(
+                os.path.join(folder, x)) != exclude)
+            for filename in sorted(filenames):
+                if filename.endswith(EXTENSIONS):
+                    yield os.path.join(folder, filename)
+
+
+def read_images(filename):
+    """Bytes of a PNG file, or of every PNG embedded in an html file"""
+    with open(filename, 'rb') as f:
+        content = f.read()
+    if filename.endswith('.png'):
+        return [content]
+    return [base64.b64decode(x) for x in DATA_URI.findall(content)]
+
+
+def digest(image):
+    return hashlib.sha256(image).hexdigest()
+
+
+def cache_path(cache_dir, level, image_digest):
+    return os.path.join(cache_dir, f'o{level}', image_digest[:2],
+                        image_digest + '.png')
+
+
+def scan_file(filename):
+    """Digests of the images of a file"""
+    return [digest(x) for x in read_images(filename)]
+
+
+def optipng(image, level=LEVEL, executable='optipng'):
+    """The image optimized by optipng, or itself if that is not smaller"""
+    with tempfile.TemporaryDirectory() as folder:
+        before = os.path.join(folder, 'before.png')
+        after = os.path.join(folder, 'after.png')
+        with open(before, 'wb') as f:
+            f.write(image)
+        subprocess.run([executable, f'-o{level}', '-quiet', '-out', after,
+                        before], check=True, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.PIPE)
+        with open(after, 'rb') as f:
+            optimized = f.read()
+    return optimized if len(optimized) < len(image) else image
+
+
+def optimize_image(image, cache_dir, level=LEVEL, executable='optipng'):
+    """Optimize an image into the cache
+
+    Returns the size of the image before and after.
+    """
+    optimized = optipng(image, level, executable)
+    # An optimized image maps to itself, so it is not optimized again
+    for key in {digest(image), digest(optimized)}:
+        write_atomic(cache_path(cache_dir, level, key), optimized)
+    return len(image), len(optimized)
+
+
+def read_cached(cache_dir, level, image):
+    """The optimized image from the cache, or the image if it is not there"""
+    filename = cache_path(cache_dir, level, digest(image))
+    if not os.path.exists(filename):
+        return image
+    with open(filename, 'rb') as f:
+        optimized = f.read()
+    return optimized if len(optimized) < len(image) else image
+
+
+def rewrite_file(filename, cache_dir, level=LEVEL):
+    """Replace the images of a file by their optimized versions
+
+    Returns the size of the file before and after.
+    """
+    with open(filename, 'rb') as f:
+        content = f.read()
+    if filename.endswith('.png'):
+        rewritten = read_cached(cache_dir, level, content)
+    else:
+        def replace(match):
+            image = base64.b64decode(match.group(1))
+            optimized = read_cached(cache_dir, level, image)
+            if optimized is image:
+                return match.group(0)
+            return b'data:image/png;base64,' + base64.b64encode(optimized)
+        rewritten = DATA_URI.sub(replace, content)
+    if rewritten != content:
+        write_atomic(filename, rewritten)
+    return len(content), len(rewritten)
+
+
+def megabytes(n_bytes):
+    return f'{n_bytes / 1e6:.2f} MB'
+
+
+@click.command()
+@click.argument('paths', nargs=-1, required=True)
+@click.option('--cache-dir', default=CACHE_DIR)
+@click.option('--level', default=LEVEL, help='optipng optimization level')
+@click.option('--optipng', 'executable', default='optipng')
+@click.option('--jobs', '-j', default=os.cpu_count())
+def cli(paths, cache_dir, level, executable, jobs):
+    """Optimize the PNG files, and PNGs embedded in html files, of PATHS"""
+    if shutil.which(executable) is None:
+        raise click.ClickException(f'{executable} not found, install it with '
+                                   f'"conda install -c conda-forge optipng"')
+    filenames = list(find_files(paths, exclude=cache_dir))
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        scans = list(executor.map(scan_file, filenames, chunksize=16))
+
+        # First file and position of each distinct image not in the cache
+        todo = {}
+        for filename, images in zip(filenames, scans):
+            for i, image_digest in enumerate(images):
+                if image_digest not in todo and not os.path.exists(
+                        cache_path(cache_dir, level, image_digest)):
+                    todo[image_digest] = (filename, i)
+        n_images = sum(len(x) for x in scans)
+        n_distinct = len({x for images in scans for x in images})
+        click.echo(f'{n_images} images ({n_distinct} distinct) in '
+                   f'{len(filenames)} files, {len(todo)} to optimize')
+
+        by_file = {}
+        for filename, i in todo.values():
+            by_file.setdefault(filename, []).append(i)
+        # Decode each file once, and optimize its images in parallel
+        futures = []
+        for filename, positions in by_file.items():
+            images = read_images(filename)
+            futures.extend(executor.submit(optimize_image, images[i],
+                                           cache_dir, level, executable)
+                           for i in positions)
+        optimized = [future.result() for future in futures]
+        if optimized:
+            before = sum(x for x, _ in optimized)
+            after = sum(x for _, x in optimized)
+            click.echo(f'Optimized {len(optimized)} images: '
+                       f'{megabytes(before)} -> {megabytes(after)}')
+
+        futures = [executor.submit(rewrite_file, filename, cache_dir, level)
+                   for filename, images in zip(filenames, scans) if images]
+        sizes = [future.result() for future in futures]
+
+    before = sum(x for x, _ in sizes)
+    after = sum(x for _, x in sizes)
+    saved = before - after
+    click.echo(f'Saved {megabytes(saved)} of {megabytes(before)} '
+               f'({100 * saved / max(before, 1):.1f}%) in '
+               f'{sum(x != y for x, y in sizes)} files')
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3.6
+# coding: utf-8
+
+# Sweep the NPCS and RES of a tissue yaml without regenerating and knitting
+# the notebook for every candidate. The PCA is computed once with the largest
+# NPCS, the nearest neighbors of every NPCS prefix come from one pass over
+# the PCs, and each SNN graph is clustered at every resolution. For each
+# setting this reports the number of clusters, the adjusted Rand index (ARI)
+# with the neighboring settings, and the ARI with the cluster.ids and
+# cell_ontology_class of the annotation csv.
+#
+# Usage (from 28_tissue_yamls_for_supplement):
+#   ../utilities/parameter_sweep.py liver_facs.yaml --npcs 5 --npcs 10 ...
+#   ../utilities/parameter_sweep.py marrow_facs.yaml --subset SUBSETA
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+import click
+import numpy as np
+import pandas as pd
+import yaml
+from sklearn.metrics import adjusted_rand_score
+
+import clustering
+import raw_counts
+from generate_from_template import TISSUE, METHOD, DEFAULTS, clean_name
+import subset_preview
+
+NPCS_GRID = (5, 10, 15, 20, 30, 40)
+RES_GRID = (0.25, 0.5, 1, 1.5, 2, 3)
+SEED = 0
+
+
+class TooFewCells(Exception):
+    """A subset has too few cells to cluster"""
+
+    def __init__(self, n_cells):
+        super().__init__(n_cells)
+        self.n_cells = n_cells
+
+
+def read_parameters(parameters_yaml, subset=None):
+    """Tissue, method and the yaml's parameters, or those of one subset"""
+    if subset is None:
+        with open(parameters_yaml) as f:
+            parameters = yaml.safe_load(f)
+        kv = {k.lower(): v for k, v in parameters.items()}
+        for k, v in DEFAULTS.items():
+            kv.setdefault(k, v)
+        return parameters[TISSUE], parameters[METHOD], kv
+    tissue, method, subsets = subset_preview.read_subsets(parameters_yaml)
+    return tissue, method, subsets[subset]
+
+
+def agreement(clusters, labels):
+    """ARI between clusters and the cells' labels, ignoring missing labels"""
+    labels = pd.Series(labels)
+    known = labels.notnull().values
+    if not known.any():
+        return np.nan
+    return adjusted_rand_score(labels.values[known], clusters[known])
+
+
+def sweep(normalized, n_pcs_grid, res_grid, seed=SEED):
+    """Clusters at every (n_pcs, resolution), as {(n_pcs, res): clusters}"""
+    pcs = clustering.variable_gene_pcs(normalized, max(n_pcs_grid), seed)
+    neighbors = clustering.prefix_knn(pcs, n_pcs_grid)
+    results = {}
+    for n_pcs, knn in neighbors.items():
+        graph = clustering.snn_graph(knn)
+        for res in res_grid:
+            results[n_pcs, res] = clustering.louvain(graph, res, seed)
+    return results
+
+
+def sweep_table(results, annotation, label_columns):
+    """One row per setting with cluster counts, stability and agreement"""
+    n_pcs_grid = sorted(set(x for x, _ in results))
+    res_grid = sorted(set(x for _, x in results))
+    rows = []
+    for i, n_pcs in enumerate(n_pcs_grid):
+        for j, res in enumerate(res_grid):
+            clusters = results[n_pcs, res]
+            row = {'npcs': n_pcs, 'res': res,
+                   'n_clusters': len(np.unique(clusters))}
+            # Stability: ARI with the next larger resolution and NPCS
+            row['ari_next_res'] = adjusted_rand_score(
+                clusters, results[n_pcs, res_grid[j + 1]]) \
+                if j + 1 < len(res_grid) else np.nan
+            row['ari_next_npcs'] = adjusted_rand_score(
+                clusters, results[n_pcs_grid[i + 1], res]) \
+                if i + 1 < len(n_pcs_grid) else np.nan
+            for column in label_columns:
+                row['ari_' + column] = agreement(clusters,
+                                                 annotation[column].values)
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def sweep_tissue(parameters_yaml, subset, n_pcs_grid, res_grid, output_dir,
+                 seed=SEED):
+    """Sweep one tissue yaml (or one of its subsets) and write the table
+
+    Returns the filename and the table. Raises TooFewCells if a subset has
+    too few cells to cluster. NPCS larger than the number of PCs are cut to
+    it, with a warning.
+    """
+    tissue, method, kv = read_parameters(parameters_yaml, subset)
+    # Always include the setting currently in the yaml
+    n_pcs_grid = sorted(set(n_pcs_grid) | {kv['npcs']})
+    res_grid = sorted(set(res_grid) | {kv['res']})
+
+    counts, annotation = raw_counts.read_annotated_counts(tissue, method)
+    normalized = raw_counts.log_normalize(
+        counts.matrix, raw_counts.SCALE_FACTORS[method],
+        totals=annotation['n_counts'].values)
+    label_columns = ['cluster.ids', 'cell_ontology_class']
+    if subset is not None:
+        mask = subset_preview.in_subset(annotation, kv['filter_column'],
+                                        kv['filter_value'])
+        normalized, annotation = normalized[mask], annotation[mask]
+        if len(annotation) < subset_preview.MIN_CELLS:
+            raise TooFewCells(len(annotation))
+        column = subset_preview.subset_cluster_column(subset)
+        if column in annotation.columns:
+            label_columns.insert(0, column)
+
+    prefix = f'{tissue}_{method}'
+    if subset is not None:
+        prefix += '_' + clean_name(subset)
+    results = sweep(normalized, n_pcs_grid, res_grid, seed)
+    # prefix_knn cuts the NPCS to the number of PCs that could be computed
+    n_pcs = max(x for x, _ in results)
+    if max(n_pcs_grid) > n_pcs:
+        cut = ', '.join(str(x) for x in n_pcs_grid if x > n_pcs)
+        click.echo(f'	{prefix}: only {n_pcs} PCs, NPCS {cut} swept as '
+                   f'{n_pcs}', err=True)
+    table = sweep_table(results, annotation, label_columns)
+    table.insert(0, 'n_cells', len(annotation))
+    table['in_yaml'] = (table['npcs'] == min(kv['npcs'], n_pcs)) & \
+        (table['res'] == kv['res'])
+
+    filename = os.path.join(output_dir, f'{prefix}_sweep.csv')
+    table.to_csv(filename, index=False)
+    return filename, table
+
+
+@click.command()
+@click.argument('parameters_yamls', nargs=-1, required=True)
+@click.option('--subset', default=None,
+              help='Sweep this SUBSET of the yamls instead of the whole tissue')
+@click.option('--npcs', 'n_pcs_grid', multiple=True, type=int,
+              default=NPCS_GRID)
+@click.option('--res', 'res_grid', multiple=True, type=float,
+              default=RES_GRID)
+@click.option('--output-dir', default='.')
+@click.option('--seed', default=SEED)
+@click.option('--jobs', '-j', default=os.cpu_count())
+def cli(parameters_yamls, subset, n_pcs_grid, res_grid, output_dir, seed,
+        jobs):
+    """Cluster each PARAMETERS_YAML's tissue over a grid of NPCS and RES"""
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(sweep_tissue, x, subset, n_pcs_grid,
+                                   res_grid, output_dir, seed)
+                   for x in parameters_yamls]
+        for parameters_yaml, future in zip(parameters_yamls, futures):
+            try:
+                filename, table = future.result()
+            except TooFewCells as e:
+                click.echo(f'\t{parameters_yaml} {subset}: only {e.n_cells} '
+                           f'cells, skipped')
+                continue
+            click.echo(f'\t{filename}: {len(table)} settings, '
+                       f'{table["n_clusters"].min()}-'
+                       f'{table["n_clusters"].max()} clusters')
+
+
+if __name__ == "__main__":
+    cli()
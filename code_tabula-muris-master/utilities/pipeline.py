@@ -0,0 +1,351 @@
+#!/usr/bin/env python3.6
+# coding: utf-8
+
+# Run the whole tissue pipeline as one dependency graph:
+#
+#   download_data.sh
+#     -> 02_tissue_analysis_rmd/<Tissue>_<method>.Rmd (annotation csv, Robj)
+#          -> 18_global_annotation_csv concat, per method
+#          -> 30_tissue_supplement_figures/<Tissue>_<method>_auto_generated.Rmd,
+#             from generate_from_template.py and its tissue yaml
+#               -> optimize_pngs.py on the rendered notebook
+#               -> generate_tissue_tex.py
+#
+# Every task starts as soon as the tasks it depends on are done, so e.g. the
+# FACS annotations are concatenated and the supplement figures of a tissue
+# are rendered while other tissues' notebooks are still running. The number
+# of tasks running at once is limited per stage class (R, python, download).
+#
+# Finished tasks are recorded in a state file with a signature of their
+# inputs, so an interrupted or partly failed run picks up where it stopped:
+# a task is skipped if its outputs exist and neither its input files nor any
+# upstream task changed since it last succeeded.
+#
+# Usage (from the root of the repository):
+#   utilities/pipeline.py --dry-run
+#   utilities/pipeline.py --tissue Liver --r-jobs 8
+
+import asyncio
+from collections import namedtuple
+import glob
+import hashlib
+import json
+import os
+import time
+
+import click
+import yaml
+
+from atomic import write_atomic
+import raw_counts
+from generate_from_template import TISSUE, METHOD, CODE_FOLDER
+from run_rmds import render_command
+
+STATE_FILE = '.pipeline_state.json'
+LOG_DIR = 'pipeline_logs'
+YAML_DIR = raw_counts.here('28_tissue_yamls_for_supplement')
+NOTEBOOK_DIR = raw_counts.here('00_data_ingest', '02_tissue_analysis_rmd')
+ROBJ_DIR = raw_counts.here('00_data_ingest', '04_tissue_robj_generated')
+GLOBAL_ANNOTATION_DIR = raw_counts.here('00_data_ingest',
+                                        '18_global_annotation_csv')
+FIGURE_DIR = raw_counts.here('30_tissue_supplement_figures')
+CODE_DIR = raw_counts.here(CODE_FOLDER)
+UTILITIES_DIR = raw_counts.here('utilities')
+TEX_DIR = raw_counts.here('31_tissue_supplement_tex')
+
+# Stage classes, which share a limit on the number of running tasks
+DOWNLOAD = 'download'
+R = 'R'
+PYTHON = 'python'
+
+# cwd is where command runs. Files in outputs that are removed before
+# running when clean is True, as some scripts refuse to overwrite them.
+Task = namedtuple('Task', ['name', 'stage', 'command', 'cwd', 'inputs',
+                           'outputs', 'deps', 'clean'])
+
+
+def task(name, stage, command, cwd, inputs=(), outputs=(), deps=(),
+         clean=False):
+    return Task(name, stage, list(command), cwd, list(inputs), list(outputs),
+                list(deps), clean)
+
+
+def tissue_methods(yaml_dir=YAML_DIR):
+    """(tissue, method, yaml) of every tissue yaml"""
+    result = []
+    for filename in sorted(glob.glob(os.path.join(yaml_dir, '*.yaml'))):
+        with open(filename) as f:
+            parameters = yaml.safe_load(f)
+        result.append((parameters[TISSUE], parameters[METHOD], filename))
+    return result
+
+
+def build_tasks(yaml_dir=YAML_DIR, tissues=None):
+    """The tasks of the pipeline, with upstream tasks before downstream ones"""
+    raw_data = [os.path.join(raw_counts.FACS_DIR, 'FACS'),
+                os.path.join(raw_counts.DROPLET_DIR, 'droplet')]
+    tasks = [task('download', DOWNLOAD, ['bash', 'download_data.sh'],
+                  raw_counts.here('00_data_ingest'), outputs=raw_data)]
+
+    notebooks = {m: [] for m in raw_counts.METHODS}
+    figures = []
+    for tissue, method, parameters_yaml in tissue_methods(yaml_dir):
+        if tissues and tissue not in tissues:
+            continue
+        name = f'{tissue}_{method}'
+
+        rmd = os.path.join(NOTEBOOK_DIR, name + '.Rmd')
+        deps = []
+        if os.path.exists(rmd):
+            robj = os.path.join(ROBJ_DIR, f'{method}_{tissue}_seurat_tiss.Robj')
+            tasks.append(task(
+                'notebook:' + name, R, render_command(rmd), NOTEBOOK_DIR,
+                inputs=[rmd, os.path.join(NOTEBOOK_DIR, 'boilerplate.R')],
+                outputs=[raw_counts.annotation_filename(tissue, method), robj],
+                deps=['download']))
+            notebooks[method].append('notebook:' + name)
+            deps.append('notebook:' + name)
+
+        generated = os.path.join(FIGURE_DIR, name + '_auto_generated.Rmd')
+        notebook = generated[:-len('.Rmd')] + '.nb.html'
+        # Figures are optimized after rendering, by the pngs: task
+        tasks.append(task(
+            'template:' + name, PYTHON,
+            ['python', os.path.join('..', 'utilities',
+                                    'generate_from_template.py'),
+             '--suffix', '_auto_generated.Rmd', '--no-optipng',
+             parameters_yaml],
+            FIGURE_DIR,
+            inputs=[parameters_yaml, os.path.join(FIGURE_DIR, 'Template.Rmd'),
+                    os.path.join(UTILITIES_DIR, 'generate_from_template.py'),
+                    os.path.join(CODE_DIR, name + '.Rmd')],
+            outputs=[generated]))
+        tasks.append(task(
+            'figures:' + name, R, render_command(generated), FIGURE_DIR,
+            inputs=[generated,
+                    os.path.join(FIGURE_DIR, 'supplemental_figures.R')],
+            outputs=[notebook], deps=deps + ['template:' + name]))
+        # Tissues are optimized in parallel, so one process each
+        tasks.append(task(
+            'pngs:' + name, PYTHON,
+            ['python', os.path.join('..', 'utilities', 'optimize_pngs.py'),
+             '--jobs', '1', notebook],
+            FIGURE_DIR, outputs=[notebook], deps=['figures:' + name]))
+        figures.append('figures:' + name)
+
+    for method, deps in notebooks.items():
+        if not deps:
+            continue
+        tasks.append(task(
+            'concat:' + method, PYTHON,
+            ['./concat_all_annotations_by_method.py', '--method', method],
+            GLOBAL_ANNOTATION_DIR,
+            outputs=[os.path.join(GLOBAL_ANNOTATION_DIR,
+                                  f'annotations_{method}.csv')],
+            deps=deps, clean=True))
+
+    tasks.append(task('tex', PYTHON, ['python', 'generate_tissue_tex.py'],
+                      TEX_DIR,
+                      outputs=[os.path.join(TEX_DIR, 'tissue_supplement.tex')],
+                      deps=figures))
+    return tasks
+
+
+def file_signature(filename):
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return 'missing'
+    return f'{stat.st_mtime_ns}:{stat.st_size}'
+
+
+def task_signature(task, dep_signatures):
+    """Hash of a task's command, input files and upstream signatures"""
+    h = hashlib.sha256()
+    h.update(json.dumps(task.command).encode())
+    for filename in task.inputs:
+        h.update(f'{filename}={file_signature(filename)}\n'.encode())
+    for signature in dep_signatures:
+        h.update(signature.encode())
+    return h.hexdigest()
+
+
+def newest_mtime(filenames):
+    return max((os.stat(x).st_mtime for x in filenames if os.path.exists(x)),
+               default=0)
+
+
+def oldest_mtime(filenames):
+    return min((os.stat(x).st_mtime for x in filenames), default=0)
+
+
+def read_state(filename):
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+
+def write_state(filename, state):
+    """Write the state atomically, so an interrupted run never corrupts it"""
+    write_atomic(filename, json.dumps(state, indent=1, sort_keys=True))
+
+
+class Runner:
+    """Run tasks concurrently, each once its dependencies have succeeded"""
+
+    def __init__(self, tasks, limits, state_file=STATE_FILE, log_dir=LOG_DIR,
+                 force=False, dry_run=False):
+        self.tasks = {x.name: x for x in tasks}
+        self.limits = limits
+        self.state_file = state_file
+        self.state = {} if force else read_state(state_file)
+        self.force = force
+        self.log_dir = log_dir
+        self.dry_run = dry_run
+        self.status = {}
+        # Tasks that run (or would run) in this run
+        self.ran = set()
+
+    async def run(self):
+        self.semaphores = {stage: asyncio.Semaphore(n)
+                           for stage, n in self.limits.items()}
+        self.futures = {}
+        for name in self.tasks:
+            self.futures[name] = asyncio.ensure_future(self.run_task(name))
+        await asyncio.gather(*self.futures.values())
+        return self.status
+
+    async def run_task(self, name):
+        """Returns the signature of the task, or None if it did not succeed
+
+        An error in one task fails it, and blocks its dependents, instead of
+        stopping the whole run.
+        """
+        try:
+            return await self._run_task(name)
+        except Exception as e:
+            self.status[name] = 'failed'
+            click.echo(f'Failed: {name} ({e!r})')
+            return None
+
+    async def _run_task(self, name):
+        task = self.tasks[name]
+        dep_signatures = []
+        for dep in task.deps:
+            signature = await self.futures[dep] if dep in self.futures \
+                else self.state.get(dep, {}).get('signature')
+            if signature is None:
+                self.status[name] = 'blocked'
+                click.echo(f'Blocked: {name} (needs {dep})')
+                return None
+            dep_signatures.append(signature)
+        signature = task_signature(task, dep_signatures)
+
+        previous = self.state.get(name, {})
+        outputs_exist = all(os.path.exists(x) for x in task.outputs)
+        if previous.get('signature') == signature and outputs_exist:
+            self.status[name] = 'up to date'
+            return signature
+        # Outputs made before there was a state file are adopted when they
+        # are newer than the inputs, like make does
+        if not previous and not self.force and outputs_exist and \
+                not any(x in self.ran for x in task.deps) and \
+                newest_mtime(task.inputs) <= oldest_mtime(task.outputs):
+            self.status[name] = 'up to date'
+            if not self.dry_run:
+                self.state[name] = {'signature': signature}
+                write_state(self.state_file, self.state)
+            return signature
+        self.ran.add(name)
+        if self.dry_run:
+            self.status[name] = 'would run'
+            click.echo(f'Would run: {name}: {" ".join(task.command)}')
+            return signature
+
+        async with self.semaphores[task.stage]:
+            click.echo(f'Starting: {name}')
+            start = time.time()
+            returncode = await self.execute(task)
+        elapsed = time.time() - start
+
+        if returncode is None:
+            self.status[name] = 'failed'
+            click.echo(f'Failed: {name} could not be started, see '
+                       f'{self.log_prefix(name)}.err')
+            return None
+        if returncode != 0:
+            self.status[name] = 'failed'
+            click.echo(f'Failed: {name} (exit code {returncode}, see '
+                       f'{self.log_prefix(name)}.err)')
+            return None
+        missing = [x for x in task.outputs if not os.path.exists(x)]
+        if missing:
+            self.status[name] = 'failed'
+            click.echo(f'Failed: {name} did not create {missing[0]}')
+            return None
+        self.status[name] = 'done'
+        click.echo(f'Done: {name} ({elapsed:.0f}s)')
+        self.state[name] = {'signature': signature, 'seconds': elapsed}
+        write_state(self.state_file, self.state)
+        return signature
+
+    def log_prefix(self, name):
+        return os.path.join(self.log_dir, name.replace(':', '_'))
+
+    async def execute(self, task):
+        """Exit code of the task's command, or None if it could not start
+
+        e.g. because the executable is missing or not executable, which is
+        written to the task's .err log.
+        """
+        os.makedirs(self.log_dir, exist_ok=True)
+        prefix = self.log_prefix(task.name)
+        with open(prefix + '.out', 'w') as out, open(prefix + '.err', 'w') as err:
+            try:
+                if task.clean:
+                    for filename in task.outputs:
+                        if os.path.isfile(filename):
+                            os.remove(filename)
+                process = await asyncio.create_subprocess_exec(
+                    *task.command, cwd=task.cwd, stdout=out, stderr=err)
+            except OSError as e:
+                err.write(f'{e}\n')
+                return None
+            return await process.wait()
+
+
+@click.command()
+@click.option('--tissue', multiple=True,
+              help='Only run the tasks of these tissues (default: all)')
+@click.option('--r-jobs', default=max(1, os.cpu_count() // 4),
+              help='Notebooks rendered at once')
+@click.option('--python-jobs', default=os.cpu_count())
+@click.option('--state', 'state_file', default=STATE_FILE)
+@click.option('--log-dir', default=LOG_DIR)
+@click.option('--force', is_flag=True,
+              help='Ignore the state file and run every task')
+@click.option('--dry-run', is_flag=True,
+              help='Only list the tasks that would run')
+def cli(tissue, r_jobs, python_jobs, state_file, log_dir, force, dry_run):
+    """Run every stale task of the tissue pipeline"""
+    tasks = build_tasks(tissues=set(tissue))
+    limits = {DOWNLOAD: 1, R: r_jobs, PYTHON: python_jobs}
+    runner = Runner(tasks, limits, state_file, log_dir, force, dry_run)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        status = loop.run_until_complete(runner.run())
+    finally:
+        loop.close()
+
+    counts = {}
+    for x in status.values():
+        counts[x] = counts.get(x, 0) + 1
+    click.echo(', '.join(f'{n} {x}' for x, n in sorted(counts.items())))
+    if counts.get('failed') or counts.get('blocked'):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3.6
+# coding: utf-8
+
+# Pseudobulk expression of every gene in every tissue__cell_ontology_class,
+# so that global figures can be drawn from a genes x groups matrix instead of
+# the whole-atlas Seurat objects. For each tissue, the summed counts, summed
+# normalized expression and number of expressing cells of all groups come
+# from one sparse product of a groups x cells indicator matrix with the
+# counts. Tissues are read in parallel and the result is saved as one
+# compressed npz per method.
+#
+# Usage:
+#   ../utilities/pseudobulk.py build --method facs
+#   ../utilities/pseudobulk.py query --method facs --stat mean --gene Cd19 \
+#       --where tissue=Marrow
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+import click
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+import raw_counts
+
+STATS = ('sum', 'mean', 'fraction_expressing')
+GROUP_SEPARATOR = '__'
+GROUP_COLUMNS = ('tissue', 'cell_ontology_class')
+
+
+def pseudobulk_filename(method):
+    return f'pseudobulk_{method}.npz'
+
+
+def group_indicator(groups):
+    """Sparse groups x cells matrix with a 1 where a cell is in a group"""
+    codes, labels = pd.factorize(groups, sort=True)
+    data = np.ones(len(codes), dtype=np.float32)
+    indicator = sparse.csr_matrix((data, (codes, np.arange(len(codes)))),
+                                  shape=(len(labels), len(codes)))
+    return indicator, labels
+
+
+def tissue_sums(tissue, method, genes=None):
+    """Per-class sums of counts, normalized expression and expressing cells
+
+    Returns the group labels, the genes, three groups x genes arrays and the
+    number of cells per group. Cells without a cell ontology class are left
+    out.
+    """
+    counts, annotation = raw_counts.read_annotated_counts(tissue, method,
+                                                          genes=genes)
+    normalized = raw_counts.log_normalize(
+        counts.matrix, raw_counts.SCALE_FACTORS[method],
+        totals=annotation['n_counts'].values)
+
+    # Use the tissue of the file, since e.g. Aorta cells have tissue "Heart"
+    has_class = annotation['cell_ontology_class'].notnull().values
+    groups = (tissue + GROUP_SEPARATOR +
+              annotation['cell_ontology_class']).values[has_class]
+    indicator, labels = group_indicator(groups)
+    matrix = counts.matrix[has_class]
+    normalized = normalized[has_class]
+
+    expressing = matrix.copy()
+    expressing.data = (expressing.data > 0).astype(np.float32)
+    # Stack so all three reductions are a single sparse product
+    sums = indicator @ sparse.hstack([matrix, normalized, expressing]).tocsc()
+    sums = np.asarray(sums.todense())
+    n_genes = len(counts.genes)
+    n_cells = np.asarray(indicator.sum(axis=1)).ravel()
+    return (list(labels), counts.genes, sums[:, :n_genes],
+            sums[:, n_genes:2 * n_genes], sums[:, 2 * n_genes:], n_cells)
+
+
+class Pseudobulk:
+    """Genes x groups statistics of one method
+
+    ``groups`` has the tissue, cell_ontology_class and n_cells of each group,
+    indexed by "<tissue>__<cell_ontology_class>", and ``stats[name]`` is a
+    float32 genes x groups array for each name in STATS.
+    """
+
+    def __init__(self, genes, groups, stats):
+        self.genes = pd.Index(genes)
+        self.groups = groups
+        self.stats = stats
+
+    @classmethod
+    def from_tissues(cls, tissues, method, genes=None, jobs=None):
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(tissue_sums, tissue, method, genes)
+                       for tissue in tissues]
+            results = [future.result() for future in futures]
+
+        all_genes = pd.Index(genes) if genes is not None else \
+            raw_counts.union_genes([x[1] for x in results])
+        labels = sum((x[0] for x in results), [])
+        n_cells = np.concatenate([x[5] for x in results])
+        # genes x groups, with zeros for genes a tissue did not measure
+        aligned = [np.vstack([raw_counts.align_genes(x[i], x[1], all_genes)
+                              for x in results]).T.astype(np.float32)
+                   for i in (2, 3, 4)]
+        count_sums, expression_sums, expressing_sums = aligned
+
+        groups = pd.DataFrame([x.split(GROUP_SEPARATOR, 1) for x in labels],
+                              index=labels, columns=GROUP_COLUMNS)
+        groups['n_cells'] = n_cells.astype(int)
+        stats = {'sum': count_sums,
+                 'mean': expression_sums / n_cells.astype(np.float32),
+                 'fraction_expressing':
+                     expressing_sums / n_cells.astype(np.float32)}
+        return cls(all_genes, groups, stats)
+
+    def save(self, filename):
+        np.savez_compressed(
+            filename, genes=np.asarray(self.genes, dtype=str),
+            groups=np.asarray(self.groups.index, dtype=str),
+            n_cells=self.groups['n_cells'].values, **self.stats)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename, allow_pickle=False) as npz:
+            labels = [str(x) for x in npz['groups']]
+            groups = pd.DataFrame(
+                [x.split(GROUP_SEPARATOR, 1) for x in labels],
+                index=labels, columns=GROUP_COLUMNS)
+            groups['n_cells'] = npz['n_cells']
+            stats = {name: npz[name] for name in STATS}
+            return cls(npz['genes'], groups, stats)
+
+    def frame(self, stat='mean', genes=None, **where):
+        """A statistic as a genes x groups dataframe
+
+        Groups can be restricted with ``tissue=`` and
+        ``cell_ontology_class=``, given one value or a list of values.
+        """
+        if stat not in self.stats:
+            raise KeyError(f'stat must be one of {STATS}, not "{stat}"')
+        keep = np.ones(len(self.groups), dtype=bool)
+        for column, values in where.items():
+            if column not in GROUP_COLUMNS:
+                raise KeyError(f'Groups can only be selected by '
+                               f'{GROUP_COLUMNS}, not "{column}"')
+            if isinstance(values, str):
+                values = [values]
+            keep &= self.groups[column].isin(values).values
+        rows = slice(None) if genes is None else \
+            self.genes.get_indexer(pd.Index(genes))
+        if genes is not None and (rows < 0).any():
+            missing = np.asarray(genes)[rows < 0]
+            raise KeyError(f'{missing[0]} is not a gene of this pseudobulk')
+        values = self.stats[stat][rows][:, keep]
+        return pd.DataFrame(values, index=self.genes[rows],
+                            columns=self.groups.index[keep])
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--method', default='all',
+              type=click.Choice(('all',) + raw_counts.METHODS))
+@click.option('--output-dir', default='.')
+@click.option('--jobs', '-j', default=os.cpu_count())
+def build(method, output_dir, jobs):
+    """Aggregate the annotated cells of every tissue per class"""
+    methods = raw_counts.METHODS if method == 'all' else (method,)
+    for m in methods:
+        tissues = raw_counts.annotated_tissues(m)
+        pseudobulk = Pseudobulk.from_tissues(tissues, m, jobs=jobs)
+        filename = os.path.join(output_dir, pseudobulk_filename(m))
+        pseudobulk.save(filename)
+        click.echo(f'Wrote {filename}: {len(pseudobulk.genes)} genes x '
+                   f'{len(pseudobulk.groups)} groups from '
+                   f'{pseudobulk.groups["n_cells"].sum()} cells')
+
+
+@cli.command()
+@click.option('--method', default='facs',
+              type=click.Choice(raw_counts.METHODS))
+@click.option('--input-dir', default='.')
+@click.option('--stat', default='mean', type=click.Choice(STATS))
+@click.option('--gene', multiple=True, help='Genes to show (default: all)')
+@click.option('--where', multiple=True,
+              help='Restrict groups, e.g. tissue=Marrow')
+@click.option('--output', default=None, help='Write a csv instead')
+def query(method, input_dir, stat, gene, where, output):
+    """Print (or write) a genes x groups table"""
+    pseudobulk = Pseudobulk.load(os.path.join(input_dir,
+                                              pseudobulk_filename(method)))
+    restrictions = {}
+    for condition in where:
+        column, value = condition.split('=', 1)
+        restrictions.setdefault(column, []).append(value)
+    table = pseudobulk.frame(stat, genes=gene or None, **restrictions)
+    if output is None:
+        click.echo(table.to_string())
+    else:
+        table.to_csv(output)
+
+
+if __name__ == "__main__":
+    cli()
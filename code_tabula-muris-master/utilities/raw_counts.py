@@ -0,0 +1,298 @@
+# coding: utf-8
+
+# Read the raw gene-cell counts of a tissue into a sparse cells x genes matrix,
+# in the same cell naming and order as boilerplate.R, so that rows line up
+# with the cells of the per-tissue annotation csvs.
+#
+# Paths are relative to the root of the repository, like here() in R, so the
+# scripts importing this module can be run from any folder.
+
+import glob
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+from scipy import io, sparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+METHODS = ("facs", "droplet")
+ANNOTATION_COLUMNS = ('tissue', 'subtissue', 'cell_ontology_class',
+                      'cell_ontology_id', 'free_annotation', 'cluster.ids',
+                      'mouse.sex', 'mouse.id')
+ERCC_PATTERN = '^ERCC-'
+SCALE_FACTORS = {'facs': 1e6, 'droplet': 1e4}
+
+# Number of genes (rows) of a FACS counts csv to parse at a time
+CHUNKSIZE = 2000
+# Number of entries of a 10x matrix.mtx to parse at a time
+MTX_CHUNKSIZE = 1000000
+
+
+def here(*parts):
+    return os.path.join(ROOT, *parts)
+
+
+FACS_DIR = here('00_data_ingest', '00_facs_raw_data')
+DROPLET_DIR = here('00_data_ingest', '01_droplet_raw_data')
+ANNOTATION_DIR = here('00_data_ingest', '03_tissue_annotation_csv')
+
+# matrix is a scipy.sparse.csr_matrix of cells x genes, and cells and genes
+# are pandas Index objects labeling its rows and columns
+Counts = namedtuple('Counts', ['matrix', 'cells', 'genes'])
+
+
+def read_facs_counts(tissue, folder=FACS_DIR, cells=None):
+    """Read <tissue>-counts.csv (genes x cells) without ever making it dense
+
+    If ``cells`` is given, only the columns of those cells are parsed.
+    """
+    filename = os.path.join(folder, 'FACS', f'{tissue}-counts.csv')
+    blocks = []
+    genes = []
+    with open(filename) as f:
+        header = next(f).rstrip('\n').split(',')
+    all_cells = pd.Index([x.strip('"') for x in header[1:]])
+    if cells is None:
+        columns = None
+        cells = all_cells
+    else:
+        positions = np.flatnonzero(all_cells.isin(cells))
+        columns = [0] + list(positions + 1)
+        cells = all_cells[positions]
+
+    for chunk in pd.read_csv(filename, index_col=0, usecols=columns,
+                             chunksize=CHUNKSIZE):
+        genes.extend(chunk.index)
+        blocks.append(sparse.csr_matrix(chunk.values.astype(np.float32)))
+    matrix = sparse.vstack(blocks).T.tocsr()
+
+    # Sort cells by cell name, as in boilerplate.R
+    order = np.argsort(cells.values)
+    return Counts(matrix[order], cells[order], pd.Index(genes))
+
+
+def droplet_channel_folders(tissue, folder=DROPLET_DIR):
+    return sorted(glob.glob(os.path.join(folder, 'droplet', f'{tissue}-10X_*')))
+
+
+def channel_name(channel_folder):
+    """e.g. 10X_P4_3 for the folder Bladder-10X_P4_3"""
+    return os.path.basename(channel_folder).split('-', 1)[1]
+
+
+def read_mtx_columns(filename, columns):
+    """Entries of some columns of a Matrix Market file, as a sparse matrix
+
+    The file is parsed a block of entries at a time and only the entries of
+    ``columns`` are kept, in that order.
+    """
+    with open(filename) as f:
+        line = next(f)
+        while line.startswith('%'):
+            line = next(f)
+        n_rows, n_columns, _ = (int(x) for x in line.split())
+        new_column = np.full(n_columns, -1)
+        new_column[columns] = np.arange(len(columns))
+        rows, cols, data = [], [], []
+        for chunk in pd.read_csv(f, sep=' ', header=None,
+                                 chunksize=MTX_CHUNKSIZE):
+            chunk = chunk.values
+            # Matrix Market indices start at 1
+            column = new_column[chunk[:, 1].astype(int) - 1]
+            keep = column >= 0
+            rows.append(chunk[keep, 0].astype(int) - 1)
+            cols.append(column[keep])
+            data.append(chunk[keep, 2].astype(np.float32))
+    return sparse.coo_matrix(
+        (np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(n_rows, len(columns)))
+
+
+def read_10x(channel_folder, cells=None):
+    """Read one cellranger output folder, naming cells <channel>_<barcode>
+
+    If ``cells`` is given, only the counts of those cells are kept.
+    """
+    channel = channel_name(channel_folder)
+    genes = pd.read_csv(os.path.join(channel_folder, 'genes.tsv'),
+                        sep='\t', header=None)
+    # Read10X uses the gene symbols in the second column when there is one
+    genes = genes.iloc[:, -1]
+    barcodes = pd.read_csv(os.path.join(channel_folder, 'barcodes.tsv'),
+                           sep='\t', header=None).iloc[:, 0]
+    barcodes = barcodes.str.replace('-1$', '', regex=True)
+    all_cells = pd.Index(channel + '_' + barcodes)
+    filename = os.path.join(channel_folder, 'matrix.mtx')
+    if cells is None:
+        matrix = io.mmread(filename)
+        cells = all_cells
+    else:
+        positions = np.flatnonzero(all_cells.isin(cells))
+        matrix = read_mtx_columns(filename, positions)
+        cells = all_cells[positions]
+    return Counts(sparse.csr_matrix(matrix.T, dtype=np.float32),
+                  cells, pd.Index(genes))
+
+
+def read_droplet_counts(tissue, folder=DROPLET_DIR, cells=None):
+    """Read all 10x channels of a tissue
+
+    If ``cells`` is given, only the channels they come from are read, and only
+    the counts of those cells are kept.
+    """
+    folders = droplet_channel_folders(tissue, folder)
+    if cells is not None:
+        # Barcodes have no underscores, so the channel is what precedes the
+        # last one
+        wanted = {x.rsplit('_', 1)[0] for x in cells}
+        folders = [x for x in folders if channel_name(x) in wanted]
+    channels = [read_10x(x, cells) for x in folders]
+    if not channels:
+        raise FileNotFoundError(f'No droplet channels found for {tissue}')
+    genes = channels[0].genes
+    for channel in channels[1:]:
+        if not channel.genes.equals(genes):
+            raise ValueError(f'Channels of {tissue} have different genes')
+    matrix = sparse.vstack([x.matrix for x in channels]).tocsr()
+    cells = pd.Index(np.concatenate([x.cells.values for x in channels]))
+
+    # Order the cells alphabetically, as in boilerplate.R
+    order = np.argsort(cells.values)
+    return Counts(matrix[order], cells[order], genes)
+
+
+def read_counts(tissue, method, cells=None):
+    """Counts of a tissue, or only of ``cells`` if given"""
+    if method == 'facs':
+        return read_facs_counts(tissue, FACS_DIR, cells=cells)
+    elif method == 'droplet':
+        return read_droplet_counts(tissue, DROPLET_DIR, cells=cells)
+    raise ValueError(f'method must be one of {METHODS}, not "{method}"')
+
+
+def annotation_filename(tissue, method):
+    return os.path.join(ANNOTATION_DIR, f'{tissue}_{method}_annotation.csv')
+
+
+def annotated_tissues(method):
+    """Tissues with an annotation csv for this method"""
+    suffix = f'_{method}_annotation.csv'
+    filenames = glob.glob(os.path.join(ANNOTATION_DIR, '*' + suffix))
+    return sorted(os.path.basename(x)[:-len(suffix)] for x in filenames)
+
+
+def read_annotation(tissue, method):
+    """Annotation csv of a tissue, indexed by cell
+
+    Cluster ids, including those of subsets such as subsetA_cluster.ids, are
+    read as strings, so a column with NAs does not turn 0 into "0.0".
+    """
+    filename = annotation_filename(tissue, method)
+    columns = pd.read_csv(filename, nrows=0).columns
+    dtype = {x: str for x in columns if x.endswith('cluster.ids')}
+    return pd.read_csv(filename, index_col='cell', dtype=dtype)
+
+
+def column_isin(column, values):
+    """Boolean mask of the entries of an annotation column in ``values``
+
+    Values are compared as strings and, where both are numbers, as numbers,
+    like the == of the generated R code, so 0 matches "0" and "0.0".
+    """
+    values = [str(x) for x in values]
+    mask = column.astype(str).isin(values).values
+    numbers = pd.to_numeric(pd.Series(values), errors='coerce').dropna()
+    if len(numbers):
+        numeric = pd.to_numeric(column, errors='coerce')
+        mask = mask | numeric.isin(numbers).values
+    return mask
+
+
+def drop_erccs(counts):
+    """Remove the ERCC spike-ins, returning them separately"""
+    is_ercc = np.asarray(counts.genes.str.contains(ERCC_PATTERN))
+    ercc = Counts(counts.matrix[:, is_ercc], counts.cells,
+                  counts.genes[is_ercc])
+    kept = Counts(counts.matrix[:, ~is_ercc], counts.cells,
+                  counts.genes[~is_ercc])
+    return kept, ercc
+
+
+def subset_cells(counts, cells):
+    """Rows of ``counts`` for ``cells``, in that order"""
+    positions = counts.cells.get_indexer(cells)
+    if (positions < 0).any():
+        missing = np.asarray(cells)[positions < 0]
+        raise KeyError(f'{len(missing)} cells have no counts, '
+                       f'e.g. {missing[0]}')
+    return Counts(counts.matrix[positions], pd.Index(cells), counts.genes)
+
+
+def subset_genes(counts, genes):
+    """Columns of ``counts`` for the ``genes`` that were measured"""
+    genes = pd.Index(genes)
+    genes = genes[genes.isin(counts.genes)]
+    positions = counts.genes.get_indexer(genes)
+    return Counts(counts.matrix[:, positions], counts.cells, genes)
+
+
+def read_annotated_counts(tissue, method, genes=None, annotation=None):
+    """Counts of the annotated cells of a tissue, without ERCCs
+
+    Returns the counts and the annotation, with rows in the same order. The
+    annotation gets an "n_counts" column of total (non-ERCC) counts per cell,
+    so cells can still be normalized if ``genes`` restricts the columns.
+    If ``annotation`` is given, e.g. some rows of the annotation csv, only the
+    counts of its cells are read.
+    """
+    if annotation is None:
+        annotation = read_annotation(tissue, method)
+        cells = None
+    else:
+        annotation = annotation.copy()
+        cells = annotation.index
+    counts, _ = drop_erccs(read_counts(tissue, method, cells=cells))
+    counts = subset_cells(counts, annotation.index)
+    annotation['n_counts'] = np.asarray(counts.matrix.sum(axis=1)).ravel()
+    if genes is not None:
+        counts = subset_genes(counts, genes)
+    return counts, annotation
+
+
+def union_genes(gene_indexes):
+    """Genes of several tissues, in order of first appearance
+
+    Tissues of a method share their genes, but their matrices are aligned to
+    the union anyway, with zeros for genes a tissue did not measure.
+    """
+    return pd.Index(pd.unique(np.concatenate(
+        [np.asarray(x) for x in gene_indexes])))
+
+
+def align_genes(matrix, genes, all_genes):
+    """Columns of ``matrix``, one per gene, moved to their place in all_genes
+
+    Works on sparse and dense matrices, filling the other columns with zeros.
+    """
+    columns = pd.Index(all_genes).get_indexer(genes)
+    if sparse.issparse(matrix):
+        matrix = matrix.tocoo()
+        return sparse.csr_matrix(
+            (matrix.data, (matrix.row, columns[matrix.col])),
+            shape=(matrix.shape[0], len(all_genes)))
+    aligned = np.zeros((matrix.shape[0], len(all_genes)), dtype=matrix.dtype)
+    aligned[:, columns] = matrix
+    return aligned
+
+
+def log_normalize(matrix, scale_factor, totals=None):
+    """log1p of counts scaled to ``scale_factor`` per cell, as NormalizeData"""
+    if totals is None:
+        totals = np.asarray(matrix.sum(axis=1)).ravel()
+    scale = np.divide(scale_factor, totals, out=np.zeros(len(totals)),
+                      where=totals > 0)
+    normalized = sparse.diags(scale.astype(np.float32)) @ matrix
+    normalized = normalized.tocsr()
+    np.log1p(normalized.data, out=normalized.data)
+    return normalized
@@ -20,6 +20,12 @@ export LANG=en_US.UTF-8
 """
 
 
+def render_command(rmd):
+    """Rscript command line rendering an Rmd to HTML"""
+    return shlex.split(f"Rscript --verbose -e \"rmarkdown::render(\'{rmd}\', "
+                       "clean=TRUE)\"")
+
+
 @click.command()
 @click.option('--folder', default='.')
 @click.option('--search', default=None)
@@ -40,8 +46,7 @@ def main(folder, search):
         stdout = rmd + '.out'
         stderr = rmd + '.err'
 
-        command = shlex.split(f"Rscript --verbose -e \"rmarkdown::render(\'{rmd}\', "
-                              "clean=TRUE)\"  > {stdout} 2>{stderr}")
+        command = render_command(rmd)
         with open(stdout, 'w') as file_out:
             with open(stderr, 'w') as file_err:
                 subprocess.Popen(command, stdout=file_out, stderr=file_err)
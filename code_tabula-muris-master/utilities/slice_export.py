@@ -0,0 +1,180 @@
+#!/usr/bin/env python3.6
+# coding: utf-8
+
+# Export the cells matching a condition on the annotation columns, e.g. all
+# droplet T cells of Spleen and Thymus, as one self-contained sparse file with
+# their raw counts and annotations. The annotation csvs are read first to find
+# the matching cells, then only their columns of the FACS counts csvs, or only
+# their entries of the 10x channels they come from, are read. Time and memory
+# therefore go with the size of the slice rather than of the atlas.
+#
+# A --where given several times for one column matches any of its values, and
+# conditions on different columns must all match. Values match as the
+# FILTER_VALUE of the tissue yamls do, so --where cluster.ids=0 also selects
+# cells whose cluster is 0.0.
+#
+# Usage:
+#   ../utilities/slice_export.py --method droplet --where tissue=Spleen \
+#       --where tissue=Thymus --where "cell_ontology_class=T cell" \
+#       --output spleen_thymus_t_cells.npz
+#   ../utilities/slice_export.py --method facs --where tissue=Liver \
+#       --where cell_ontology_class=hepatocyte --format mtx \
+#       --output liver_hepatocytes
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+import click
+import numpy as np
+import pandas as pd
+from scipy import io, sparse
+
+import raw_counts
+
+FORMATS = ('npz', 'mtx')
+
+
+def parse_where(conditions):
+    """{column: [values]} of conditions like "mouse.sex=F" """
+    where = {}
+    for condition in conditions:
+        if '=' not in condition:
+            raise click.BadParameter(f'"{condition}" is not column=value')
+        column, value = condition.split('=', 1)
+        where.setdefault(column.strip(), []).append(value.strip())
+    return where
+
+
+def select_cells(method, where, tissues=None):
+    """Annotation of the matching cells of each tissue file
+
+    ``where`` is {column: [values]}, compared as the FILTER_VALUE of the
+    tissue yamls (see raw_counts.column_isin). Returns {tissue: annotation},
+    keyed by the tissue of the file, leaving out tissues with no matching
+    cells.
+    """
+    selected = {}
+    known = set()
+    for tissue in tissues or raw_counts.annotated_tissues(method):
+        annotation = raw_counts.read_annotation(tissue, method)
+        known.update(annotation.columns)
+        keep = np.ones(len(annotation), dtype=bool)
+        for column, values in where.items():
+            if column not in annotation.columns:
+                keep[:] = False
+                break
+            keep &= raw_counts.column_isin(annotation[column], values)
+        if keep.any():
+            selected[tissue] = annotation.loc[keep]
+    unknown = set(where) - known
+    if unknown:
+        raise KeyError(f'{sorted(unknown)[0]} is not an annotation column')
+    return selected
+
+
+def export_slice(method, where, genes=None, tissues=None, jobs=None):
+    """Counts and annotation of the matching cells of all tissues
+
+    Tissues are read in parallel.
+    """
+    selected = select_cells(method, where, tissues)
+    if not selected:
+        raise ValueError('No cells match ' + ', '.join(
+            f'{k} in {v}' for k, v in where.items()))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(raw_counts.read_annotated_counts, tissue,
+                                   method, genes, annotation)
+                   for tissue, annotation in selected.items()]
+        results = [future.result() for future in futures]
+
+    all_genes = raw_counts.union_genes([counts.genes for counts, _ in results])
+    matrix = sparse.vstack([
+        raw_counts.align_genes(counts.matrix, counts.genes, all_genes)
+        for counts, _ in results]).tocsr()
+    annotation = pd.concat([x for _, x in results], sort=False)
+    counts = raw_counts.Counts(matrix, annotation.index, all_genes)
+    return counts, annotation
+
+
+def save_slice(filename, counts, annotation):
+    """Save counts and annotation in one npz, read back with load_slice
+
+    Text annotation columns are saved as strings, with missing values as "".
+    """
+    columns = {}
+    for i, column in enumerate(annotation.columns):
+        values = annotation[column]
+        if not pd.api.types.is_numeric_dtype(values):
+            values = np.asarray(values.fillna(''), dtype=str)
+        columns[f'annotation_{i}'] = np.asarray(values)
+    matrix = counts.matrix.tocsr()
+    np.savez_compressed(
+        filename, data=matrix.data, indices=matrix.indices,
+        indptr=matrix.indptr, shape=matrix.shape,
+        cells=np.asarray(counts.cells, dtype=str),
+        genes=np.asarray(counts.genes, dtype=str),
+        annotation_columns=np.asarray(annotation.columns, dtype=str),
+        **columns)
+
+
+def load_slice(filename):
+    """Counts and annotation saved by save_slice"""
+    with np.load(filename, allow_pickle=False) as npz:
+        matrix = sparse.csr_matrix(
+            (npz['data'], npz['indices'], npz['indptr']),
+            shape=tuple(npz['shape']))
+        cells = pd.Index(npz['cells'], name='cell')
+        annotation = pd.DataFrame(index=cells)
+        for i, column in enumerate(npz['annotation_columns']):
+            values = npz[f'annotation_{i}']
+            if values.dtype.kind == 'U':
+                values = pd.Series(values, index=cells, dtype=object)
+                values[values == ''] = np.nan
+            annotation[str(column)] = values
+        return raw_counts.Counts(matrix, cells, pd.Index(npz['genes'])), \
+            annotation
+
+
+def write_mtx(folder, counts, annotation):
+    """Write a folder that Seurat's Read10X reads, plus annotation.csv"""
+    os.makedirs(folder, exist_ok=True)
+    # Read10X expects genes x cells
+    io.mmwrite(os.path.join(folder, 'matrix.mtx'), counts.matrix.T.tocoo(),
+               field='integer')
+    pd.DataFrame({'id': counts.genes, 'symbol': counts.genes}).to_csv(
+        os.path.join(folder, 'genes.tsv'), sep='\t', header=False,
+        index=False)
+    pd.Series(counts.cells).to_csv(os.path.join(folder, 'barcodes.tsv'),
+                                   header=False, index=False)
+    annotation.to_csv(os.path.join(folder, 'annotation.csv'))
+
+
+@click.command()
+@click.option('--method', required=True, type=click.Choice(raw_counts.METHODS))
+@click.option('--where', multiple=True,
+              help='Condition on an annotation column, e.g. mouse.sex=F')
+@click.option('--tissue', multiple=True,
+              help='Only look at the annotation csvs of these tissues '
+                   '(default: all)')
+@click.option('--gene', multiple=True, help='Genes to keep (default: all)')
+@click.option('--format', 'output_format', default='npz',
+              type=click.Choice(FORMATS))
+@click.option('--output', '-o', required=True,
+              help='npz file, or folder for --format mtx')
+@click.option('--jobs', '-j', default=os.cpu_count())
+def cli(method, where, tissue, gene, output_format, output, jobs):
+    """Write the counts and annotations of the cells matching --where"""
+    counts, annotation = export_slice(method, parse_where(where),
+                                      genes=gene or None,
+                                      tissues=tissue or None, jobs=jobs)
+    if output_format == 'npz':
+        save_slice(output, counts, annotation)
+    else:
+        write_mtx(output, counts, annotation)
+    click.echo(f'Wrote {output}: {len(counts.cells)} cells x '
+               f'{len(counts.genes)} genes, {counts.matrix.nnz} nonzero '
+               f'counts')
+
+
+if __name__ == "__main__":
+    cli()
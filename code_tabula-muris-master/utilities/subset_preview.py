@@ -0,0 +1,165 @@
+#!/usr/bin/env python3.6
+# coding: utf-8
+
+# Preview the subset reclustering that generate_from_template.py writes into
+# each tissue's Rmd, straight from the tissue yaml, in seconds instead of a
+# full knit. Each SUBSET's cells are selected with FILTER_COLUMN and
+# FILTER_VALUE, then go through variable genes, a randomized truncated PCA
+# with NPCS components, a shared nearest neighbor graph, Louvain clustering
+# at resolution RES and a tSNE with PERPLEXITY. Tissue yamls are processed in
+# parallel.
+#
+# Usage (from 30_tissue_supplement_figures):
+#   ../utilities/subset_preview.py ../28_tissue_yamls_for_supplement/*.yaml
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+import re
+
+import click
+import numpy as np
+import pandas as pd
+import yaml
+
+import clustering
+import raw_counts
+from generate_from_template import (TISSUE, METHOD, SUBSET, FILTER_COLUMN,
+                                    FILTER_VALUE, DEFAULTS, clean_name)
+
+NAME = 'NAME'
+SEED = 0
+# Subsets with fewer cells are reported instead of reclustered
+MIN_CELLS = 10
+
+
+def read_subsets(parameters_yaml):
+    """Tissue, method and {subset: parameters} of a tissue yaml
+
+    Parameter names are lowercase and missing ones get the same defaults as
+    in generate_from_template.py
+    """
+    with open(parameters_yaml) as f:
+        parameters = yaml.safe_load(f)
+    subsets = {}
+    for subset, kv in (parameters.get(SUBSET) or {}).items():
+        kv = {k.lower(): v for k, v in kv.items()}
+        for k, v in DEFAULTS.items():
+            kv.setdefault(k, v)
+        subsets[subset] = kv
+    return parameters[TISSUE], parameters[METHOD], subsets
+
+
+def filter_values(filter_value):
+    """Values of FILTER_VALUE as strings, e.g. "c(11,12)" -> ["11", "12"]"""
+    filter_value = str(filter_value)
+    vector = re.match(r'^c\((.*)\)$', filter_value.strip())
+    if vector is None:
+        return [filter_value]
+    return [x.strip().strip('"\'') for x in vector.group(1).split(',')]
+
+
+def in_subset(annotation, filter_column, filter_value):
+    """Boolean mask of the cells whose FILTER_COLUMN is in FILTER_VALUE
+
+    Numbers match whatever their formatting, see raw_counts.column_isin.
+    """
+    return raw_counts.column_isin(annotation[filter_column],
+                                  filter_values(filter_value))
+
+
+def subset_cluster_column(subset):
+    """Annotation column of a subset's clusters, e.g. subsetA_cluster.ids"""
+    subset = clean_name(subset)
+    return 's' + subset[1:] + '_cluster.ids'
+
+
+def recluster(normalized, n_pcs, resolution, perplexity, seed=SEED):
+    """Clusters and tSNE of a subset of cells"""
+    pcs = clustering.variable_gene_pcs(normalized, n_pcs, seed)
+    clusters = clustering.find_clusters(pcs, n_pcs, resolution, seed=seed)
+    return clusters, clustering.tsne(pcs, perplexity)
+
+
+def preview_tissue(parameters_yaml, output_dir, seed=SEED):
+    """Recluster every subset of a tissue yaml and write the results
+
+    Returns the number of cells and clusters of each subset
+    """
+    tissue, method, subsets = read_subsets(parameters_yaml)
+    if not subsets:
+        return tissue, method, []
+    counts, annotation = raw_counts.read_annotated_counts(tissue, method)
+    normalized = raw_counts.log_normalize(
+        counts.matrix, raw_counts.SCALE_FACTORS[method],
+        totals=annotation['n_counts'].values)
+
+    summary = []
+    for subset, kv in subsets.items():
+        column = subset_cluster_column(subset)
+        mask = in_subset(annotation, kv[FILTER_COLUMN.lower()],
+                         kv[FILTER_VALUE.lower()])
+        cells = annotation.index[mask]
+        row = {'tissue': tissue, 'method': method, 'subset': subset,
+               'name': kv.get(NAME.lower()), 'n_cells': len(cells),
+               'npcs': kv['npcs'], 'res': kv['res'],
+               'perplexity': kv['perplexity'], 'n_clusters': 0}
+        if len(cells) < MIN_CELLS:
+            # Report the subset so the yaml can be fixed, and go on
+            summary.append(row)
+            continue
+
+        clusters, tsne = recluster(normalized[mask], kv['npcs'],
+                                   kv['res'], kv['perplexity'], seed)
+        preview = pd.DataFrame({'preview_cluster.ids': clusters,
+                                'tSNE_1': tsne[:, 0], 'tSNE_2': tsne[:, 1]},
+                               index=cells)
+        preview.index.name = 'cell'
+        # Later subsets may filter on the clusters of this one, so fill them
+        # in when the annotation does not already have them
+        if column not in annotation.columns:
+            annotation[column] = pd.Series(clusters.astype(str), index=cells)
+        preview = preview.join(annotation[['cell_ontology_class', column]])
+
+        prefix = f'{tissue}_{method}_{clean_name(subset)}'
+        preview.to_csv(os.path.join(output_dir, f'{prefix}_preview.csv'))
+        table = pd.crosstab(preview['preview_cluster.ids'],
+                            preview['cell_ontology_class'].fillna('NA'))
+        table.to_csv(os.path.join(output_dir, f'{prefix}_preview_counts.csv'))
+
+        row['n_clusters'] = len(np.unique(clusters))
+        summary.append(row)
+    return tissue, method, summary
+
+
+@click.command()
+@click.argument('parameters_yamls', nargs=-1, required=True)
+@click.option('--output-dir', default='subset_preview')
+@click.option('--seed', default=SEED)
+@click.option('--jobs', '-j', default=os.cpu_count())
+def cli(parameters_yamls, output_dir, seed, jobs):
+    """Recluster the SUBSETs of each PARAMETERS_YAML"""
+    os.makedirs(output_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(preview_tissue, x, output_dir, seed)
+                   for x in parameters_yamls]
+        summary = []
+        for future in futures:
+            tissue, method, subsets = future.result()
+            for x in subsets:
+                if x['n_clusters'] == 0:
+                    click.echo(f'\t{tissue} {method} {x["subset"]}: only '
+                               f'{x["n_cells"]} cells, skipped')
+                else:
+                    click.echo(f'\t{tissue} {method} {x["subset"]}: '
+                               f'{x["n_cells"]} cells, {x["n_clusters"]} '
+                               f'clusters')
+            summary.extend(subsets)
+
+    summary = pd.DataFrame(summary)
+    summary.to_csv(os.path.join(output_dir, 'subset_preview_summary.csv'),
+                   index=False)
+    click.echo(f'Wrote {len(summary)} subset previews to {output_dir}')
+
+
+if __name__ == "__main__":
+    cli()
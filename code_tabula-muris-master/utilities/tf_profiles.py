@@ -0,0 +1,200 @@
+#!/usr/bin/env python3.6
+# coding: utf-8
+
+# Transcription factor expression per tissue__cell_ontology_class, as in
+# 23_tf_analysis/allCells_TF_analysis.Rmd, without building whole-atlas
+# Seurat objects. The counts of each tissue are restricted to the TFs as soon
+# as they are read, and the mean, fraction expressing and cell count of every
+# TF in every class come from one grouped sparse product per tissue (see
+# pseudobulk.py). Tissues are read in parallel.
+#
+# Usage (from 23_tf_analysis):
+#   ../utilities/tf_profiles.py --method facs \
+#       --reprogramming Extended_Data_Table_5.csv
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+import re
+
+import click
+import numpy as np
+import pandas as pd
+from scipy.cluster import hierarchy
+
+import pseudobulk
+import raw_counts
+
+TF_CSV = raw_counts.here('23_tf_analysis', 'GO_term_summary_20171110_222852.csv')
+DISSOCIATION_CSV = raw_counts.here('00_data_ingest', '20_dissociation_genes',
+                                   'genes_affected_by_dissociation_unix.csv')
+LINKAGE_COLUMNS = ['left', 'right', 'height', 'n_classes']
+# Names that make.names turns into e.g. "if." and "NA."
+R_RESERVED = {'if', 'else', 'repeat', 'while', 'function', 'for', 'next',
+              'break', 'TRUE', 'FALSE', 'NULL', 'Inf', 'NaN', 'NA',
+              'NA_integer_', 'NA_real_', 'NA_character_', 'NA_complex_',
+              'in'}
+
+
+def read_tf_names(tf_csv=TF_CSV, dissociation_csv=DISSOCIATION_CSV):
+    """TF symbols, without the genes affected by dissociation"""
+    tfs = pd.read_csv(tf_csv)['Symbol'].dropna().unique()
+    if dissociation_csv is not None:
+        iegs = pd.read_csv(dissociation_csv).iloc[:, 0]
+        tfs = tfs[~pd.Index(tfs).isin(iegs)]
+    return pd.Index(tfs)
+
+
+def tissue_tf_sums(tissue, method, tfs):
+    """Per-class sums of normalized TF expression and of expressing cells"""
+    labels, genes, _, sums, expressing, n_cells = pseudobulk.tissue_sums(
+        tissue, method, genes=tfs)
+
+    # Put this tissue's TFs in the order of the full list
+    return (labels, raw_counts.align_genes(sums, genes, tfs),
+            raw_counts.align_genes(expressing, genes, tfs), n_cells)
+
+
+def tf_profiles(tissues, method, tfs, jobs=None):
+    """Mean, fraction expressing and specificity of every TF in every class
+
+    Returns TF x class dataframes and the number of cells per class
+    """
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(tissue_tf_sums, tissue, method, tfs)
+                   for tissue in tissues]
+        results = [future.result() for future in futures]
+
+    labels = sum((x[0] for x in results), [])
+    expression_sums = np.vstack([x[1] for x in results])
+    expressing_sums = np.vstack([x[2] for x in results])
+    n_cells = np.concatenate([x[3] for x in results])
+
+    mean = expression_sums / n_cells[:, None]
+    fraction = expressing_sums / n_cells[:, None]
+    # Share of each TF's average expression that is in this class
+    totals = mean.sum(axis=0, keepdims=True)
+    specificity = np.divide(mean, totals, out=np.zeros(mean.shape),
+                            where=totals > 0)
+
+    def to_frame(values):
+        return pd.DataFrame(values.T, index=tfs, columns=labels)
+
+    detected = fraction.max(axis=0) > 0
+    profiles = {'mean': to_frame(mean), 'fraction_expressing':
+                to_frame(fraction), 'specificity': to_frame(specificity)}
+    profiles = {name: df.loc[detected] for name, df in profiles.items()}
+    return profiles, pd.Series(n_cells.astype(int), index=labels,
+                               name='n_cells')
+
+
+def correlation_clustering(mean, method='complete'):
+    """Class x class correlation of TF profiles, ordered by their dendrogram
+
+    Classes whose profile is constant, e.g. expressing none of the TFs, have
+    no correlation with any other class, so they are left out. Returns the
+    correlation, the linkage and the labels of the classes left out. The
+    linkage is empty when fewer than two classes are left.
+    """
+    constant = mean.columns[mean.values.std(axis=0) == 0]
+    mean = mean.drop(columns=constant)
+    if mean.shape[1] < 2:
+        correlation = pd.DataFrame(np.ones((mean.shape[1], mean.shape[1])),
+                                   index=mean.columns, columns=mean.columns)
+        linkage = pd.DataFrame(columns=LINKAGE_COLUMNS).astype(
+            {'left': int, 'right': int, 'height': float, 'n_classes': int})
+        return correlation, linkage, constant
+    correlation = np.corrcoef(mean.values.T)
+    distance = 1 - correlation[np.triu_indices(len(correlation), k=1)]
+    linkage = hierarchy.linkage(np.maximum(distance, 0), method=method)
+    order = hierarchy.leaves_list(linkage)
+
+    labels = mean.columns[order]
+    correlation = pd.DataFrame(correlation[np.ix_(order, order)],
+                               index=labels, columns=labels)
+    linkage = pd.DataFrame(linkage, columns=LINKAGE_COLUMNS)
+    linkage[['left', 'right', 'n_classes']] = \
+        linkage[['left', 'right', 'n_classes']].astype(int)
+    return correlation, linkage, constant
+
+
+def make_names(label):
+    """Mimic R's make.names, which the Extended Data Tables use
+
+    Names must start with a letter, or a dot not followed by a digit, so
+    others get an "X" prefix. Other characters than letters, digits, dots and
+    underscores become dots, and reserved words get a trailing dot.
+    """
+    if not re.match(r'[A-Za-z]|\.(?![0-9])', label):
+        label = 'X' + label
+    label = re.sub('[^A-Za-z0-9._]', '.', label)
+    if label in R_RESERVED:
+        label += '.'
+    return label
+
+
+def classes_above_threshold(fraction, protocols):
+    """Classes where every TF of a protocol is expressed above the threshold
+
+    Fills the Celltypes_above_threshold column of Extended Data Table 5
+    """
+    columns = pd.Index([make_names(x) for x in fraction.columns])
+    above = []
+    for genes, threshold in zip(protocols['Genes'],
+                                protocols['Fraction_Expressing_Threshold']):
+        genes = [x for x in str(genes).split(';') if x]
+        in_table = fraction.reindex(genes).fillna(0).values
+        all_above = (in_table >= threshold).all(axis=0)
+        above.append(';'.join(columns[all_above]))
+    protocols = protocols.copy()
+    protocols['Celltypes_above_threshold'] = above
+    return protocols
+
+
+@click.command()
+@click.option('--method', default='facs',
+              type=click.Choice(raw_counts.METHODS))
+@click.option('--tf-csv', default=TF_CSV,
+              help='GO term summary listing the TFs in a "Symbol" column')
+@click.option('--keep-dissociation-genes', is_flag=True)
+@click.option('--linkage', 'linkage_method', default='complete',
+              help='Hierarchical clustering linkage, as in hclust')
+@click.option('--reprogramming', default=None,
+              help='Extended Data Table 5 csv whose Celltypes_above_threshold '
+                   'to recompute')
+@click.option('--output-dir', default='.')
+@click.option('--jobs', '-j', default=os.cpu_count())
+def cli(method, tf_csv, keep_dissociation_genes, linkage_method,
+        reprogramming, output_dir, jobs):
+    """Write TF x class tables, the class correlation and its dendrogram"""
+    dissociation_csv = None if keep_dissociation_genes else DISSOCIATION_CSV
+    tfs = read_tf_names(tf_csv, dissociation_csv)
+    tissues = raw_counts.annotated_tissues(method)
+    click.echo(f'{len(tfs)} TFs in {len(tissues)} {method} tissues')
+
+    profiles, n_cells = tf_profiles(tissues, method, tfs, jobs)
+    for name, df in profiles.items():
+        df.to_csv(os.path.join(output_dir, f'tf_{name}_{method}.csv'))
+    n_cells.to_csv(os.path.join(output_dir, f'tf_n_cells_{method}.csv'))
+
+    correlation, linkage, constant = correlation_clustering(profiles['mean'],
+                                                            linkage_method)
+    if len(constant):
+        click.echo(f'{len(constant)} classes with a constant TF profile left '
+                   f'out of the correlation: {", ".join(constant)}')
+    correlation.to_csv(os.path.join(output_dir, f'tf_correlation_{method}.csv'))
+    linkage.to_csv(os.path.join(output_dir, f'tf_linkage_{method}.csv'),
+                   index=False)
+
+    if reprogramming is not None:
+        protocols = pd.read_csv(reprogramming)
+        protocols = classes_above_threshold(profiles['fraction_expressing'],
+                                            protocols)
+        protocols.to_csv(
+            os.path.join(output_dir, f'tf_reprogramming_{method}.csv'),
+            index=False)
+    click.echo(f'{len(profiles["mean"])} expressed TFs in '
+               f'{len(n_cells)} classes')
+
+
+if __name__ == "__main__":
+    cli()
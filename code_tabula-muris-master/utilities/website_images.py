@@ -0,0 +1,266 @@
+#!/usr/bin/env python3.6
+# coding: utf-8
+
+# Incremental build of the website images made by 21_website/GeneratePlots.Rmd:
+# <tissue>-<method>-<gene>-tsne.png, <tissue>-<method>-<gene>-vln.png and
+# <tissue>-<method>-<meta>-tsne.png.
+#
+# Every image gets a fingerprint of everything it is drawn from: the gene's
+# normalized expression, the tSNE coordinates, the grouping labels and the
+# plotting script. Images whose fingerprint is unchanged since the last build
+# are skipped. The others are drawn by 21_website/render_website_images.R,
+# with the ggplot code of GeneratePlots.Rmd, once per tissue. Rendered images
+# are stored once per fingerprint in images/objects, so identical plots (e.g.
+# every gene with no counts in a tissue) are drawn once and hard linked to
+# each of their names. The fingerprints of all images are written to
+# images/manifest.json.
+#
+# Usage (from 21_website):
+#   ../utilities/website_images.py [--tissue Liver] [--method facs]
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+import click
+import numpy as np
+import pandas as pd
+
+from atomic import atomic_path, write_atomic
+import raw_counts
+
+IMAGES_DIR = raw_counts.here('21_website', 'images')
+GENE_LIST = raw_counts.here('21_website', 'gene_list.csv')
+ROBJ_DIR = raw_counts.here('00_data_ingest', '04_tissue_robj_generated')
+RENDERER = ('Rscript',
+            raw_counts.here('21_website', 'render_website_images.R'))
+MANIFEST = 'manifest.json'
+OBJECTS = 'objects'
+METAS = ('cell_ontology_class', 'free_annotation', 'mouse.sex')
+
+
+def fingerprint(*parts):
+    """sha256 of strings, bytes and arrays, in order"""
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            h.update(str(part.dtype).encode())
+            h.update(np.ascontiguousarray(part).tobytes())
+        elif isinstance(part, bytes):
+            h.update(part)
+        else:
+            h.update(str(part).encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def renderer_fingerprint(renderer):
+    """Fingerprint of the renderer command, with the content of its scripts
+
+    Editing the plotting script therefore redraws every image.
+    """
+    parts = []
+    for arg in renderer:
+        if os.path.isfile(arg):
+            with open(arg, 'rb') as f:
+                parts.append(f.read())
+        else:
+            parts.append(arg)
+    return fingerprint(*parts)
+
+
+def object_path(images_dir, digest):
+    return os.path.join(images_dir, OBJECTS, digest[:2], digest + '.png')
+
+
+def read_manifest(images_dir):
+    filename = os.path.join(images_dir, MANIFEST)
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+
+def link(source, name):
+    """Point ``name`` at ``source``, replacing any previous image"""
+    # Renaming a hard link over another link to the same file does nothing,
+    # and would leave the temporary link behind
+    if os.path.exists(name) and os.path.samefile(source, name):
+        return
+    with atomic_path(name, suffix='.png') as tmp:
+        os.remove(tmp)
+        try:
+            os.link(source, tmp)
+        except OSError:
+            shutil.copyfile(source, tmp)
+
+
+def render(renderer, tissue, method, images):
+    """Draw (kind, name, filename) images of a tissue with the renderer"""
+    for _, _, filename in images:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    robj = os.path.join(ROBJ_DIR, f'{method}_{tissue}_seurat_tiss.Robj')
+    with tempfile.TemporaryDirectory() as folder:
+        images_csv = os.path.join(folder, 'images.csv')
+        pd.DataFrame(images, columns=['kind', 'name', 'filename']).to_csv(
+            images_csv, index=False)
+        result = subprocess.run(list(renderer) + [tissue, method, robj,
+                                                  images_csv],
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE,
+                                universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'{renderer[0]} exited with {result.returncode}: '
+                           f'{result.stderr.strip()[-1000:]}')
+
+
+def build_tissue(tissue, method, genes, images_dir, previous, force=False,
+                 renderer=RENDERER):
+    """Render the stale images of a tissue
+
+    Returns the manifest entries of all its images and the number of images
+    that were unchanged, linked to an existing object and rendered
+    """
+    counts, annotation = raw_counts.read_annotated_counts(tissue, method,
+                                                          genes=genes)
+    normalized = raw_counts.log_normalize(
+        counts.matrix, raw_counts.SCALE_FACTORS[method],
+        totals=annotation['n_counts'].values).tocsc()
+    normalized.sort_indices()
+    tsne = annotation[['tSNE_1', 'tSNE_2']].values.astype(np.float64)
+    classes = annotation['cell_ontology_class'].fillna('NA').values.astype(str)
+    renderer_digest = renderer_fingerprint(renderer)
+    tsne_digest = fingerprint(tsne)
+    classes_digest = fingerprint(classes)
+
+    entries = {}
+    stats = {'unchanged': 0, 'linked': 0, 'rendered': 0}
+    # Objects to draw, by fingerprint, and the names to link to them after
+    to_render = {}
+    to_link = []
+
+    def build(name, digest, kind, subject):
+        filename = os.path.join(images_dir, name)
+        obj = object_path(images_dir, digest)
+        entries[name] = {'tissue': tissue, 'method': method,
+                         'fingerprint': digest,
+                         'object': os.path.relpath(obj, images_dir)}
+        if not force and previous.get(name, {}).get('fingerprint') == digest \
+                and os.path.exists(filename) and os.path.exists(obj):
+            stats['unchanged'] += 1
+            return
+        if digest in to_render or (not force and os.path.exists(obj)):
+            stats['linked'] += 1
+        else:
+            to_render[digest] = (kind, subject, obj)
+            stats['rendered'] += 1
+        to_link.append((obj, filename))
+
+    for j, gene in enumerate(counts.genes):
+        column = normalized[:, j]
+        # Sparse indices and values identify the expression vector without
+        # densifying it, and are empty for genes with no counts
+        expression_digest = fingerprint(column.indices, column.data)
+        build(f'{tissue}-{method}-{gene}-tsne.png',
+              fingerprint('tsne', renderer_digest, method, tsne_digest,
+                          expression_digest), 'tsne', gene)
+        build(f'{tissue}-{method}-{gene}-vln.png',
+              fingerprint('vln', renderer_digest, method, classes_digest,
+                          expression_digest), 'vln', gene)
+
+    for meta in METAS:
+        if meta not in annotation.columns:
+            continue
+        labels = annotation[meta].fillna('NA').values.astype(str)
+        build(f'{tissue}-{method}-{meta}-tsne.png',
+              fingerprint('meta', renderer_digest, meta, tsne_digest, labels),
+              'meta', meta)
+
+    if to_render:
+        render(renderer, tissue, method, list(to_render.values()))
+    for obj, filename in to_link:
+        link(obj, filename)
+    return entries, stats
+
+
+def write_manifest(images_dir, manifest):
+    """Write the manifest atomically, with images sorted by name"""
+    write_atomic(os.path.join(images_dir, MANIFEST),
+                 json.dumps(dict(sorted(manifest.items())), indent=1))
+
+
+def remove_unused_objects(images_dir, manifest):
+    used = {x['object'] for x in manifest.values()}
+    removed = 0
+    for folder, _, filenames in os.walk(os.path.join(images_dir, OBJECTS)):
+        for filename in filenames:
+            path = os.path.join(folder, filename)
+            if os.path.relpath(path, images_dir) not in used:
+                os.remove(path)
+                removed += 1
+    return removed
+
+
+@click.command()
+@click.option('--images-dir', default=IMAGES_DIR)
+@click.option('--gene-list', default=GENE_LIST)
+@click.option('--method', default='all',
+              type=click.Choice(('all',) + raw_counts.METHODS))
+@click.option('--tissue', default=None, multiple=True,
+              help='Only build these tissues (default: all annotated)')
+@click.option('--force', is_flag=True, help='Render every image again')
+@click.option('--prune', is_flag=True,
+              help='Remove stored images no longer in the manifest')
+@click.option('--jobs', '-j', default=os.cpu_count())
+def cli(images_dir, gene_list, method, tissue, force, prune, jobs):
+    """Render the website images whose inputs changed since the last build"""
+    genes = pd.read_csv(gene_list, header=None).iloc[:, 0].values
+    methods = raw_counts.METHODS if method == 'all' else (method,)
+    jobs_args = [(t, m) for m in methods
+                 for t in (tissue or raw_counts.annotated_tissues(m))]
+    os.makedirs(images_dir, exist_ok=True)
+    manifest = read_manifest(images_dir)
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+        for t, m in jobs_args:
+            previous = {k: v for k, v in manifest.items()
+                        if v['tissue'] == t and v['method'] == m}
+            futures[executor.submit(build_tissue, t, m, genes, images_dir,
+                                    previous, force)] = t, m
+        # Save each tissue's images in the manifest as soon as it finishes,
+        # so a failing tissue does not lose the images of the others
+        for future in as_completed(futures):
+            t, m = futures[future]
+            try:
+                entries, stats = future.result()
+            except Exception as e:
+                failed.append(f'{t} {m}')
+                click.echo(f'\t{t} {m}: failed, {e!r}', err=True)
+                continue
+            # Drop images of this tissue that are no longer built
+            manifest = {k: v for k, v in manifest.items()
+                        if not (v['tissue'] == t and v['method'] == m)}
+            manifest.update(entries)
+            write_manifest(images_dir, manifest)
+            click.echo(f'\t{t} {m}: {stats["rendered"]} rendered, '
+                       f'{stats["linked"]} deduplicated, '
+                       f'{stats["unchanged"]} unchanged')
+
+    write_manifest(images_dir, manifest)
+    if prune:
+        click.echo(f'Removed {remove_unused_objects(images_dir, manifest)} '
+                   f'unused images')
+    click.echo(f'{len(manifest)} images in {MANIFEST}')
+    if failed:
+        raise click.ClickException(f'{len(failed)} tissues failed: '
+                                   f'{", ".join(failed)}')
+
+
+if __name__ == "__main__":
+    cli()